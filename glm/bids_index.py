@@ -0,0 +1,174 @@
+# Columnar index of vignette events, ratings and confounds
+#
+# One Parquet row per (subject, run) holding the source paths, a size/mtime
+# stamp and every events / behavioral / selected confound column as a list, so
+# get_subject_info and the nltools GLM read one file instead of re-parsing
+# three TSVs per run. Runs are whatever is on disk (a preprocessed bold plus
+# its events and confounds files); the index is checked against the files on
+# every load and rescans re-parse only runs that are new or whose source files
+# changed.
+
+import os
+import re
+import glob
+import argparse
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from run_cache import _atomic_write
+
+event_columns = ['onset', 'duration', 'trial_type', 'stim_file']
+beh_columns = ['moral_decision']
+confound_columns = ['dvars', 'framewise_displacement'] + \
+    ['a_comp_cor_%02d' % i for i in range(6)] + ['cosine%02d' % i for i in range(4)] + \
+    ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']
+
+# Source files of one run; the run entity is zero-padded in some names
+# (run-01) and not in others (run-1), so runs are keyed by integer
+patterns = {'bold': 'derivatives/fmriprep/sub-*/func/sub-*_task-vignette_run-*_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz',
+            'events': 'sub-*/func/sub-*_task-vignette_run-*_events.tsv',
+            'confounds': 'derivatives/fmriprep/sub-*/func/sub-*_task-vignette_run-*_desc-confounds_timeseries.tsv',
+            'beh': 'sub-*/beh/sub-*_task-vignette_*run-*_beh.tsv'}
+required = ['bold', 'events', 'confounds']
+
+_entities = re.compile(r'(sub-[a-zA-Z0-9]+)_.*run-(\d+)')
+_loaded = {}
+
+
+def index_file(bids_dir):
+    '''Location of the index for a BIDS directory'''
+    return os.path.join(bids_dir, 'derivatives', 'vignette_index', 'runs.parquet')
+
+
+def find_runs(bids_dir):
+    '''Source files of every complete run on disk, one row per (subject, run)'''
+    files = {}
+    for kind, pattern in patterns.items():
+        for path in glob.glob(os.path.join(bids_dir, pattern)):
+            match = _entities.search(os.path.basename(path))
+            if match:
+                files.setdefault((match.group(1), int(match.group(2))), {})[kind] = path
+
+    rows = []
+    for (subject, run), paths in sorted(files.items()):
+        if all(kind in paths for kind in required):
+            rows.append(dict(subject=subject, run=run,
+                             **{kind: paths.get(kind) for kind in patterns}))
+    runs = pd.DataFrame(rows, columns=['subject', 'run'] + list(patterns))
+    runs['stamp'] = [_stamp(row) for _, row in runs.iterrows()]
+    return runs
+
+
+def _stamp(row):
+    '''Sizes and mtimes of a run's text sources; a change triggers re-parsing'''
+    stamps = []
+    for kind in ['events', 'confounds', 'beh']:
+        if isinstance(row[kind], str):
+            stat = os.stat(row[kind])
+            stamps.append('{}:{}'.format(stat.st_size, stat.st_mtime_ns))
+        else:
+            stamps.append('-')
+    return '|'.join(stamps)
+
+
+def _read_columns(path, columns):
+    '''Requested columns of a TSV as arrays (empty for a run without that file)'''
+    if not isinstance(path, str):
+        return {c: np.array([]) for c in columns}
+    header = pd.read_csv(path, sep='\t', nrows=0).columns
+    missing = [c for c in columns if c not in header]
+    if missing:
+        raise ValueError('{} has no column(s) {}'.format(path, ', '.join(missing)))
+    df = pd.read_csv(path, sep='\t', usecols=columns)
+    return {c: df[c].values for c in columns}
+
+
+def parse_run(row):
+    '''Events, ratings and confounds of one run as list-valued columns'''
+    parsed = dict(row)
+    parsed.update(_read_columns(row['events'], event_columns))
+    parsed.update(_read_columns(row['beh'], beh_columns))
+    parsed.update(_read_columns(row['confounds'], confound_columns))
+    parsed['trial_type'] = parsed['trial_type'].astype(str)
+    parsed['stim_file'] = parsed['stim_file'].astype(str)
+    return parsed
+
+
+def build_index(bids_dir, n_jobs=-1, verbose=0):
+    '''Scan bids_dir, re-parse new or changed runs in parallel and rewrite the index'''
+    runs = find_runs(bids_dir)
+    out_file = index_file(bids_dir)
+    old = pd.read_parquet(out_file) if os.path.exists(out_file) else None
+
+    if old is not None:
+        current = runs.merge(old[['subject', 'run', 'stamp']], on=['subject', 'run', 'stamp'],
+                             how='left', indicator=True)['_merge'] == 'both'
+    else:
+        current = pd.Series(False, index=runs.index)
+
+    parsed = Parallel(n_jobs=n_jobs, verbose=verbose)(
+        delayed(parse_run)(row) for _, row in runs[~current.values].iterrows())
+    if old is not None and current.any():
+        keep = old.merge(runs[current.values][['subject', 'run', 'stamp']],
+                         on=['subject', 'run', 'stamp'])
+        parsed = keep.to_dict('records') + parsed
+
+    index = pd.DataFrame(parsed, columns=list(runs.columns) + event_columns + beh_columns +
+                         confound_columns).sort_values(['subject', 'run']).reset_index(drop=True)
+    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    _atomic_write(out_file, lambda tmp_path: index.to_parquet(tmp_path, index=False))
+    _loaded.pop(out_file, None)
+    print('Indexed {} runs of {} subjects ({} re-parsed)'.format(
+        len(index), index['subject'].nunique(), int((~current).sum())))
+    return index
+
+
+def _stale(bids_dir, out_file):
+    '''Whether runs were added, removed or changed on disk since the index was written'''
+    if not os.path.exists(out_file):
+        return True
+    key = ['subject', 'run', 'stamp']
+    on_disk = find_runs(bids_dir)[key]
+    indexed = pd.read_parquet(out_file, columns=key)
+    return len(on_disk) != len(indexed) or \
+        len(on_disk.merge(indexed, on=key)) != len(on_disk)
+
+
+def load_index(bids_dir):
+    '''The index for bids_dir, rescanned when it no longer matches the files on disk and memoized per process'''
+    out_file = index_file(bids_dir)
+    if _stale(bids_dir, out_file):
+        build_index(bids_dir)
+    mtime = os.stat(out_file).st_mtime_ns
+    if out_file not in _loaded or _loaded[out_file][0] != mtime:
+        _loaded[out_file] = (mtime, pd.read_parquet(out_file))
+    return _loaded[out_file][1]
+
+
+def subject_runs(subject, bids_dir, require=()):
+    '''Index rows of one subject, ordered by run; raises if the subject has no
+    complete runs or any run lacks one of the optional sources in require (e.g. 'beh')'''
+    index = load_index(bids_dir)
+    runs = index[index['subject'] == subject].sort_values('run')
+    if not len(runs):
+        raise ValueError('No indexed runs for {} in {} (needs {} files)'.format(
+            subject, bids_dir, ', '.join(required)))
+    for kind in require:
+        lacking = runs.loc[runs[kind].isna(), 'run'].tolist()
+        if lacking:
+            raise ValueError('{} has no {} file for run(s) {}'.format(subject, kind, lacking))
+    return runs
+
+
+def run_table(row, columns):
+    '''Rebuild a per-run DataFrame (e.g. event_columns) from an index row'''
+    return pd.DataFrame({c: row[c] for c in columns})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or refresh the vignette events/confounds index')
+    parser.add_argument('-bids_dir', type=str, required=True)
+    parser.add_argument('-n_jobs', type=int, default=-1)
+    args = parser.parse_args()
+
+    build_index(args.bids_dir, n_jobs=args.n_jobs, verbose=5)
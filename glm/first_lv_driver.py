@@ -0,0 +1,102 @@
+# Multi-subject first-level driver
+#
+# Replaces launching one first_lv_*.py / nltools_ratings_glm.py process per
+# subject: every requested subject and pipeline is scheduled in a single nipype
+# graph, so one MultiProc pool with one CPU and memory budget covers the whole
+# batch and nodes are admitted according to their mem_gb estimates.
+
+import os
+import argparse
+from nipype import Workflow, Node
+from nipype.interfaces.utility import Function, IdentityInterface
+from first_lv_workflow import find_subjects, code_dir, working_dir
+from provenance import build_incremental
+from tracing import start_trace, node_trace_args
+
+pipelines = ['smoothed', 'unsmoothed', 'nltools']
+
+
+def nltools_subject(subject, stream, code_dir):
+    '''Nipype Function node wrapper around nltools_ratings_glm.run_subject'''
+    import sys
+    sys.path.insert(0, code_dir)
+    from nltools_ratings_glm import run_subject
+    run_subject(subject, stream=stream)
+    return subject
+
+
+def build_nltools(subject_list, stream=False):
+    '''Workflow running the rating-modulated nltools GLM once per subject'''
+    infosource = Node(IdentityInterface(fields=['subject_id']), name="infosource")
+    infosource.iterables = [('subject_id', subject_list)]
+
+    glm = Node(Function(input_names=['subject', 'stream', 'code_dir'],
+                        output_names=['subject'],
+                        function=nltools_subject),
+               # One smoothed float64 run plus its copy, or bounded chunks
+               # when streaming; see nltools_ratings_glm.py
+               name='nltools_glm', mem_gb=2 if stream else 8)
+    glm.inputs.stream = stream
+    glm.inputs.code_dir = code_dir
+
+    wf = Workflow(name='nltools_ratings_glm')
+    wf.connect([(infosource, glm, [('subject_id', 'subject')])])
+    return wf
+
+
+def available_memory_gb(fraction=0.9):
+    '''Share of total system memory handed to the MultiProc scheduler'''
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                return fraction * int(line.split()[1]) / 1024**2
+    return None
+
+
+def build_driver(subject_list, pipeline_list, stream=False, force=False):
+    '''One graph holding every requested pipeline for every subject
+
+    SPM subjects whose provenance manifest is current are left out, and those
+    where only contrast_list changed get a contrast-only workflow. Returns
+    None when there is nothing to run.
+    '''
+    driver = Workflow(name='1st_lv_driver', base_dir=working_dir)
+    workflows = []
+    for pipeline in pipeline_list:
+        if pipeline == 'nltools':
+            workflows.append(build_nltools(subject_list, stream=stream))
+        else:
+            workflows += build_incremental(subject_list, smoothed=pipeline == 'smoothed', force=force)
+    if not workflows:
+        return None
+    driver.add_nodes(workflows)
+    driver.config["execution"]["crashfile_format"] = "txt"
+    return driver
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run first-level models for many subjects in one nipype graph')
+    parser.add_argument('-subjects', nargs='+', default=['all'],
+                        help="subject ids ('01' or 'sub-01'), or 'all' for every subject in the BIDS dir")
+    parser.add_argument('-pipelines', nargs='+', default=['smoothed'], choices=pipelines)
+    parser.add_argument('-stream', action='store_true', help='run the nltools GLM in streaming mode')
+    parser.add_argument('-force', action='store_true', help='ignore provenance manifests and re-estimate everything')
+    parser.add_argument('-n_procs', type=int, default=os.cpu_count())
+    parser.add_argument('-memory_gb', type=float, default=available_memory_gb())
+    parser.add_argument('-trace', type=str, default=None,
+                        help='append per-node and per-stage wall/CPU time, peak RSS and I/O to this .jsonl')
+    args = parser.parse_args()
+    if args.trace:
+        start_trace(args.trace)
+
+    if args.subjects == ['all']:
+        subject_list = find_subjects()
+    else:
+        subject_list = [s if s.startswith('sub-') else 'sub-' + s for s in args.subjects]
+    print('Running {} subject(s) through: {}'.format(len(subject_list), ', '.join(args.pipelines)))
+
+    driver = build_driver(subject_list, args.pipelines, stream=args.stream, force=args.force)
+    if driver is None:
+        raise SystemExit('Every subject is up to date')
+    driver.run('MultiProc', plugin_args=node_trace_args({'n_procs': args.n_procs,
+                                                         'memory_gb': args.memory_gb}))
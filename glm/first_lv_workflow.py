@@ -0,0 +1,313 @@
+# First-level GLM via Nipype & SPM12: shared workflow definition
+#
+# Used by first_lv_smoothed_condition.py, first_lv_unsmoothed_condition.py and
+# the multi-subject driver first_lv_driver.py.
+
+from os.path import join as opj
+import os
+import getpass
+from nipype.interfaces.spm import Level1Design, EstimateModel, EstimateContrast
+from nipype.algorithms.modelgen import SpecifySPMModel
+from nipype.interfaces.utility import Function, IdentityInterface
+from nipype.interfaces.io import SelectFiles, DataSink
+from nipype import Workflow, Node, MapNode
+from nipype.algorithms.misc import Gunzip
+from run_cache import trim_run
+from smoothing import smooth_runs
+
+user = getpass.getuser()
+
+working_dir = '/home/{}/spm/analysis/vignettes/glm/spm/'.format(user)
+data_dir = '/home/{}/spm/bids/'.format(user) # BIDS main
+exp_dir = '/home/{}/spm/analysis/vignettes/glm/spm/'.format(user)
+
+output_dir = os.path.join(exp_dir + "results") # Output for analyses
+experiment_dir = '/home/{}/spm/bids/'.format(user) # BIDS main
+
+code_dir = os.path.dirname(os.path.abspath(__file__))
+
+TR = 0.72
+fwhm = [6,6,6]
+hpf = 90
+bases = {'hrf': {'derivs': [1, 0]}}
+serial_correlations = 'AR(1)'
+t_min, t_size = 11, 668 # dummy scans dropped from each run
+
+# Rough per-node memory footprints (GB) used by MultiProc's memory-aware
+# scheduler; one 668-volume MNI run is ~1.5 GB uncompressed. Smoothing works
+# through a memory-mapped copy a few volumes at a time.
+node_mem_gb = {'Remove_Dummies': 2,
+               'smooth': 1,
+               'level1design': 1,
+               'level1estimate': 6,
+               'level1conest': 2}
+
+# Condition names & Contrasts
+condition_names = ['carep','carem','fair','lib',
+                  'loy','auth','pur','socn']
+
+# Canonical Contrasts
+cont01 = ['Physical Care', 'T', condition_names, [1, 0, 0, 0, 0, 0, 0, 0]]
+cont02 = ['Emotional Care', 'T', condition_names, [0, 1, 0, 0, 0, 0, 0, 0]]
+cont03 = ['Fairness','T', condition_names, [0, 0, 1, 0, 0, 0, 0, 0]]
+cont04 = ['Liberty','T', condition_names, [0, 0, 0, 1, 0, 0, 0, 0]]
+cont05 = ['Loyalty','T', condition_names, [0, 0, 0, 0, 1, 0, 0, 0]]
+cont06 = ['Authority','T', condition_names, [0, 0, 0, 0, 0, 1, 0, 0]]
+cont07 = ['Sanctity','T', condition_names, [0, 0, 0, 0, 0, 0, 1, 0]]
+cont08 = ['Social Norms','T', condition_names, [0, 0, 0, 0, 0, 0, 0, 1]]
+
+# Moral Foundation > Social Norms
+cont09 = ['Physical Care > Social','T', condition_names, [1, 0, 0, 0, 0, 0, 0, -1]]
+cont10 = ['Emotional Care > Social','T', condition_names, [0, 1, 0, 0, 0, 0, 0, -1]]
+cont11 = ['Fairness > Social','T', condition_names, [0, 0, 1, 0, 0, 0, 0, -1]]
+cont12 = ['Liberty > Social','T', condition_names, [0, 0, 0, 1, 0, 0, 0, -1]]
+cont13 = ['Loyalty > Social','T', condition_names, [0, 0, 0, 0, 1, 0, 0, -1]]
+cont14 = ['Authority > Social','T', condition_names, [0, 0, 0, 0, 0, 1, 0, -1]]
+cont15 = ['Sanctity > Social','T', condition_names, [0, 0, 0, 0, 0, 0, 1, -1]]
+
+cont16 = ['Binding > Individualizing','T', condition_names, [-1/3., -1/3., -1/3., 0, 1/3., 1/3., 1/3., 0]]
+cont17 = ['Moral > Social','T', condition_names, [1/7., 1/7., 1/7., 1/7., 1/7., 1/7., 1/7., -1]]
+
+contrast_list = [cont01, cont02, cont03, cont04, cont05, cont06, cont07, cont08,
+                 cont09, cont10, cont11, cont12, cont13, cont14, cont15,
+                 cont16, cont17]
+
+# Function to get Subject specific condition information from the events /
+# confounds index (bids_index.py); runs are those present on disk
+def get_subject_info(subject_id, bids_dir, code_dir):
+    import sys
+    import pandas as pd
+    sys.path.insert(0, code_dir)
+    from bids_index import subject_runs, run_table
+    from nipype.interfaces.base import Bunch
+
+    nuisance_reg = ['dvars', 'framewise_displacement'] + \
+    ['a_comp_cor_%02d' % i for i in range(6)] + ['cosine%02d' % i for i in range(4)]
+
+    subjectinfo = []
+    for _, row in subject_runs(subject_id, bids_dir).iterrows():
+        ev = run_table(row, ['onset', 'duration', 'trial_type'])
+        ev['onset'] = ev['onset'] - 5.76
+        ev['duration'] = 7.92
+
+        nr = run_table(row, nuisance_reg).iloc[11:-11]
+
+        run_info = Bunch(onsets=[], durations=[])
+
+        run_info.set(conditions=[g[0] for g in ev.groupby("trial_type")])
+        run_info.set(regressor_names=nr.columns.tolist())
+        run_info.set(regressors=nr.T.values.tolist())
+
+        for group in ev.groupby("trial_type"):
+            run_info.onsets.append(group[1].onset.tolist())
+            run_info.durations.append(group[1].duration.tolist())
+
+        subjectinfo.append(run_info)
+
+    return subjectinfo
+
+
+def record_provenance(subject_id, smoothed, spm_mat_file, beta_images, residual_image,
+                      con_images, spmT_images, output_dir, code_dir):
+    '''Write the provenance manifest of a finished subject (see provenance.py)'''
+    import os
+    import sys
+    sys.path.insert(0, code_dir)
+    from provenance import write_manifest, pipeline_label
+    images = [con_images] if isinstance(con_images, str) else list(con_images)
+    images += [spmT_images] if isinstance(spmT_images, str) else list(spmT_images)
+    sunk = os.path.join(output_dir, pipeline_label(smoothed), subject_id)
+    outputs = [os.path.join(sunk, os.path.basename(f)) for f in images]
+    return write_manifest(subject_id, smoothed, spm_mat_file, beta_images, residual_image, outputs)
+
+
+def estimated_model(subject_id, smoothed, code_dir):
+    '''SPM.mat, betas and ResMS of a previous estimation, from the subject's manifest'''
+    import sys
+    sys.path.insert(0, code_dir)
+    from provenance import read_manifest
+    model = read_manifest(subject_id, smoothed)['model']
+    return model['spm_mat_file'], model['beta_images'], model['residual_image']
+
+
+def find_subjects(bids_dir=experiment_dir):
+    '''All subjects with preprocessed vignette runs in the fMRIPrep derivatives'''
+    deriv_dir = opj(bids_dir, 'derivatives', 'fmriprep')
+    subjects = []
+    for sub in sorted(os.listdir(deriv_dir)):
+        func_dir = opj(deriv_dir, sub, 'func')
+        if sub.startswith('sub-') and os.path.isdir(func_dir) and \
+                any('task-vignette' in f and 'preproc_bold' in f for f in os.listdir(func_dir)):
+            subjects.append(sub)
+    return subjects
+
+
+def add_contrast_stage(l1analysis, infosource, model, smoothed):
+    '''EstimateContrast on the outputs of `model`, then datasink and provenance manifest
+
+    `model` is any node with spm_mat_file, beta_images and residual_image
+    outputs (level1estimate, or the stored model of a previous run).
+    '''
+    label = '1st_lv_smoothed_avgcond' if smoothed else '1st_lv_unsmoothed_avgcond'
+
+    # EstimateContrast - estimates contrasts
+    level1conest = Node(EstimateContrast(), name="level1conest",
+                        mem_gb=node_mem_gb['level1conest'])
+
+    # Datasink - creates output folder for important outputs
+    datasink = Node(DataSink(base_directory=experiment_dir,
+                             container=output_dir),
+                    name="datasink")
+
+    # Use the following DataSink output substitutions
+    datasink.inputs.substitutions = [('_subject_id_', ''),]
+
+    record = Node(Function(input_names=['subject_id', 'smoothed', 'spm_mat_file', 'beta_images',
+                                        'residual_image', 'con_images', 'spmT_images',
+                                        'output_dir', 'code_dir'],
+                           output_names=['manifest'],
+                           function=record_provenance),
+                  name='provenance')
+    record.inputs.smoothed = smoothed
+    record.inputs.output_dir = output_dir
+    record.inputs.code_dir = code_dir
+
+    model_outputs = [('spm_mat_file', 'spm_mat_file'),
+                     ('beta_images', 'beta_images'),
+                     ('residual_image', 'residual_image')]
+    l1analysis.connect([(infosource, level1conest, [('contrasts', 'contrasts')]),
+                        (model, level1conest, model_outputs),
+                        (level1conest, datasink, [('spm_mat_file', label + '.@spm_mat'),
+                                                  ('spmT_images', label + '.@T'),
+                                                  ('con_images', label + '.@con'),
+                                                  ('spmF_images', label + '.@F'),
+                                                  ('ess_images', label + '.@ess'),
+                                                  ]),
+                        (infosource, record, [('subject_id', 'subject_id')]),
+                        (model, record, model_outputs),
+                        (level1conest, record, [('con_images', 'con_images'),
+                                                ('spmT_images', 'spmT_images')]),
+                        ])
+
+
+def build_first_lv(subject_list, smoothed=True):
+    '''Build the 1st-level workflow iterating over every subject in subject_list'''
+    # 1) Unzip brain mask
+    mask_gunzip = Node(Gunzip(), name="mask_gunzip", iterfield=['in_file'])
+
+    # 2) Unzip functional images and drop dummy scans via the shared run cache
+    #    (see run_cache.py), so both first-level pipelines reuse the same files
+    extract = MapNode(Function(input_names=['in_file', 't_min', 't_size', 'code_dir'],
+                               output_names=['roi_file'],
+                               function=trim_run),
+                      iterfield=["in_file"],
+                      name="Remove_Dummies",
+                      mem_gb=node_mem_gb['Remove_Dummies'])
+    extract.inputs.t_min = t_min
+    extract.inputs.t_size = t_size
+    extract.inputs.code_dir = code_dir
+
+    # 3) Smooth: spm_smooth's kernel in float32 without MATLAB (smoothing.py),
+    #    writing s-prefixed runs like spm.Smooth
+    smooth = Node(Function(input_names=['in_files', 'fwhm', 'code_dir'],
+                           output_names=['smoothed_files'],
+                           function=smooth_runs),
+                  name="smooth", mem_gb=node_mem_gb['smooth'])
+    smooth.inputs.fwhm = fwhm
+    smooth.inputs.code_dir = code_dir
+
+    # 4) SpecifyModel - Generates SPM-specific Model
+    modelspec = Node(SpecifySPMModel(concatenate_runs=False,
+                                     input_units='secs',
+                                     output_units='secs',
+                                     time_repetition=TR,
+                                     high_pass_filter_cutoff=hpf),
+                     name="modelspec")
+
+    # 5) Level1Design - Generates an SPM design matrix
+    level1design = Node(Level1Design(bases=bases,
+                                     timing_units='secs',
+                                     interscan_interval=TR,
+                                     model_serial_correlations=serial_correlations),
+                        name="level1design", mem_gb=node_mem_gb['level1design'])
+
+    # 6) EstimateModel - estimate the parameters of the model
+    level1estimate = Node(EstimateModel(estimation_method={'Classical': 1}),
+                          name="level1estimate", mem_gb=node_mem_gb['level1estimate'])
+
+    getsubjectinfo = Node(Function(input_names=['subject_id', 'bids_dir', 'code_dir'],
+                                   output_names=['subject_info'],
+                                   function=get_subject_info),
+                          name='getsubjectinfo')
+    getsubjectinfo.inputs.bids_dir = experiment_dir
+    getsubjectinfo.inputs.code_dir = code_dir
+
+    # Infosource - a function free node to iterate over the list of subject names
+    infosource = Node(IdentityInterface(fields=['subject_id','contrasts'],
+                                        contrasts=contrast_list),
+                      name="infosource")
+    infosource.iterables = [('subject_id', subject_list)]
+
+    # SelectFiles - to grab the data (alternativ to DataGrabber)
+    templates = {'func': 'derivatives/fmriprep/{subject_id}/func/{subject_id}_task-vignette_run-*_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz',
+                'mask': 'derivatives/fmriprep/{subject_id}/anat/{subject_id}_space-MNI152NLin2009cAsym_desc-brain_mask.nii.gz'}
+    selectfiles = Node(SelectFiles(templates,
+                                   base_directory=experiment_dir,
+                                   sort_filelist=True),
+                       name="selectfiles")
+
+    # Initiation of the 1st-level analysis workflow
+    l1analysis = Workflow(name='1st_lv_workflow_smoothed' if smoothed else '1st_lv_workflow')
+    l1analysis.base_dir = opj(experiment_dir, working_dir)
+
+    if smoothed:
+        preproc = [(extract, smooth, [('roi_file', 'in_files')]),
+                   (smooth, modelspec, [('smoothed_files', 'functional_runs')])]
+    else:
+        preproc = [(extract, modelspec, [('roi_file', 'functional_runs')])]
+
+    # Connect up the 1st-level analysis components
+    l1analysis.connect([(infosource, selectfiles, [('subject_id', 'subject_id')]),
+                        (infosource, getsubjectinfo, [('subject_id',
+                                                       'subject_id')]),
+                        (getsubjectinfo, modelspec, [('subject_info',
+                                                      'subject_info')]),
+                        (selectfiles, extract, [('func', 'in_file')]),
+                        (selectfiles, mask_gunzip, [('mask', 'in_file')])] +
+                       preproc +
+                       [(modelspec, level1design, [('session_info',
+                                                    'session_info')]),
+                        (mask_gunzip, level1design, [('out_file',
+                                                    'mask_image')]),
+                        (level1design, level1estimate, [('spm_mat_file',
+                                                         'spm_mat_file')]),
+                        ])
+
+    # 7) Contrasts, datasink and provenance manifest
+    add_contrast_stage(l1analysis, infosource, level1estimate, smoothed)
+
+    l1analysis.config["execution"]["crashfile_format"] = "txt"
+    return l1analysis
+
+
+def build_contrast_only(subject_list, smoothed=True):
+    '''Re-estimate contrast_list on each subject's stored SPM.mat and betas'''
+    infosource = Node(IdentityInterface(fields=['subject_id','contrasts'],
+                                        contrasts=contrast_list),
+                      name="infosource")
+    infosource.iterables = [('subject_id', subject_list)]
+
+    model = Node(Function(input_names=['subject_id', 'smoothed', 'code_dir'],
+                          output_names=['spm_mat_file', 'beta_images', 'residual_image'],
+                          function=estimated_model),
+                 name='estimated_model')
+    model.inputs.smoothed = smoothed
+    model.inputs.code_dir = code_dir
+
+    l1contrasts = Workflow(name=('1st_lv_contrasts_smoothed' if smoothed else '1st_lv_contrasts'))
+    l1contrasts.base_dir = opj(experiment_dir, working_dir)
+    l1contrasts.connect([(infosource, model, [('subject_id', 'subject_id')])])
+    add_contrast_stage(l1contrasts, infosource, model, smoothed)
+
+    l1contrasts.config["execution"]["crashfile_format"] = "txt"
+    return l1contrasts
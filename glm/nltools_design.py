@@ -0,0 +1,216 @@
+# Vectorized design matrices for nltools_ratings_glm.py
+#
+# The original path built each run with two onsets_to_dm calls, recovered the
+# rating per TR with idxmax, multiplied every condition column by it in a
+# Python loop and then grew the matrix through repeated Design_Matrix.append
+# copies (convolve, DCT, polynomials, motion, spikes). Here the rating-modulated
+# boxcars, HRF convolution, DCT/Legendre drifts and the 24 motion regressors of
+# every run are written into one preallocated (n_runs, n_tr, n_columns) array;
+# only the data-dependent spike columns are attached per run at fit time.
+#
+# Columns: <cond>_c0 for each condition present in the run (in the order of
+# `conditions`), cosine_1..k, poly_0, poly_1, the 24 motion regressors and the
+# spikes. Condition columns missing from a run are dropped, as before.
+
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+from scipy.special import legendre
+from nltools.external.hrf import glover_hrf
+from nltools.stats import make_cosine_basis
+
+tr = 0.72
+n_tr = 668
+hpf = 90
+onset_shift = 5.76
+trial_duration = 7.92
+
+conditions = ['carem', 'carep', 'fair', 'lib', 'loy', 'auth', 'pur', 'socn']
+motion_params = ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']
+
+
+def run_events(onsets, ratings):
+    '''Trials with a moral decision: onset (s, shifted), duration, trial_type, rating'''
+    onsets = onsets[['onset', 'duration', 'trial_type']].copy()
+    onsets['onset'] = onsets['onset'] - onset_shift
+    onsets['duration'] = trial_duration
+    onsets = onsets.join(ratings[['moral_decision']]).dropna(subset=['moral_decision'])
+    onsets['rating'] = onsets['moral_decision'].astype(int)
+    return onsets[['onset', 'duration', 'trial_type', 'rating']]
+
+
+def load_run_events(onset_path, beh_path):
+    '''run_events from the BIDS events and behavioral TSVs'''
+    return run_events(pd.read_csv(onset_path, sep='\t', usecols=['onset', 'duration', 'trial_type']),
+                      pd.read_csv(beh_path, sep='\t', usecols=['moral_decision']))
+
+
+def run_motion(confounds, t_min=11, t_size=n_tr):
+    '''(t_size, 6) realignment parameters with dummy scans dropped'''
+    return confounds[motion_params].values[t_min:t_min + t_size]
+
+
+def load_run_motion(cov_path, t_min=11, t_size=n_tr):
+    '''run_motion from the fMRIPrep confounds TSV'''
+    return run_motion(pd.read_csv(cov_path, sep='\t', usecols=motion_params), t_min, t_size)
+
+
+def drift_basis(n_tr=n_tr, tr=tr, hpf=hpf):
+    '''DCT high-pass set plus constant and linear Legendre terms, as add_dct_basis + add_poly'''
+    dct = make_cosine_basis(n_tr, tr, hpf)
+    x = np.linspace(-1, 1, n_tr)
+    names = ['cosine_' + str(i + 1) for i in range(dct.shape[1])] + ['poly_0', 'poly_1']
+    return np.column_stack([dct, legendre(0)(x), legendre(1)(x)]), names
+
+
+def build_designs(events, motion, n_tr=n_tr, tr=tr, hpf=hpf, conditions=conditions,
+                  dtype=np.float64):
+    '''Rating-modulated design for every run of a subject in one array
+
+    Args:
+        events: list of per-run trial tables from load_run_events
+        motion: list of per-run (n_tr, 6) realignment parameters
+        dtype: np.float64 (matches the original path) or np.float32
+
+    Returns:
+        X: (n_runs, n_tr, n_columns) array
+        columns: column names of X
+        present: (n_runs, len(conditions)) bool, conditions with trials in each run
+
+    A TR covered by two trials of the same condition takes the later trial's
+    rating; the original idxmax lookup shared one rating across all columns in
+    such TRs.
+    '''
+    n_runs, n_cond = len(events), len(conditions)
+    drift, drift_names = drift_basis(n_tr, tr, hpf)
+    n_drift = drift.shape[1]
+    columns = [c + '_c0' for c in conditions] + drift_names + \
+        list(motion_params) + [p + '_sq' for p in motion_params] + \
+        [p + '_diff' for p in motion_params] + [p + '_diff_sq' for p in motion_params]
+    X = np.zeros((n_runs, n_tr, len(columns)), dtype=dtype)
+
+    # 1) Boxcars scaled by rating, all runs and trials at once
+    ev = pd.concat(events, keys=range(n_runs), names=['run']).reset_index(level='run')
+    ev = ev[ev['trial_type'].isin(conditions)].sort_values(['run', 'onset'], kind='stable')
+    on = np.floor(ev['onset'].values / tr).astype(int)
+    off_trs = (ev['onset'].values + ev['duration'].values) / tr
+    off = np.where(off_trs > np.floor(off_trs), np.floor(off_trs), np.floor(off_trs) - 1).astype(int)
+    on, off = np.clip(on, 0, n_tr - 1), np.clip(off, -1, n_tr - 1)
+    lengths = np.maximum(off - on + 1, 0)
+    rows = np.repeat(on, lengths) + np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    cond_idx = pd.Categorical(ev['trial_type'], categories=conditions).codes
+    X[np.repeat(ev['run'].values, lengths), rows, np.repeat(cond_idx, lengths)] = \
+        np.repeat(ev['rating'].values, lengths)
+
+    present = np.zeros((n_runs, n_cond), dtype=bool)
+    present[ev['run'].values, cond_idx] = True
+
+    # 2) Glover HRF, truncated to the run like Design_Matrix.convolve
+    X[:, :, :n_cond] = lfilter(glover_hrf(tr, oversampling=1), [1.], X[:, :, :n_cond], axis=1)
+
+    # 3) Drifts are shared by every run
+    X[:, :, n_cond:n_cond + n_drift] = drift
+
+    # 4) Motion: z-score (ddof=1), squares, backward differences, squared differences
+    mc = np.stack(motion).astype(np.float64)
+    z = (mc - mc.mean(axis=1, keepdims=True)) / mc.std(axis=1, ddof=1, keepdims=True)
+    dz = np.zeros_like(z)
+    dz[:, 1:] = np.diff(z, axis=1)
+    X[:, :, n_cond + n_drift:] = np.concatenate([z, z**2, dz, dz**2], axis=2)
+    return X, columns, present
+
+
+def run_design(X, columns, present, run, spikes=None):
+    '''Design of one run as a DataFrame: present conditions, drifts, motion, spikes'''
+    n_cond = present.shape[1]
+    keep = np.concatenate([present[run], np.ones(len(columns) - n_cond, dtype=bool)])
+    dm = pd.DataFrame(X[run][:, keep], columns=[c for c, k in zip(columns, keep) if k])
+    if spikes is not None and spikes.shape[1]:
+        dm = pd.concat([dm, pd.DataFrame(np.asarray(spikes, dtype=X.dtype),
+                                         columns=list(spikes.columns))], axis=1)
+    return dm
+
+
+def legacy_design(events, motion, spikes=None, n_tr=n_tr, tr=tr):
+    '''The original onsets_to_dm / idxmax / Design_Matrix.append construction of one run'''
+    from nltools.file_reader import onsets_to_dm
+    from nltools.data import Design_Matrix
+    from nltools.stats import zscore
+
+    onsets = events[['onset', 'duration', 'trial_type']]
+    onsets.columns = ['Onset', 'Duration', 'Stim']
+    ratings = events[['onset', 'duration', 'rating']].copy()
+    ratings['rating'] = ratings['rating'].astype(str)
+    ratings.columns = ['Onset', 'Duration', 'Stim']
+    dm = onsets_to_dm(onsets, sampling_freq=1. / tr, run_length=n_tr)
+    md = onsets_to_dm(ratings, sampling_freq=1. / tr, run_length=n_tr)
+
+    md['moral_rating'] = md.idxmax(axis=1)
+    dm['moral_rating'] = md['moral_rating'].astype(int)
+    for c in dm.columns:
+        if c != 'moral_rating':
+            dm[c] = dm[c] * dm['moral_rating']
+    del dm['moral_rating']
+
+    z_mc = zscore(pd.DataFrame(motion, columns=motion_params))
+    all_mc = pd.concat([z_mc, z_mc**2, z_mc.diff(), z_mc.diff()**2], axis=1)
+    all_mc.fillna(value=0, inplace=True)
+    mc_cov = Design_Matrix(all_mc, sampling_freq=1 / tr)
+
+    dm_cov = dm.convolve().add_dct_basis(duration=hpf).add_poly(order=1, include_lower=True)
+    dm_cov = dm_cov.append(mc_cov, axis=1)
+    if spikes is not None:
+        dm_cov = dm_cov.append(Design_Matrix(spikes, sampling_freq=1 / tr), axis=1)
+    return dm_cov
+
+
+def synthetic_run(seed, n_trials=32, n_tr=n_tr, tr=tr):
+    '''Non-overlapping trials over the eight conditions plus random-walk motion'''
+    rng = np.random.default_rng(seed)
+    onsets = 4 * tr + np.arange(n_trials) * (n_tr - 20) * tr / n_trials
+    events = pd.DataFrame({'onset': onsets,
+                           'duration': trial_duration,
+                           'trial_type': rng.permutation(np.repeat(conditions, n_trials // len(conditions))),
+                           'rating': rng.integers(1, 5, n_trials)})
+    motion = np.cumsum(rng.normal(scale=0.01, size=(n_tr, len(motion_params))), axis=0)
+    return events, motion
+
+
+def benchmark(n_runs=3, repeats=5, dtype=np.float64):
+    '''Seconds per subject for the vectorized and original builders, and their max difference'''
+    runs = [synthetic_run(seed) for seed in range(n_runs)]
+    events, motion = [r[0] for r in runs], [r[1] for r in runs]
+
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        legacy = [legacy_design(e, m) for e, m in runs]
+    t_legacy = (time.perf_counter() - t0) / repeats
+
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        X, columns, present = build_designs(events, motion, dtype=dtype)
+        designs = [run_design(X, columns, present, r) for r in range(n_runs)]
+    t_vector = (time.perf_counter() - t0) / repeats
+
+    # Motion columns are named differently; compare by position within each block
+    max_diff = 0.
+    for old, new in zip(legacy, designs):
+        task = [c for c in new.columns if c.endswith('_c0')]
+        diff = np.abs(old[task].values - new[task].values).max()
+        diff = max(diff, np.abs(old.values[:, len(task):] - new.values[:, len(task):]).max())
+        max_diff = max(max_diff, diff)
+    return pd.Series({'runs': n_runs, 'legacy_s': t_legacy, 'vectorized_s': t_vector,
+                      'speedup': t_legacy / t_vector, 'max_abs_diff': max_diff})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the vectorized ratings design builder')
+    parser.add_argument('-n_runs', type=int, default=3)
+    parser.add_argument('-repeats', type=int, default=5)
+    parser.add_argument('-float32', action='store_true')
+    args = parser.parse_args()
+
+    print(benchmark(n_runs=args.n_runs, repeats=args.repeats,
+                    dtype=np.float32 if args.float32 else np.float64))
@@ -13,19 +13,12 @@ from nltools.mask import expand_mask, roi_to_brain
 from nltools.utils import concatenate
 import argparse
 from itertools import combinations
-import time, random
-
-time.sleep(random.randint(5, 20))
-
-bids_dir = '/srv/lab/fmri/mft/fhopp_diss/bids'
-deriv_dir = '/srv/lab/fmri/mft/fhopp_diss/bids/derivatives/fmriprep'
-output_dir = '/srv/lab/fmri/mft/fhopp_diss/analysis/vignettes/mvpa/betas/test/'
-
-parser = argparse.ArgumentParser()
-parser.add_argument('-subject', type=str, required=True, dest='subject')
-
-args = parser.parse_args()
-subject = 'sub-' + args.subject
+from run_cache import cached_trimmed_run
+from stream_glm import StreamedRun, peak_rss_gb
+from smoothing import smooth_brain_data
+from nltools_design import run_events, run_motion, build_designs, run_design
+from bids_index import subject_runs, run_table, event_columns, beh_columns, confound_columns
+from tracing import stage, start_trace
 
 bids_dir = '/srv/lab/fmri/mft/fhopp_diss/bids'
 deriv_dir = '/srv/lab/fmri/mft/fhopp_diss/bids/derivatives/fmriprep'
@@ -35,11 +28,6 @@ tr = 0.72
 fwhm = 6
 spike_cutoff = 3
 
-nifti_paths = sorted([x for x in glob.glob(os.path.join(deriv_dir, '*/func/*preproc*gz')) if 'vignette' in x and subject in x] )
-onset_paths = sorted([x for x in glob.glob(os.path.join(bids_dir, '*/func/*events*tsv')) if 'vignette' in x and subject in x] )
-cov_paths = sorted([x for x in glob.glob(os.path.join(deriv_dir, '*/func/*confounds*tsv')) if 'vignette' in x and subject in x] )
-beh_paths = sorted([x for x in glob.glob(os.path.join(bids_dir, '*/beh/*tsv')) if 'vignette' in x and subject in x] )
-
 conds = {'carem':'Care Emotional',
              'carep':'Care Physical',
              'fair':'Fairness',
@@ -49,64 +37,78 @@ conds = {'carem':'Care Emotional',
              'pur':'Purity',
              'socn':'Social'}
 
-def load_bids_events(onset_path, beh_path):
-    '''Create a design_matrix instance from BIDS event file'''
-    
-    tr = 0.72
-    n_tr = 668
-    
-    onsets = pd.read_csv(onset_path, sep='\t',usecols=['onset','duration','trial_type', 'stim_file'])
-    onsets['onset'] = onsets['onset'] - 5.76
-    onsets['duration'] = 7.92
-    
-    ratings = pd.read_csv(beh_path, sep='\t',usecols=['moral_decision'])
-    onsets = onsets.join(ratings)
-    onsets = onsets.dropna(subset=['moral_decision'])
-    ratings = onsets.copy(deep=True)
-    ratings['trial_type'] = ratings['moral_decision'].astype(int).astype(str)
-    ratings = ratings[['onset','duration','trial_type']]
-    ratings.columns = ['Onset', 'Duration', 'Stim']
-    
-    onsets = onsets[['onset','duration','trial_type']]
-    onsets.columns = ['Onset', 'Duration', 'Stim']
-    
-    return onsets_to_dm(onsets, sampling_freq=1./tr, run_length=n_tr), onsets_to_dm(ratings, sampling_freq=1./tr, run_length=n_tr)
+def run_subject(subject, stream=False, max_rss_gb=None, scratch_dir=None, bids_dir=bids_dir, output_dir=output_dir):
+    '''Fit the rating-modulated GLM for every run of one subject and write z-scored betas
+
+    With stream=True runs are smoothed and regressed in bounded chunks from a
+    memory-mapped copy (see stream_glm.py); max_rss_gb aborts the subject once
+    peak RSS passes the ceiling. Stages are traced when MFT_TRACE is set
+    (profiling/instrument.py).
+    '''
+    # Runs, events, ratings and confounds from the BIDS index (bids_index.py);
+    # every run needs its behaviour file for the rating modulation
+    runs = subject_runs(subject, bids_dir, require=['beh'])
+    nifti_paths = list(runs['bold'])
+
+    # Task (rating-modulated, convolved), drift and motion regressors for all
+    # runs at once; spikes are added per run once the data is smoothed
+    with stage('design build', subject=subject):
+        events = [run_events(run_table(row, event_columns), run_table(row, beh_columns))
+                  for _, row in runs.iterrows()]
+        motion = [run_motion(run_table(row, confound_columns)) for _, row in runs.iterrows()]
+        X, columns, present = build_designs(events, motion)
+
+    for r, nifti_path in enumerate(nifti_paths):
+        run = nifti_path.split('_')[3]
+        print("Loading Run: ", run)
+        # Dummy scans ([11:-11]) are dropped once in the shared run cache
+        run_file = cached_trimmed_run(nifti_path, t_min=11, t_size=668)
+        with stage('smoothing', subject=subject, run=run):
+            if stream:
+                data = StreamedRun(run_file, fwhm, scratch_dir=scratch_dir, max_rss_gb=max_rss_gb)
+            else:
+                # Brain_Data.smooth(fwhm) in float32, in place (smoothing.py)
+                data = smooth_brain_data(Brain_Data(run_file), fwhm)
+
+        spikes = data.find_spikes(global_spike_cutoff=spike_cutoff, diff_spike_cutoff=spike_cutoff)
+        dm_cov = run_design(X, columns, present, r, spikes=spikes.iloc[:, 1:])
+
+        if stream:
+            beta_columns, out_files = [], []
+            for cond, name in conds.items():
+                for col in dm_cov.columns:
+                    if col.startswith(cond):
+                        beta_columns.append(col)
+                        out_files.append(output_dir + f"{subject}_{name}_{run}.nii.gz")
+            data.regress_zscored_betas(dm_cov, beta_columns, out_files, tags={'subject': subject, 'run': run})
+            data.close()
+            print("Peak RSS (GB): ", round(peak_rss_gb(), 2))
+            continue
+
+        data.X = Design_Matrix(dm_cov, sampling_freq=1./tr)
+        with stage('regression', subject=subject, run=run):
+            stats = data.regress()
 
-def make_motion_covariates(mc):
-    z_mc = zscore(mc)
-    all_mc = pd.concat([z_mc, z_mc**2, z_mc.diff(), z_mc.diff()**2], axis=1)
-    all_mc.fillna(value=0, inplace=True)
-    return Design_Matrix(all_mc, sampling_freq=1/tr)
+        with stage('beta write', subject=subject, run=run):
+            for cond, name in conds.items():
+                for i, col in enumerate(data.X.columns):
+                    if col.startswith(cond):
+                        stats['beta'][i].standardize(axis=0, method='zscore').write(output_dir + f"{subject}_{name}_{run}.nii.gz")
 
-# brain_data = {}
-# Construct DMs, Convolve with HRF, Add DCT Basis, and Poly drifts
-all_runs = Design_Matrix(sampling_freq = 1./tr)
 
-for nifti_path, onset_path, cov_path, beh_path in zip(nifti_paths, onset_paths, cov_paths, beh_paths):
-    
-     # 1) Load in onsets for this run
-    dm, md = load_bids_events(onset_path, beh_path)
-    md['moral_rating'] = md.idxmax(axis=1)
-    dm['moral_rating'] = md['moral_rating'].astype(int)
-    for c in dm.columns:
-        if c != 'moral_rating':
-            dm[c] = dm[c] * dm['moral_rating']
-    del dm['moral_rating']
-    
-    run = nifti_path.split('_')[3]
-    print("Loading Run: ", run)
-    data = Brain_Data(nifti_path)[11:-11].smooth(fwhm=fwhm)
-   
-    # 3) Load in covariates for this run
-    covariates = pd.read_csv(cov_path, sep='\t')[11:-11].reset_index(drop=True)
-    mc_cov = make_motion_covariates(covariates[['trans_x','trans_y','trans_z','rot_x', 'rot_y', 'rot_z']])
-    spikes = data.find_spikes(global_spike_cutoff=spike_cutoff, diff_spike_cutoff=spike_cutoff)
-    dm_cov = dm.convolve().add_dct_basis(duration=90).add_poly(order=1, include_lower=True)
-    dm_cov = dm_cov.append(mc_cov, axis=1).append(Design_Matrix(spikes.iloc[:, 1:], sampling_freq=1/tr), axis=1)
-    data.X = dm_cov
-    stats = data.regress()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-subject', type=str, required=True, dest='subject')
+    parser.add_argument('-stream', action='store_true',
+                        help='smooth and regress in bounded chunks from a memory-mapped run')
+    parser.add_argument('-max_rss_gb', type=float, default=None,
+                        help='abort if peak RSS exceeds this many GB (streaming mode)')
+    parser.add_argument('-scratch_dir', type=str, default=None)
+    parser.add_argument('-trace', type=str, default=None,
+                        help='append per-stage wall/CPU time, peak RSS and I/O to this .jsonl')
 
-    for cond, name in conds.items():
-        for i, col in enumerate(data.X.columns):
-            if col.startswith(cond):
-                stats['beta'][i].standardize(axis=0, method='zscore').write(output_dir + f"{subject}_{name}_{run}.nii.gz")
\ No newline at end of file
+    args = parser.parse_args()
+    if args.trace:
+        start_trace(args.trace)
+    run_subject('sub-' + args.subject, stream=args.stream, max_rss_gb=args.max_rss_gb,
+                scratch_dir=args.scratch_dir)
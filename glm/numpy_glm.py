@@ -0,0 +1,509 @@
+# First-level GLM in NumPy (alternative to the SPM12 path)
+#
+# Rebuilds the design that first_lv_workflow.py hands to SPM (trial_type
+# boxcars from get_subject_info, canonical HRF + temporal derivative
+# orthogonalised per condition as spm_fMRI_design does, the 12
+# fMRIPrep nuisance regressors, 90 s DCT high-pass, session constants), follows
+# spm_spm's two passes (ReML estimate of the AR(0.2) non-sphericity from
+# voxels passing an F-test on the effects of interest, then a prewhitened fit),
+# and writes con_*.nii / spmT_*.nii for every contrast in contrast_list.
+# Voxels are fit in z-slab blocks straight from the uncompressed runs in the
+# run cache, smoothed with SPM's kernel (smoothing.py) like the smoothed SPM
+# pipeline or left unsmoothed like the unsmoothed one; a comparison with SPM
+# outputs fits the inputs that SPM directory was produced from.
+
+import os
+import time
+import argparse
+import numpy as np
+import nibabel as nib
+from scipy import stats, linalg
+from first_lv_workflow import TR, contrast_list, get_subject_info, output_dir, find_subjects, \
+    experiment_dir, code_dir, fwhm, t_min, t_size
+from run_cache import cached_trimmed_run, cached_smoothed_run
+from tracing import stage, start_trace
+
+# SPM12 defaults (spm_defaults.m / Level1Design in first_lv_workflow.py)
+fmri_t = 16       # microtime resolution
+fmri_t0 = 8       # microtime onset
+hpf = 90          # high-pass cutoff (secs)
+ar_a = 0.2        # AR(1) expansion point for the non-sphericity components
+uf_p = 0.001      # F-test threshold selecting voxels for ReML
+global_scale = 100
+
+
+def numpy_dir(smoothed=True):
+    return os.path.join(output_dir, '1st_lv_numpy_smoothed_avgcond' if smoothed else '1st_lv_numpy_unsmoothed_avgcond')
+
+
+def _round(x):
+    '''MATLAB-style round (halves away from zero)'''
+    x = np.asarray(x, dtype=float)
+    return (np.sign(x) * np.floor(np.abs(x) + 0.5)).astype(int)
+
+
+def spm_hrf(rt, p=None, fmri_t=fmri_t):
+    '''Canonical HRF sampled every rt seconds, as spm_hrf.m'''
+    params = np.array([6, 16, 1, 1, 6, 0, 32], dtype=float)
+    if p is not None:
+        params[:len(p)] = p
+    dt = rt / fmri_t
+    u = np.arange(0, np.ceil(params[6] / dt) + 1) - params[5] / dt
+    hrf = stats.gamma.pdf(u, params[0] / params[2], scale=params[2] / dt) - \
+        stats.gamma.pdf(u, params[1] / params[3], scale=params[3] / dt) / params[4]
+    hrf = hrf[(np.arange(0, np.floor(params[6] / rt) + 1) * fmri_t).astype(int)]
+    return hrf / hrf.sum()
+
+
+def hrf_basis(rt=TR):
+    '''Canonical HRF and temporal derivative at microtime resolution, as spm_get_bf.m'''
+    dt = rt / fmri_t
+    bf = spm_hrf(dt)
+    deriv = bf - spm_hrf(dt, p=[6, 16, 1, 1, 6, 1, 32])
+    # spm_orth: the derivative is orthogonalised with respect to the HRF
+    deriv = deriv - bf * (bf @ deriv) / (bf @ bf)
+    return np.column_stack([bf, deriv])
+
+
+def orthogonalise(columns):
+    '''Sequential Gram-Schmidt of one condition's sampled regressors, as spm_orth.m
+
+    The first column is kept; each later one has its projection onto the
+    preceding (already orthogonalised) columns removed, without mean removal.
+    '''
+    out = []
+    for x in columns:
+        x = np.asarray(x, dtype=float)
+        if out:
+            X = np.column_stack(out)
+            x = x - X @ (linalg.pinv(X) @ x)
+        out.append(x)
+    return out
+
+
+def session_design(run_info, n_scans, rt=TR):
+    '''Convolved condition regressors and nuisance regressors for one session'''
+    dt = rt / fmri_t
+    n_micro = n_scans * fmri_t + 128
+    bf = hrf_basis(rt)
+
+    columns, names = [], []
+    for cond, onsets, durations in zip(run_info.conditions, run_info.onsets, run_info.durations):
+        # Boxcar stimulus function with SPM's 32-bin offset (spm_get_ons.m)
+        # Offsets come from the unclamped onsets; both are clamped afterwards
+        sf = np.zeros(n_micro)
+        ton = _round(np.asarray(onsets) / dt) + 32
+        tof = _round(np.asarray(durations) / dt) + ton
+        ton, tof = np.maximum(ton, 0), np.maximum(tof, 0)
+        np.add.at(sf, ton[ton < n_micro], 1)
+        np.add.at(sf, tof[tof < n_micro], -1)
+        sf = np.cumsum(sf)[:n_scans * fmri_t + 32]
+
+        sampled = []
+        for b in range(bf.shape[1]):
+            x = np.convolve(sf, bf[:, b])[:len(sf)]
+            sampled.append(x[np.arange(n_scans) * fmri_t + fmri_t0 + 31])
+            names.append('{}*bf({})'.format(cond, b + 1))
+        columns += orthogonalise(sampled)
+
+    for name, regressor in zip(run_info.regressor_names, run_info.regressors):
+        columns.append(np.asarray(regressor, dtype=float))
+        names.append(name)
+
+    return np.column_stack(columns), names
+
+
+def build_design(subject_info, n_scans, rt=TR):
+    '''Block-diagonal design over sessions with session constants last, as SPM.xX.X'''
+    blocks, names = [], []
+    for s, (run_info, k) in enumerate(zip(subject_info, n_scans)):
+        x, session_names = session_design(run_info, k, rt=rt)
+        blocks.append(x)
+        names += ['Sn({}) {}'.format(s + 1, n) for n in session_names]
+    constants = linalg.block_diag(*[np.ones((k, 1)) for k in n_scans])
+    names += ['Sn({}) constant'.format(s + 1) for s in range(len(n_scans))]
+    return np.hstack([linalg.block_diag(*blocks), constants]), names
+
+
+def dct_basis(k, rt=TR, cutoff=hpf):
+    '''High-pass confounds for a session of k scans (spm_dctmtx without the constant)'''
+    n = int(np.fix(2 * (k * rt) / cutoff + 1))
+    t = np.arange(k)[:, None]
+    return np.sqrt(2. / k) * np.cos(np.pi * (2 * t + 1) * np.arange(1, n)[None, :] / (2 * k))
+
+
+def filter_matrix(k, rt=TR, cutoff=hpf):
+    '''Residual-forming matrix of the DCT high-pass filter for one session'''
+    x0 = dct_basis(k, rt, cutoff)
+    return np.eye(k) - x0 @ x0.T
+
+
+def contrast_matrix(names, contrasts=contrast_list):
+    '''Weights over design columns, applying each condition weight to its bf(1) column in every session
+
+    Mirrors the T-contrast vectors nipype's EstimateContrast builds from SPM.xX.name.
+    '''
+    columns = [n.split(' ', 1)[1] for n in names]
+    C = np.zeros((len(names), len(contrasts)))
+    for i, (name, stat, conditions, weights) in enumerate(contrasts):
+        if stat != 'T':
+            raise ValueError('Only T contrasts are supported: {}'.format(name))
+        for cond, weight in zip(conditions, weights):
+            idx = [j for j, c in enumerate(columns) if c == cond + '*bf(1)']
+            if not idx:
+                raise ValueError('Contrast {} references unknown condition {}'.format(name, cond))
+            C[idx, i] = weight
+    return C
+
+
+def _ar_components(k, a=ar_a):
+    '''Non-sphericity components of one session, as spm_Ce(k, a)'''
+    def ar_corr(a):
+        # spm_Q: unit-diagonal AR(1) autocorrelation matrix
+        lag = np.subtract.outer(np.arange(k), np.arange(k))
+        K = np.where(lag >= 0, a ** np.abs(lag), 0)
+        K = K * (np.abs(K) > 1e-4)
+        Q = K @ K.T
+        Q = Q * (np.abs(Q) > 1e-4)
+        d = 1 / np.sqrt(np.diag(Q))
+        return Q * np.outer(d, d)
+
+    da = np.exp(-8)
+    dQda = (ar_corr(a + da) - ar_corr(a)) / da
+    Q = ar_corr(a)
+    return [Q - dQda * a, dQda * a]
+
+
+def reml(Cy, X, Q, n_iter=32):
+    '''ReML hyperparameters of Cy = sum(h[i] * Q[i]) given confounds X (cf. spm_reml.m)'''
+    X = linalg.orth(X)
+    n = Cy.shape[0]
+    h = np.array([float(np.any(np.diag(q))) for q in Q])
+    for _ in range(n_iter):
+        C = sum(hi * qi for hi, qi in zip(h, Q))
+        iC = linalg.inv(C)
+        iCX = iC @ X
+        Cq = linalg.inv(X.T @ iCX)
+        P = iC - iCX @ Cq @ iCX.T
+        U = np.eye(n) - P @ Cy
+        PQ = [P @ q for q in Q]
+        dFdh = np.array([-np.sum(pq.T * U) / 2 for pq in PQ])
+        dFdhh = np.array([[-np.sum(pi.T * pj) / 2 for pj in PQ] for pi in PQ])
+        dh = -linalg.solve(dFdhh, dFdh)
+
+        # Fisher scoring, halving steps that leave the covariance indefinite
+        step = 1.
+        while np.linalg.eigvalsh(sum((hi + step * di) * qi for hi, di, qi in zip(h, dh, Q)))[0] <= 0:
+            step /= 2
+        h = h + step * dh
+        if dFdh @ dh < 1e-2:
+            break
+    return sum(hi * qi for hi, qi in zip(h, Q)), h
+
+
+def _sqrtm_inv(V):
+    '''Whitening matrix inv(V)^(1/2) of a symmetric positive definite V'''
+    w, U = np.linalg.eigh(V)
+    W = (U / np.sqrt(w)) @ U.T
+    return W * (np.abs(W) > 1e-6)
+
+
+def global_scale_factors(imgs, block=32):
+    '''Session-specific grand mean scaling (spm_global + spm_fmri_spm_ui)'''
+    gsf = []
+    for img in imgs:
+        g = []
+        for t0 in range(0, img.shape[3], block):
+            vols = np.asarray(img.dataobj[..., t0:t0 + block], dtype=np.float64)
+            vols = vols.reshape(-1, vols.shape[-1])
+            means = vols.mean(0)
+            g += [v[v > m / 8].mean() for v, m in zip(vols.T, means)]
+        gsf.append(global_scale / np.mean(g))
+    return gsf
+
+
+def iter_chunks(imgs, mask, gsf, max_voxels=20000):
+    '''Yield (slab, scaled time series) for z-slabs holding at most ~max_voxels in-mask voxels'''
+    per_slice = mask.reshape(-1, mask.shape[2]).sum(0)
+    z0 = 0
+    while z0 < mask.shape[2]:
+        z1, count = z0 + 1, per_slice[z0]
+        while z1 < mask.shape[2] and count + per_slice[z1] <= max_voxels:
+            count += per_slice[z1]
+            z1 += 1
+        m = mask[:, :, z0:z1]
+        if m.any():
+            Y = np.vstack([np.asarray(img.dataobj[:, :, z0:z1, :], dtype=np.float64)[m].T * g
+                           for img, g in zip(imgs, gsf)])
+            yield (z0, z1, m), Y
+        z0 = z1
+
+
+class NumpyGLM(object):
+    '''Two-pass SPM-style first-level estimation over voxel blocks'''
+
+    def __init__(self, functional_runs, subject_info, mask_file, contrasts=contrast_list,
+                 rt=TR, max_voxels=20000):
+        self.imgs = [nib.load(f, mmap=True) for f in functional_runs]
+        self.mask_img = nib.load(mask_file)
+        self.mask = np.asarray(self.mask_img.dataobj) > 0
+        if self.mask.shape != self.imgs[0].shape[:3]:
+            raise ValueError('Mask {} does not match the functional grid {}'.format(
+                self.mask.shape, self.imgs[0].shape[:3]))
+        self.n_scans = [img.shape[3] for img in self.imgs]
+        self.rows = np.split(np.arange(sum(self.n_scans)), np.cumsum(self.n_scans)[:-1])
+        self.X, self.names = build_design(subject_info, self.n_scans, rt=rt)
+        self.C = contrast_matrix(self.names, contrasts)
+        self.contrasts = contrasts
+        self.K = [filter_matrix(k, rt) for k in self.n_scans]
+        self.max_voxels = max_voxels
+        self.timings = {}
+
+    def _blockwise(self, mats, Y):
+        '''Apply one matrix per session to the session's rows of Y'''
+        return np.vstack([m @ Y[rows] for m, rows in zip(mats, self.rows)])
+
+    def estimate_nonsphericity(self):
+        '''Pass 1: pooled covariance of F-significant voxels and ReML whitening'''
+        KX = self._blockwise(self.K, self.X)
+        KX0 = self._blockwise(self.K, self.X[:, -len(self.n_scans):])
+        pKX, pKX0 = linalg.pinv(KX), linalg.pinv(KX0)
+        rank, rank0 = np.linalg.matrix_rank(KX), np.linalg.matrix_rank(KX0)
+        trRV, trMV = KX.shape[0] - rank, rank - rank0
+        UF = stats.f.ppf(1 - uf_p, trMV, trRV)
+
+        Cy = [np.zeros((k, k)) for k in self.n_scans]
+        n_selected = 0
+        for _, Y in iter_chunks(self.imgs, self.mask, self.gsf, self.max_voxels):
+            KY = self._blockwise(self.K, Y)
+            ResSS = np.sum((KY - KX @ (pKX @ KY)) ** 2, 0)
+            ESS = np.sum((KY - KX0 @ (pKX0 @ KY)) ** 2, 0) - ResSS
+            j = ESS / trMV > UF * ResSS / trRV
+            if j.any():
+                Yj = Y[:, j] * np.sqrt(trRV / ResSS[j])
+                for c, rows in zip(Cy, self.rows):
+                    c += Yj[rows] @ Yj[rows].T
+                n_selected += j.sum()
+        if not n_selected:
+            raise ValueError('There are no significant voxels to estimate the non-sphericity from')
+
+        V = []
+        for c, rows, K, k in zip(Cy, self.rows, self.K, self.n_scans):
+            x0 = np.hstack([self.X[rows], dct_basis(k)])
+            Vs, _ = reml(c / n_selected, x0, _ar_components(k))
+            V.append(Vs)
+        scale = sum(self.n_scans) / sum(np.trace(v) for v in V)
+        self.V = [v * scale for v in V]
+        self.W = [_sqrtm_inv(v) for v in self.V]
+        self.n_reml_voxels = n_selected
+
+    def fit(self):
+        '''Pass 2: prewhitened fit, contrasts and t statistics for every in-mask voxel'''
+        start = time.perf_counter()
+        self.gsf = global_scale_factors(self.imgs)
+        self.timings['global scaling'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        self.estimate_nonsphericity()
+        self.timings['non-sphericity'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        KW = [K @ W for K, W in zip(self.K, self.W)]
+        KWX = self._blockwise(KW, self.X)
+        pKX = linalg.pinv(KWX)
+        # Effective error covariance after whitening and filtering
+        KWVWK = linalg.block_diag(*[kw @ v @ kw.T for kw, v in zip(KW, self.V)])
+        RV = KWVWK - KWX @ (pKX @ KWVWK)
+        self.trRV = np.trace(RV)
+        self.erdf = self.trRV ** 2 / np.sum(RV * RV.T)
+        con_var = np.einsum('ij,ij->j', self.C, pKX @ KWVWK @ pKX.T @ self.C)
+
+        shape = self.mask.shape
+        self.con = np.full((self.C.shape[1],) + shape, np.nan, dtype=np.float32)
+        self.spmT = np.full((self.C.shape[1],) + shape, np.nan, dtype=np.float32)
+        for (z0, z1, m), Y in iter_chunks(self.imgs, self.mask, self.gsf, self.max_voxels):
+            KWY = self._blockwise(KW, Y)
+            beta = pKX @ KWY
+            ResMS = np.sum((KWY - KWX @ beta) ** 2, 0) / self.trRV
+            con = self.C.T @ beta
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = con / np.sqrt(ResMS[None, :] * con_var[:, None])
+            for i in range(self.C.shape[1]):
+                self.con[i, :, :, z0:z1][m] = con[i]
+                self.spmT[i, :, :, z0:z1][m] = t[i]
+        self.timings['estimation'] = time.perf_counter() - start
+        return self
+
+    def write(self, out_dir):
+        '''Write con_XXXX.nii and spmT_XXXX.nii numbered like EstimateContrast'''
+        start = time.perf_counter()
+        os.makedirs(out_dir, exist_ok=True)
+        affine = self.mask_img.affine
+        for i, contrast in enumerate(self.contrasts):
+            for prefix, maps in [('con', self.con), ('spmT', self.spmT)]:
+                img = nib.Nifti1Image(maps[i], affine)
+                img.header['descrip'] = '{}: {}'.format(prefix, contrast[0])
+                nib.save(img, os.path.join(out_dir, '{}_{:04d}.nii'.format(prefix, i + 1)))
+        self.timings['write'] = time.perf_counter() - start
+
+
+def mask_file(subject_id, bids_dir=experiment_dir):
+    return os.path.join(bids_dir, 'derivatives/fmriprep/{0}/anat/{0}_space-MNI152NLin2009cAsym_desc-brain_mask.nii.gz'.format(subject_id))
+
+
+def subject_inputs(subject_id, bids_dir=experiment_dir, smoothed=True):
+    '''Cached, dummy-trimmed (and SPM-smoothed) runs of a subject in index run order'''
+    from bids_index import subject_runs
+    func = subject_runs(subject_id, bids_dir)['bold']
+    if smoothed:
+        return [cached_smoothed_run(f, fwhm=fwhm, t_min=t_min, t_size=t_size) for f in func]
+    return [cached_trimmed_run(f, t_min=t_min, t_size=t_size) for f in func]
+
+
+def run_subject(subject_id, out_dir=None, functional_runs=None, max_voxels=20000, bids_dir=experiment_dir,
+                smoothed=True):
+    '''Fit and write one subject; returns per-stage wall times (secs)
+
+    functional_runs are fit as given (smoothed is then ignored and the run
+    cache is not touched); otherwise the subject's runs come from the run
+    cache, smoothed or not.
+    '''
+    start = time.perf_counter()
+    runs = functional_runs
+    if runs is None:
+        with stage('smoothing' if smoothed else 'trim', subject=subject_id):
+            runs = subject_inputs(subject_id, bids_dir, smoothed)
+    with stage('design build', subject=subject_id):
+        glm = NumpyGLM(runs, get_subject_info(subject_id, bids_dir, code_dir), mask_file(subject_id, bids_dir),
+                       max_voxels=max_voxels)
+    with stage('regression', subject=subject_id):
+        glm.fit()
+    with stage('beta write', subject=subject_id):
+        glm.write(out_dir or os.path.join(numpy_dir(smoothed), subject_id))
+    glm.timings['total'] = time.perf_counter() - start
+    return glm.timings
+
+
+def spm_smoothed(spm_dir):
+    '''Whether an SPM first-level directory holds the smoothed (True) or unsmoothed (False)
+    pipeline, from its pipeline label; None when the name does not tell'''
+    parts = os.path.normpath(spm_dir).split(os.sep)
+    if any('unsmoothed' in p for p in parts):
+        return False
+    if any('smoothed' in p for p in parts):
+        return True
+    return None
+
+
+def compare_with_spm(out_dir, spm_dir, n_contrasts=len(contrast_list)):
+    '''Voxelwise agreement of con/spmT images with a stored SPM first-level directory'''
+    import pandas as pd
+    rows = []
+    for i in range(1, n_contrasts + 1):
+        for prefix in ['con', 'spmT']:
+            fname = '{}_{:04d}.nii'.format(prefix, i)
+            ours = np.asarray(nib.load(os.path.join(out_dir, fname)).dataobj, dtype=np.float64)
+            spm = np.asarray(nib.load(os.path.join(spm_dir, fname)).dataobj, dtype=np.float64)
+            both = np.isfinite(ours) & np.isfinite(spm) & (spm != 0)
+            diff = ours[both] - spm[both]
+            rows.append({'image': fname,
+                         'n_voxels': int(both.sum()),
+                         'r': np.corrcoef(ours[both], spm[both])[0, 1],
+                         'max_abs_diff': np.abs(diff).max(),
+                         'rel_rmse': np.sqrt(np.mean(diff ** 2)) / np.sqrt(np.mean(spm[both] ** 2))})
+    return pd.DataFrame(rows)
+
+
+def within_tolerance(agreement, max_abs=None, max_rel_rmse=0.01):
+    '''Per-image pass/fail of compare_with_spm's table against absolute and relative-RMSE tolerances'''
+    ok = agreement['rel_rmse'] <= max_rel_rmse
+    if max_abs is not None:
+        ok &= agreement['max_abs_diff'] <= max_abs
+    return ok & (agreement['n_voxels'] > 0)
+
+
+def check(fixture_dir, subject='sub-01', max_abs=None, max_rel_rmse=0.01, max_voxels=20000):
+    '''Fit a stored SPM fixture and compare every con/spmT image within tolerance
+
+    fixture_dir holds a small dataset in bids/ (raw BIDS plus
+    derivatives/fmriprep) and the SPM first-level outputs of the same subject
+    from first_lv_smoothed_condition.py and/or first_lv_unsmoothed_condition.py
+    in 1st_lv_smoothed_avgcond/<subject>/ and 1st_lv_unsmoothed_avgcond/<subject>/.
+    Each one found is refit with the matching inputs. Returns the agreement
+    table with a 'pass' column.
+    '''
+    import tempfile
+    import pandas as pd
+    tables = []
+    for label, smoothed in [('1st_lv_smoothed_avgcond', True), ('1st_lv_unsmoothed_avgcond', False)]:
+        spm_dir = os.path.join(fixture_dir, label, subject)
+        if not os.path.isdir(spm_dir):
+            continue
+        out_dir = tempfile.mkdtemp(prefix='numpy_glm_check_')
+        run_subject(subject, out_dir, max_voxels=max_voxels, bids_dir=os.path.join(fixture_dir, 'bids'),
+                    smoothed=smoothed)
+        agreement = compare_with_spm(out_dir, spm_dir).assign(pipeline=label)
+        agreement['pass'] = within_tolerance(agreement, max_abs, max_rel_rmse)
+        tables.append(agreement)
+    if not tables:
+        raise ValueError('No SPM outputs for {} under {}'.format(subject, fixture_dir))
+    return pd.concat(tables, ignore_index=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='NumPy first-level GLM (SPM-equivalent design and AR(1) prewhitening)')
+    parser.add_argument('-subjects', nargs='+', default=['all'])
+    parser.add_argument('-functional_runs', nargs='+', default=None,
+                        help='fit these runs as given instead of the cached runs (single subject only)')
+    parser.add_argument('-inputs', choices=['smoothed', 'unsmoothed'], default=None,
+                        help='cached runs to fit (default: smoothed, or whatever -compare_spm was produced from)')
+    parser.add_argument('-max_voxels', type=int, default=20000, help='voxels per estimation block')
+    parser.add_argument('-compare_spm', type=str, default=None,
+                        help="SPM results dir holding <subject>/con_*.nii to check equivalence against")
+    parser.add_argument('-check', type=str, default=None,
+                        help='fit a stored SPM fixture directory (see check()) and exit')
+    parser.add_argument('-max_abs', type=float, default=None, help='largest allowed voxelwise difference')
+    parser.add_argument('-max_rel_rmse', type=float, default=0.01,
+                        help='largest allowed RMS difference relative to the RMS of the SPM image')
+    parser.add_argument('-trace', type=str, default=None,
+                        help='append per-stage wall/CPU time, peak RSS and I/O to this .jsonl')
+    args = parser.parse_args()
+    if args.trace:
+        start_trace(args.trace)
+
+    if args.check:
+        agreement = check(args.check, max_abs=args.max_abs, max_rel_rmse=args.max_rel_rmse,
+                          max_voxels=args.max_voxels)
+        print(agreement.to_string(index=False))
+        raise SystemExit(int(not agreement['pass'].all()))
+
+    smoothed = args.inputs != 'unsmoothed'
+    if args.compare_spm:
+        spm_smoothing = spm_smoothed(args.compare_spm)
+        if spm_smoothing is None and args.inputs is None:
+            parser.error('cannot tell whether {} is the smoothed or unsmoothed pipeline; '
+                         'pass -inputs'.format(args.compare_spm))
+        if spm_smoothing is not None and args.inputs is not None and spm_smoothing != smoothed:
+            parser.error('-inputs {} does not match the SPM outputs in {}'.format(args.inputs, args.compare_spm))
+        if args.functional_runs:
+            parser.error('-compare_spm fits the cached runs; drop -functional_runs')
+        if spm_smoothing is not None:
+            smoothed = spm_smoothing
+
+    if args.subjects == ['all']:
+        subject_list = find_subjects()
+    else:
+        subject_list = [s if s.startswith('sub-') else 'sub-' + s for s in args.subjects]
+
+    failed = False
+    for subject in subject_list:
+        timings = run_subject(subject, functional_runs=args.functional_runs, max_voxels=args.max_voxels,
+                              smoothed=smoothed)
+        print(subject, ' '.join('{}: {:.1f}s'.format(k, v) for k, v in timings.items()))
+        if args.compare_spm:
+            agreement = compare_with_spm(os.path.join(numpy_dir(smoothed), subject),
+                                         os.path.join(args.compare_spm, subject))
+            agreement['pass'] = within_tolerance(agreement, args.max_abs, args.max_rel_rmse)
+            print(agreement.to_string(index=False))
+            failed |= not agreement['pass'].all()
+    raise SystemExit(int(failed))
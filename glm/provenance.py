@@ -0,0 +1,137 @@
+# Provenance manifests for incremental first-level runs
+#
+# After a subject's first-level model finishes, a JSON manifest records the
+# hashes of every input file (bold runs, brain mask, events, ratings and
+# confounds), the design parameters (TR, smoothing width, implementation and
+# kernel, high-pass, basis set, serial correlations, dummy-scan trim, the
+# source of get_subject_info with its nuisance list and onset handling) and the contrast vectors, along with the
+# estimated model (SPM.mat, betas, ResMS) and the contrast images. Comparing
+# the manifest with the current inputs gives each subject a plan:
+#   'skip'      - inputs, design and contrasts unchanged
+#   'contrasts' - only contrast_list changed; re-run EstimateContrast on the
+#                 stored SPM.mat and betas
+#   'full'      - new subject, changed inputs or design, or missing outputs
+
+import os
+import json
+import inspect
+import hashlib
+import first_lv_workflow as flw
+import smoothing
+from run_cache import file_hash
+from bids_index import subject_runs
+
+provenance_dir = os.path.join(flw.output_dir, 'provenance')
+
+
+def pipeline_label(smoothed):
+    return '1st_lv_smoothed_avgcond' if smoothed else '1st_lv_unsmoothed_avgcond'
+
+
+def manifest_file(subject_id, smoothed):
+    return os.path.join(provenance_dir, pipeline_label(smoothed), subject_id + '.json')
+
+
+def _digest(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode()).hexdigest()
+
+
+def input_files(subject_id, bids_dir=flw.experiment_dir):
+    '''Every file the first-level model of a subject reads'''
+    files = []
+    for _, row in subject_runs(subject_id, bids_dir).iterrows():
+        files += [row[kind] for kind in ['bold', 'events', 'confounds', 'beh'] if isinstance(row[kind], str)]
+    files.append(os.path.join(bids_dir, 'derivatives/fmriprep/{0}/anat/{0}_space-MNI152NLin2009cAsym_desc-brain_mask.nii.gz'.format(subject_id)))
+    return files
+
+
+def input_hashes(subject_id, bids_dir=flw.experiment_dir):
+    '''Content hashes of the inputs (memoized on size/mtime by run_cache.file_hash)'''
+    return {f: file_hash(f) for f in input_files(subject_id, bids_dir)}
+
+
+def design_params(smoothed):
+    '''Everything besides the inputs and contrasts that determines SPM.mat and the betas'''
+    return {'TR': flw.TR,
+            'fwhm': flw.fwhm if smoothed else None,
+            'smoothing': 'smoothing.py:spm' if smoothed else None,
+            'smoothing_kernel': inspect.getsource(smoothing.spm_smoothkern) if smoothed else None,
+            'hpf': flw.hpf,
+            'bases': flw.bases,
+            'serial_correlations': flw.serial_correlations,
+            't_min': flw.t_min,
+            't_size': flw.t_size,
+            'get_subject_info': inspect.getsource(flw.get_subject_info)}
+
+
+def contrast_params(contrasts=flw.contrast_list):
+    return [[name, stat, list(conds), [float(w) for w in weights]]
+            for name, stat, conds, weights in contrasts]
+
+
+def read_manifest(subject_id, smoothed):
+    path = manifest_file(subject_id, smoothed)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def plan(subject_id, smoothed, bids_dir=flw.experiment_dir):
+    ''''skip', 'contrasts' or 'full' for one subject and pipeline'''
+    manifest = read_manifest(subject_id, smoothed)
+    if manifest is None:
+        return 'full'
+    model = manifest['model']
+    if not all(os.path.exists(f) for f in [model['spm_mat_file'], model['residual_image']] + model['beta_images']):
+        return 'full'
+    if manifest['model_key'] != _digest([input_hashes(subject_id, bids_dir), design_params(smoothed)]):
+        return 'full'
+    if manifest['contrast_key'] != _digest(contrast_params()) or \
+            not all(os.path.exists(f) for f in manifest['outputs']):
+        return 'contrasts'
+    return 'skip'
+
+
+def plan_subjects(subject_list, smoothed, force=False, bids_dir=flw.experiment_dir):
+    '''Subjects grouped by plan'''
+    plans = {'full': [], 'contrasts': [], 'skip': []}
+    for subject_id in subject_list:
+        plans['full' if force else plan(subject_id, smoothed, bids_dir)].append(subject_id)
+    return plans
+
+
+def write_manifest(subject_id, smoothed, spm_mat_file, beta_images, residual_image, outputs,
+                   bids_dir=flw.experiment_dir):
+    '''Record inputs, parameters, the estimated model and the sunk outputs of a subject'''
+    hashes = input_hashes(subject_id, bids_dir)
+    manifest = {'subject_id': subject_id,
+                'pipeline': pipeline_label(smoothed),
+                'inputs': hashes,
+                'design': design_params(smoothed),
+                'contrasts': contrast_params(),
+                'model_key': _digest([hashes, design_params(smoothed)]),
+                'contrast_key': _digest(contrast_params()),
+                'model': {'spm_mat_file': spm_mat_file,
+                          'beta_images': list(beta_images),
+                          'residual_image': residual_image},
+                'outputs': list(outputs)}
+    path = manifest_file(subject_id, smoothed)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def build_incremental(subject_list, smoothed, force=False, bids_dir=flw.experiment_dir):
+    '''Workflows covering only the subjects (and stages) that need to run'''
+    plans = plan_subjects(subject_list, smoothed, force, bids_dir)
+    print('{}: {} full, {} contrasts only, {} unchanged'.format(
+        pipeline_label(smoothed), len(plans['full']), len(plans['contrasts']), len(plans['skip'])))
+    workflows = []
+    if plans['full']:
+        workflows.append(flw.build_first_lv(plans['full'], smoothed=smoothed))
+    if plans['contrasts']:
+        workflows.append(flw.build_contrast_only(plans['contrasts'], smoothed=smoothed))
+    return workflows
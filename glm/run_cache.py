@@ -0,0 +1,185 @@
+# Content-addressed cache of trimmed, uncompressed fMRIPrep runs
+#
+# Entries are keyed by the SHA-1 of the source file's contents plus the trim
+# parameters, so the smoothed and unsmoothed SPM pipelines and the nltools GLM
+# all decompress and drop dummy scans once per run instead of once per
+# workflow directory. SPM-smoothed copies (cached_smoothed_run) are keyed the
+# same way plus the FWHM.
+
+import os
+import glob
+import json
+import time
+import getpass
+import hashlib
+import argparse
+
+user = getpass.getuser()
+
+cache_dir = os.environ.get('VIGNETTE_RUN_CACHE',
+                           '/home/{}/spm/scratch/run_cache/'.format(user))
+max_gb = float(os.environ.get('VIGNETTE_RUN_CACHE_GB', 250))
+
+# Entries used more recently than this are not evicted, so a run handed out by
+# cached_trimmed_run is still there when the caller opens it (hits refresh the
+# mtime; an entry that is already open stays readable after it is unlinked).
+# Keep it short: pinned entries do not count towards freeing space, so a long
+# window lets the cache grow past max_gb.
+pin_seconds = float(os.environ.get('VIGNETTE_RUN_CACHE_PIN_S', 10 * 60))
+
+
+def _atomic_write(path, write):
+    '''Call write(tmp_path) and move the result into place'''
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def file_hash(in_file, cache_dir=cache_dir, block_size=2**23):
+    '''SHA-1 of a file's contents, memoized on (path, size, mtime)'''
+    stat = os.stat(in_file)
+    stat_key = '{}:{}:{}'.format(os.path.realpath(in_file), stat.st_size, stat.st_mtime_ns)
+    memo_file = os.path.join(cache_dir, 'hashes',
+                             hashlib.sha1(stat_key.encode()).hexdigest())
+    if os.path.exists(memo_file):
+        with open(memo_file) as f:
+            return f.read().strip()
+
+    digest = hashlib.sha1()
+    with open(in_file, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    digest = digest.hexdigest()
+
+    os.makedirs(os.path.dirname(memo_file), exist_ok=True)
+
+    def write(tmp_path):
+        with open(tmp_path, 'w') as f:
+            f.write(digest)
+    _atomic_write(memo_file, write)
+    return digest
+
+
+def cache_entry(in_file, t_min, t_size, cache_dir=cache_dir):
+    '''Path of the cache entry for in_file trimmed to [t_min, t_min + t_size)'''
+    return os.path.join(cache_dir, 'runs', '{}_tmin-{}_tsize-{}.nii'.format(
+        file_hash(in_file, cache_dir=cache_dir), t_min, t_size))
+
+
+def cached_trimmed_run(in_file, t_min=11, t_size=668, cache_dir=cache_dir, max_gb=max_gb):
+    '''Return an uncompressed NIfTI of in_file with dummy scans dropped
+
+    Equivalent to Gunzip followed by ExtractROI(t_min=t_min, t_size=t_size),
+    but the result is shared by every pipeline that asks for the same run.
+    '''
+    import nibabel as nib
+
+    entry = cache_entry(in_file, t_min, t_size, cache_dir=cache_dir)
+    if os.path.exists(entry):
+        # Hits refresh the mtime, which is what eviction orders on
+        os.utime(entry)
+        return entry
+
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    img = nib.load(in_file)
+    trimmed = img.slicer[..., t_min:t_min + t_size]
+
+    def write(tmp_path):
+        # nibabel picks the on-disk format from the extension
+        try:
+            nib.save(trimmed, tmp_path + '.nii')
+            os.replace(tmp_path + '.nii', tmp_path)
+        finally:
+            if os.path.exists(tmp_path + '.nii'):
+                os.remove(tmp_path + '.nii')
+    _atomic_write(entry, write)
+
+    def write_sidecar(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump({'source': os.path.realpath(in_file), 't_min': t_min, 't_size': t_size}, f)
+    _atomic_write(entry + '.json', write_sidecar)
+
+    evict(cache_dir=cache_dir, max_gb=max_gb, keep=[entry])
+    return entry
+
+
+def cached_smoothed_run(in_file, fwhm=6, t_min=11, t_size=668, cache_dir=cache_dir, max_gb=max_gb):
+    '''Return the cached trimmed run of in_file smoothed with SPM's kernel (smoothing.py)
+
+    Stored next to the trimmed entry, so both are evicted by the same LRU.
+    '''
+    import numpy as np
+    from smoothing import smooth_file
+
+    trimmed = cached_trimmed_run(in_file, t_min=t_min, t_size=t_size, cache_dir=cache_dir, max_gb=max_gb)
+    label = 'x'.join('{:g}'.format(f) for f in np.broadcast_to(np.asarray(fwhm, dtype=float), (3,)))
+    entry = trimmed[:-len('.nii')] + '_fwhm-{}.nii'.format(label)
+    if os.path.exists(entry):
+        os.utime(entry)
+        return entry
+
+    def write(tmp_path):
+        try:
+            smooth_file(trimmed, tmp_path + '.nii', fwhm=fwhm, kernel='spm')
+            os.replace(tmp_path + '.nii', tmp_path)
+        finally:
+            if os.path.exists(tmp_path + '.nii'):
+                os.remove(tmp_path + '.nii')
+    _atomic_write(entry, write)
+
+    evict(cache_dir=cache_dir, max_gb=max_gb, keep=[trimmed, entry])
+    return entry
+
+
+def evict(cache_dir=cache_dir, max_gb=max_gb, keep=(), pin_seconds=pin_seconds):
+    '''Drop least recently used entries until the cache fits in max_gb, sparing keep and
+    entries used in the last pin_seconds'''
+    entries = []
+    for entry in glob.glob(os.path.join(cache_dir, 'runs', '*.nii')):
+        try:
+            stat = os.stat(entry)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry))
+
+    total = sum(size for _, size, _ in entries)
+    budget = max_gb * 1024**3
+    now = time.time()
+    for mtime, size, entry in sorted(entries):
+        if total <= budget:
+            break
+        if entry in keep or now - mtime < pin_seconds:
+            continue
+        for f in [entry, entry + '.json']:
+            if os.path.exists(f):
+                os.remove(f)
+        total -= size
+    return total
+
+
+def trim_run(in_file, t_min, t_size, code_dir):
+    '''Nipype Function node wrapper around cached_trimmed_run'''
+    import sys
+    sys.path.insert(0, code_dir)
+    from run_cache import cached_trimmed_run
+    return cached_trimmed_run(in_file, t_min=t_min, t_size=t_size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Warm or prune the trimmed-run cache')
+    parser.add_argument('files', nargs='*')
+    parser.add_argument('-t_min', type=int, default=11)
+    parser.add_argument('-t_size', type=int, default=668)
+    parser.add_argument('-evict', action='store_true')
+    parser.add_argument('-pin_s', type=float, default=pin_seconds,
+                        help='spare entries used in the last pin_s seconds when evicting')
+    args = parser.parse_args()
+
+    for f in args.files:
+        print(f, '->', cached_trimmed_run(f, t_min=args.t_min, t_size=args.t_size))
+    if args.evict:
+        print('Cache size (GB): ', evict(pin_seconds=args.pin_s) / 1024**3)
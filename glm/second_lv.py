@@ -10,6 +10,7 @@ from nipype.interfaces.io import DataSink
 # Get current user
 import getpass
 import os
+from tracing import node_trace_args
 
 user = getpass.getuser()
 print('Running code as: ', user)
@@ -91,4 +92,5 @@ analysis2nd.connect([(level2conestimate, datasink, [('spm_mat_file',
                      ])
 
 analysis2nd.config["execution"]["crashfile_format"] = "txt"
-analysis2nd.run('MultiProc', plugin_args={'n_procs': 7})
\ No newline at end of file
+# Nodes are traced when MFT_TRACE points at a .jsonl (profiling/instrument.py)
+analysis2nd.run('MultiProc', plugin_args=node_trace_args({'n_procs': 7}))
\ No newline at end of file
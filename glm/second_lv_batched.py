@@ -0,0 +1,302 @@
+# Second-level one-sample t-tests for all contrasts in one NumPy pass
+#
+# second_lv.py runs OneSampleTTestDesign + EstimateModel + EstimateContrast +
+# Threshold as a separate SPM job per contrast, each re-reading the same
+# con_*.nii files. Here every subject x contrast image is read once into a
+# (n_contrasts, n_subjects, n_voxels) float32 stack, all t maps come from one
+# vectorized pass, and each map gets SPM's p < 0.001 height threshold with
+# topological FDR on cluster extent (Chumbley & Friston, 2009): smoothness is
+# estimated from the standardized residuals, cluster p-values come from random
+# field theory as in spm_P_RF, and clusters surviving Benjamini-Hochberg at
+# q = 0.01 are kept. Optional sign-flip permutations (permutation.py) add
+# max-t and TFCE FWE-corrected p maps.
+
+import os
+import glob
+import time
+import getpass
+import argparse
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from scipy import stats, ndimage
+from scipy.special import gammaln
+from permutation import permutation_test
+
+user = getpass.getuser()
+
+exp_dir = '/home/{}/spm/analysis/vignettes/glm/spm'.format(user)
+first_lv_dir = os.path.join(exp_dir, 'results', '1st_lv_smoothed_avgcond')
+batched_dir = os.path.join(exp_dir, 'results', '2nd_lv_batched_avgcond')
+
+# Same contrasts and thresholds as second_lv.py
+contrast_id_list = ['0009', '0010', '0011', '0012', '0013',
+                    '0014', '0015', '0016', '0017']
+height_p = 0.001
+cluster_q = 0.01
+
+
+def load_contrasts(contrast_ids, first_lv_dir=first_lv_dir):
+    '''Stack con images of every subject into (n_contrasts, n_subjects, n_voxels)
+
+    The analysis mask keeps voxels that are finite and non-zero in every
+    image (SPM's implicit mask for NaN-masked con images).
+    '''
+    subjects = sorted(os.path.basename(d) for d in glob.glob(os.path.join(first_lv_dir, 'sub-*'))
+                      if all(os.path.exists(os.path.join(d, 'con_{}.nii'.format(c))) for c in contrast_ids))
+    ref = nib.load(os.path.join(first_lv_dir, subjects[0], 'con_{}.nii'.format(contrast_ids[0])))
+    imgs = np.empty((len(contrast_ids), len(subjects)) + ref.shape[:3], dtype=np.float32)
+    for i, c in enumerate(contrast_ids):
+        for j, sub in enumerate(subjects):
+            imgs[i, j] = np.asarray(nib.load(os.path.join(first_lv_dir, sub, 'con_{}.nii'.format(c))).dataobj,
+                                    dtype=np.float32)
+    mask = np.all(np.isfinite(imgs) & (imgs != 0), axis=(0, 1))
+    return subjects, imgs[:, :, mask], mask, ref.affine
+
+
+def one_sample_t(Y):
+    '''Group mean and t over the subject axis of a (..., n_subjects, n_voxels) stack'''
+    n = Y.shape[-2]
+    mean = Y.mean(axis=-2, dtype=np.float64)
+    sd = Y.std(axis=-2, ddof=1, dtype=np.float64)
+    return mean, mean / (sd / np.sqrt(n))
+
+
+def estimate_smoothness(resid, mask):
+    '''FWHM (voxels) per axis from residuals (n_subjects, n_voxels), as spm_est_smoothness
+
+    Residuals are scaled to unit sum of squares per voxel; the variance of
+    their spatial first differences over in-mask neighbour pairs gives the
+    roughness along each axis.
+    '''
+    u = np.zeros((resid.shape[0],) + mask.shape, dtype=np.float64)
+    u[:, mask] = resid / np.sqrt((resid.astype(np.float64) ** 2).sum(axis=0))
+    fwhm = np.empty(3)
+    for axis in range(3):
+        lo = [slice(None)] * 3
+        hi = [slice(None)] * 3
+        lo[axis], hi[axis] = slice(None, -1), slice(1, None)
+        pairs = mask[tuple(lo)] & mask[tuple(hi)]
+        d = u[(slice(None),) + tuple(hi)][:, pairs] - u[(slice(None),) + tuple(lo)][:, pairs]
+        lam = (d ** 2).sum() / pairs.sum()
+        fwhm[axis] = np.sqrt(4 * np.log(2) / lam)
+    return fwhm
+
+
+def resel_counts(mask, fwhm):
+    '''Resel counts R0..R3 of the search volume, as spm_resels_vol'''
+    m = mask.astype(bool)
+    rx, ry, rz = fwhm
+    v = m.sum()
+    ex = (m[:-1] & m[1:]).sum()
+    ey = (m[:, :-1] & m[:, 1:]).sum()
+    ez = (m[:, :, :-1] & m[:, :, 1:]).sum()
+    fxy = (m[:-1, :-1] & m[1:, :-1] & m[:-1, 1:] & m[1:, 1:]).sum()
+    fxz = (m[:-1, :, :-1] & m[1:, :, :-1] & m[:-1, :, 1:] & m[1:, :, 1:]).sum()
+    fyz = (m[:, :-1, :-1] & m[:, 1:, :-1] & m[:, :-1, 1:] & m[:, 1:, 1:]).sum()
+    c = (m[:-1, :-1, :-1] & m[1:, :-1, :-1] & m[:-1, 1:, :-1] & m[:-1, :-1, 1:] &
+         m[1:, 1:, :-1] & m[1:, :-1, 1:] & m[:-1, 1:, 1:] & m[1:, 1:, 1:]).sum()
+    return np.array([v - ex - ey - ez + fxy + fxz + fyz - c,
+                     (ex - fxy - fxz + c) / rx + (ey - fxy - fyz + c) / ry + (ez - fxz - fyz + c) / rz,
+                     (fxy - c) / (rx * ry) + (fxz - c) / (rx * rz) + (fyz - c) / (ry * rz),
+                     c / (rx * ry * rz)], dtype=np.float64)
+
+
+def ec_density_t(u, df):
+    '''Euler characteristic densities (0-3D) of a t field at threshold u, as spm_ECdensity'''
+    a = 4 * np.log(2)
+    b = np.exp(gammaln((df + 1) / 2.) - gammaln(df / 2.))
+    decay = (1 + u ** 2 / df) ** (-(df - 1) / 2.)
+    return np.array([stats.t.sf(u, df),
+                     np.sqrt(a) / (2 * np.pi) * decay,
+                     a / (2 * np.pi) ** 1.5 * b / np.sqrt(df / 2.) * u * decay,
+                     a ** 1.5 / (2 * np.pi) ** 2 * decay * ((df - 1) * u ** 2 / df - 1)])
+
+
+def cluster_p(k, u, df, R, fwhm):
+    '''Uncorrected RFT p-value of clusters of k voxels above u, as spm_P_RF (n = 1)'''
+    D = 3
+    ec = ec_density_t(u, df)
+    em = R[D] * ec[D]
+    en = ec[0] * R[D] / em
+    beta = (np.exp(gammaln(D / 2. + 1)) / en) ** (2. / D)
+    return np.exp(-beta * (np.asarray(k) / np.prod(fwhm)) ** (2. / D))
+
+
+def topo_fdr(t, mask, df, fwhm, height_p=height_p, q=cluster_q):
+    '''Height-threshold t (3D) at height_p and keep clusters passing topological FDR
+
+    Returns the thresholded map and a table of every supra-threshold cluster.
+    '''
+    u = stats.t.isf(height_p, df)
+    labels, n_clusters = ndimage.label((t > u) & mask)
+    table = pd.DataFrame(columns=['cluster', 'k', 'peak_t', 'p_unc', 'p_fdr', 'kept'])
+    if n_clusters == 0:
+        return np.zeros_like(t), table, u
+
+    ids = np.arange(1, n_clusters + 1)
+    k = ndimage.sum_labels(np.ones_like(t), labels, ids)
+    p = cluster_p(k, u, df, resel_counts(mask, fwhm), fwhm)
+
+    # Benjamini-Hochberg over clusters
+    order = np.argsort(p)
+    p_fdr = np.empty_like(p)
+    p_fdr[order] = np.minimum.accumulate((p[order] * n_clusters / np.arange(1, n_clusters + 1))[::-1])[::-1]
+    kept = p_fdr <= q
+
+    thresholded = np.where(np.isin(labels, ids[kept]), t, 0)
+    table = pd.DataFrame({'cluster': ids, 'k': k.astype(int),
+                          'peak_t': ndimage.maximum(t, labels, ids),
+                          'p_unc': p, 'p_fdr': np.minimum(p_fdr, 1), 'kept': kept})
+    return thresholded, table.sort_values('k', ascending=False), u
+
+
+def _rel_diff(ours, spm):
+    ours, spm = np.asarray(ours, dtype=float), np.asarray(spm, dtype=float)
+    return np.abs(ours - spm) / np.maximum(np.abs(spm), np.finfo(float).tiny)
+
+
+def spm_clusters(tab_dat):
+    '''Cluster rows (k, p_unc, p_fdr, peak_t) of an SPM results table saved as TabDat in a .mat
+
+    TabDat is what spm_list('List', xSPM, hReg) returns; cluster rows are the
+    ones with an extent.
+    '''
+    from scipy.io import loadmat
+    dat = np.atleast_2d(loadmat(tab_dat, squeeze_me=True, struct_as_record=False)['TabDat'].dat)
+    rows = [{'k': int(r[4]), 'p_unc': float(r[5]), 'p_fdr': float(r[3]), 'peak_t': float(r[8])}
+            for r in dat if np.size(r[4])]
+    return pd.DataFrame(rows, columns=['k', 'p_unc', 'p_fdr', 'peak_t'])
+
+
+def check(spm_dir, contrast, first_lv_dir=first_lv_dir, tab_dat=None, max_rel=0.05):
+    '''Compare smoothness, resels and cluster p-values of one contrast with SPM's second level
+
+    spm_dir holds the SPM.mat (and spmT_0001_thr.nii) that second_lv.py wrote
+    for the contrast; tab_dat is an optional .mat with the TabDat of its
+    results table (height p < 0.001), whose cluster p-values are compared by
+    matching clusters on their peak t. Each quantity is compared end to end
+    and, where possible, with SPM's own inputs (mask, FWHM, resels, df) so a
+    mismatch points at one step. Returns a table with a 'pass' column
+    (relative difference <= max_rel).
+    '''
+    from scipy.io import loadmat
+    SPM = loadmat(os.path.join(spm_dir, 'SPM.mat'), squeeze_me=True, struct_as_record=False)['SPM']
+    spm_fwhm = np.atleast_1d(SPM.xVol.FWHM).astype(float)
+    spm_R = np.atleast_1d(SPM.xVol.R).astype(float)
+    spm_df = float(SPM.xX.erdf)
+    spm_mask = np.zeros(tuple(np.atleast_1d(SPM.xVol.DIM).astype(int)), dtype=bool)
+    xyz = np.atleast_2d(SPM.xVol.XYZ).astype(int) - 1
+    spm_mask[tuple(xyz)] = True
+
+    subjects, Y, mask, affine = load_contrasts([contrast], first_lv_dir)
+    mean, t = one_sample_t(Y[0])
+    df = len(subjects) - 1
+    fwhm = estimate_smoothness(Y[0] - mean.astype(np.float32), mask)
+    R = resel_counts(mask, fwhm)
+    t_map = np.zeros(mask.shape)
+    t_map[mask] = t
+    thresholded, clusters, u = topo_fdr(t_map, mask, df, fwhm)
+
+    rows = [('df', df, spm_df), ('in-mask voxels', mask.sum(), spm_mask.sum())]
+    rows += [('FWHM {} (vox)'.format(a), f, g) for a, f, g in zip('xyz', fwhm, spm_fwhm)]
+    rows += [('R{}'.format(d), r, g) for d, (r, g) in enumerate(zip(R, spm_R))]
+    rows += [('R{} (SPM mask, FWHM)'.format(d), r, g)
+             for d, (r, g) in enumerate(zip(resel_counts(spm_mask, spm_fwhm), spm_R))]
+    thr_file = os.path.join(spm_dir, 'spmT_0001_thr.nii')
+    if os.path.exists(thr_file):
+        spm_thr = np.asarray(nib.load(thr_file).dataobj)
+        rows.append(('voxels surviving topological FDR', (thresholded != 0).sum(),
+                     (np.nan_to_num(spm_thr) != 0).sum()))
+    if tab_dat is not None:
+        spm_u = stats.t.isf(height_p, spm_df)
+        for c in spm_clusters(tab_dat).itertuples():
+            rows.append(('cluster k={} p_unc (SPM k, u, R, FWHM, df)'.format(c.k),
+                         cluster_p(c.k, spm_u, spm_df, spm_R, spm_fwhm), c.p_unc))
+            if len(clusters):
+                ours = clusters.iloc[np.argmin(np.abs(clusters['peak_t'].to_numpy() - c.peak_t))]
+                rows.append(('cluster k={} size'.format(c.k), ours['k'], c.k))
+                rows.append(('cluster k={} p_unc'.format(c.k), ours['p_unc'], c.p_unc))
+                rows.append(('cluster k={} p_fdr'.format(c.k), ours['p_fdr'], c.p_fdr))
+    table = pd.DataFrame(rows, columns=['quantity', 'ours', 'spm'])
+    table['rel_diff'] = _rel_diff(table['ours'], table['spm'])
+    table['pass'] = table['rel_diff'] <= max_rel
+    return table
+
+
+def run(contrast_ids=contrast_id_list, first_lv_dir=first_lv_dir, out_dir=batched_dir,
+        n_perm=0, with_tfce=True, n_jobs=None, seed=0):
+    '''One-sample t for every contrast; writes spmT, thresholded maps and cluster tables'''
+    start = time.perf_counter()
+    subjects, Y, mask, affine = load_contrasts(contrast_ids, first_lv_dir)
+    n = len(subjects)
+    df = n - 1
+    loaded = time.perf_counter()
+    mean, t = one_sample_t(Y)
+
+    summary = []
+    for i, c in enumerate(contrast_ids):
+        con_dir = os.path.join(out_dir, 'con_' + c)
+        os.makedirs(con_dir, exist_ok=True)
+        t_map = np.zeros(mask.shape)
+        t_map[mask] = t[i]
+        fwhm = estimate_smoothness(Y[i] - mean[i].astype(np.float32), mask)
+        thresholded, clusters, u = topo_fdr(t_map, mask, df, fwhm)
+
+        for name, data in [('con_0001.nii', mean[i]), ('spmT_0001.nii', t[i])]:
+            img = np.full(mask.shape, np.nan, dtype=np.float32)
+            img[mask] = data
+            nib.save(nib.Nifti1Image(img, affine), os.path.join(con_dir, name))
+        nib.save(nib.Nifti1Image(thresholded.astype(np.float32), affine),
+                 os.path.join(con_dir, 'spmT_0001_thr.nii'))
+        clusters.to_csv(os.path.join(con_dir, 'clusters.csv'), index=False)
+
+        row = {'contrast': c, 'n': n, 'max_t': t[i].max(), 'u': u,
+               'fwhm_vox': np.round(fwhm, 2).tolist(), 'clusters': len(clusters),
+               'kept': int(clusters['kept'].sum()) if len(clusters) else 0}
+        if n_perm:
+            perm = permutation_test(Y[i], mask, n_perm=n_perm, n_jobs=n_jobs,
+                                    with_tfce=with_tfce, seed=seed)
+            maps = [('spmT_0001_pfwe.nii', perm['p_fwe_t'])]
+            row.update(fwe_t_05=np.percentile(perm['max_t'], 95), min_p_fwe_t=perm['p_fwe_t'].min(),
+                       perms_per_sec=perm['perms_per_sec'])
+            if with_tfce:
+                maps += [('tfce_0001.nii', perm['tfce']), ('tfce_0001_pfwe.nii', perm['p_fwe_tfce'])]
+                row.update(min_p_fwe_tfce=perm['p_fwe_tfce'].min())
+            for name, data in maps:
+                img = np.full(mask.shape, np.nan, dtype=np.float32)
+                img[mask] = data
+                nib.save(nib.Nifti1Image(img, affine), os.path.join(con_dir, name))
+        summary.append(row)
+
+    summary = pd.DataFrame(summary)
+    summary.to_csv(os.path.join(out_dir, 'summary.csv'), index=False)
+    print('Loaded {} subjects x {} contrasts in {:.1f}s, tested in {:.1f}s'.format(
+        n, len(contrast_ids), loaded - start, time.perf_counter() - loaded))
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Batched second-level one-sample t-tests with topological FDR')
+    parser.add_argument('-contrasts', nargs='+', default=contrast_id_list)
+    parser.add_argument('-first_lv_dir', type=str, default=first_lv_dir)
+    parser.add_argument('-out_dir', type=str, default=batched_dir)
+    parser.add_argument('-n_perm', type=int, default=0, help='sign-flip permutations for max-t / TFCE nulls (0 = off)')
+    parser.add_argument('-no_tfce', action='store_true', help='max-t only')
+    parser.add_argument('-n_jobs', type=int, default=None)
+    parser.add_argument('-seed', type=int, default=0)
+    parser.add_argument('-check', type=str, default=None,
+                        help="SPM second-level dir (SPM.mat) of the first -contrasts entry to compare "
+                             "FWHM, resels and cluster p-values against, then exit")
+    parser.add_argument('-tabdat', type=str, default=None,
+                        help='.mat holding the TabDat of the SPM results table, for -check cluster p-values')
+    parser.add_argument('-max_rel', type=float, default=0.05, help='largest relative difference for -check')
+    args = parser.parse_args()
+
+    if args.check:
+        table = check(args.check, args.contrasts[0], args.first_lv_dir, args.tabdat, args.max_rel)
+        print(table.to_string(index=False))
+        raise SystemExit(int(not table['pass'].all()))
+
+    print(run(args.contrasts, args.first_lv_dir, args.out_dir, n_perm=args.n_perm,
+              with_tfce=not args.no_tfce, n_jobs=args.n_jobs, seed=args.seed).to_string(index=False))
@@ -0,0 +1,125 @@
+# Memory-bounded streaming mode for nltools_ratings_glm.py
+#
+# Brain_Data(nifti_path).smooth(fwhm) holds the whole run in float64 (plus a
+# smoothed copy). Here the uncompressed run from the run cache is memory-mapped,
+# resampled/masked/smoothed a few volumes at a time into a float32 scratch
+# array, regressed in voxel chunks, and every beta map of interest is z-scored
+# and written on its own.
+
+import os
+import resource
+import tempfile
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from nilearn.maskers import NiftiMasker
+from nltools.prefs import MNI_Template, resolve_mni_path
+from tracing import stage
+from smoothing import smooth_masked
+
+
+def peak_rss_gb():
+    '''Peak resident set size of this process so far (GB)'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024**2
+
+
+def check_rss(max_rss_gb, stage):
+    '''Raise once peak RSS has gone past the configured ceiling'''
+    if max_rss_gb is not None and peak_rss_gb() > max_rss_gb:
+        raise MemoryError('Peak RSS {:.2f} GB exceeded the {:.2f} GB ceiling during {}'.format(
+            peak_rss_gb(), max_rss_gb, stage))
+
+
+class StreamedRun(object):
+    '''Smoothed, masked run held in a float32 memmap of shape (n_tr, n_voxels)
+
+    Uses the same default MNI mask and resampling as Brain_Data, so betas land
+    in the same space as the in-memory path.
+    '''
+
+    def __init__(self, nifti_path, fwhm, mask=None, chunk_volumes=32, scratch_dir=None,
+                 max_rss_gb=None):
+        self.masker = NiftiMasker(mask_img=mask or resolve_mni_path(MNI_Template)['mask']).fit()
+        self.max_rss_gb = max_rss_gb
+        img = nib.load(nifti_path, mmap=True)
+        n_tr = img.shape[3]
+        self._mask = np.asarray(self.masker.mask_img_.dataobj) != 0
+        n_voxels = int(self._mask.sum())
+
+        self._scratch = tempfile.NamedTemporaryFile(suffix='.npy', dir=scratch_dir)
+        self.data = np.lib.format.open_memmap(self._scratch.name, mode='w+', dtype=np.float32,
+                                              shape=(n_tr, n_voxels))
+        self.global_mn = np.zeros(n_tr)
+        self.frame_diff = np.zeros(n_tr - 1)
+
+        previous = None
+        for t0 in range(0, n_tr, chunk_volumes):
+            t1 = min(t0 + chunk_volumes, n_tr)
+            chunk = nib.Nifti1Image(np.asarray(img.dataobj[..., t0:t1], dtype=np.float32),
+                                    img.affine, img.header)
+            # Brain_Data(...).smooth(): resample + mask, then unmask, smooth and
+            # mask in place on the memmap (smoothing.smooth_masked)
+            self.data[t0:t1] = self.masker.transform(chunk)
+            smooth_masked(self.data[t0:t1], self._mask, self.masker.mask_img_.affine, fwhm)
+            masked = np.asarray(self.data[t0:t1])
+
+            # Running summaries for find_spikes
+            self.global_mn[t0:t1] = masked.mean(axis=1)
+            if previous is not None:
+                masked = np.vstack([previous, masked])
+            self.frame_diff[max(t0 - 1, 0):t1 - 1] = np.mean(np.abs(np.diff(masked, axis=0)), axis=1)
+            previous = masked[-1:]
+            check_rss(self.max_rss_gb, 'smoothing volumes {}-{}'.format(t0, t1))
+        self.data.flush()
+
+    def find_spikes(self, global_spike_cutoff=3, diff_spike_cutoff=3):
+        '''Spike regressors identical to nltools.stats.find_spikes on the full run'''
+        gm, fd = self.global_mn, self.frame_diff
+        global_outliers = np.append(np.where(gm > gm.mean() + gm.std() * global_spike_cutoff),
+                                    np.where(gm < gm.mean() - gm.std() * global_spike_cutoff))
+        frame_outliers = np.append(np.where(fd > fd.mean() + fd.std() * diff_spike_cutoff),
+                                   np.where(fd < fd.mean() - fd.std() * diff_spike_cutoff))
+        outlier = pd.DataFrame({'TR': np.arange(1, len(gm) + 1)})
+        for prefix, locs in [('global_spike', global_outliers), ('diff_spike', frame_outliers)]:
+            for i, loc in enumerate(locs):
+                outlier[prefix + str(i + 1)] = 0
+                outlier.loc[int(loc), prefix + str(i + 1)] = 1
+        return outlier
+
+    def regress_zscored_betas(self, X, columns, out_files, chunk_voxels=None, tags=None):
+        '''OLS in voxel chunks; writes each requested beta map z-scored over voxels
+
+        Args:
+            X: (pd.DataFrame) design matrix with one row per volume
+            columns: design columns whose betas are written
+            out_files: output paths, one per column
+            chunk_voxels: voxels per regression chunk; defaults to ~256 MB of float64 data
+            tags: labels (subject, run) of the traced regression / beta write stages
+        '''
+        n_tr, n_voxels = self.data.shape
+        chunk_voxels = chunk_voxels or max(1, 2**28 // (8 * n_tr))
+        pinv = np.linalg.pinv(X.values)[[X.columns.get_loc(c) for c in columns]]
+
+        betas = np.lib.format.open_memmap(self._scratch.name + '.betas.npy', mode='w+',
+                                          dtype=np.float32, shape=(len(columns), n_voxels))
+        tags = tags or {}
+        try:
+            with stage('regression', **tags):
+                for v0 in range(0, n_voxels, chunk_voxels):
+                    v1 = min(v0 + chunk_voxels, n_voxels)
+                    betas[:, v0:v1] = pinv @ np.asarray(self.data[:, v0:v1], dtype=np.float64)
+                    check_rss(self.max_rss_gb, 'regressing voxels {}-{}'.format(v0, v1))
+
+            with stage('beta write', **tags):
+                for i, out_file in enumerate(out_files):
+                    beta = np.asarray(betas[i], dtype=np.float64)
+                    # standardize(axis=0, method='zscore') on a single map
+                    beta = (beta - beta.mean()) / beta.std()
+                    self.masker.inverse_transform(beta).to_filename(out_file)
+        finally:
+            del betas
+            os.remove(self._scratch.name + '.betas.npy')
+
+    def close(self):
+        del self.data
+        self._scratch.close()
@@ -0,0 +1,205 @@
+# Cached sparse volume-to-surface projection and pooled surface rendering
+#
+# surfplot.ipynb calls neuromaps.transforms.mni152_to_fslr for every map.
+# That interpolates the volume at the registration-fusion coordinates of each
+# vertex (Wu et al., 2018) with scipy's interpn, and it reloads the
+# coordinates from text files and recomputes the interpolation weights every
+# time. The weights depend only on the vertices and the volume grid. Here they
+# are built once per (space, density, method, grid) as a sparse
+# (vertices x voxels) matrix with eight trilinear weights (or one nearest
+# voxel) per vertex, cached as an .npz, and any number of maps on that grid
+# are projected together by one sparse product. Figures are rendered as in
+# the notebook by a process pool sharing one virtual X display, started and
+# stopped by the parent; every worker fetches the surfaces once.
+
+import os
+import time
+import hashlib
+import argparse
+import numpy as np
+import nibabel as nib
+from scipy import sparse
+from concurrent.futures import ProcessPoolExecutor
+
+second_lv_maps = '/srv/lab/fmri/mft/fhopp_diss/analysis/vignettes/glm/spm/second_lv/datasink/2ndLevel/'
+cache_dir = 'surface_cache'
+plot_dir = 'plots'
+
+contrast_mapper = {
+    'con_0018': 'Physical Care > Social',
+    'con_0019': 'Emotional Care > Social',
+    'con_0020': 'Fairness > Social',
+    'con_0021': 'Liberty > Social',
+    'con_0022': 'Loyalty > Social',
+    'con_0023': 'Authority > Social',
+    'con_0024': 'Sanctity > Social',
+    'con_0025': 'Binding > Individualizing',
+    'con_0026': 'Moral > Social'
+}
+
+# Surfaces of the rendering workers, fetched once per process
+_surfaces = None
+
+
+def vertex_coords(space='fsLR', density='32k'):
+    '''MNI coordinates (n_vertices, 3) of the left and right hemisphere vertices (registration fusion)'''
+    from neuromaps.datasets import fetch_regfusion
+    return [np.loadtxt(ras) for ras in fetch_regfusion(space)[density]]
+
+
+def projection_matrix(coords, affine, shape, method='linear'):
+    '''Sparse (n_vertices, n_voxels) matrix of interpn weights of the C-ordered volume at coords
+
+    Vertices outside the volume get an empty row.
+    '''
+    ijk = nib.affines.apply_affine(np.linalg.inv(affine), coords)
+    shape = np.array(shape[:3])
+    valid = ((ijk >= 0) & (ijk <= shape - 1)).all(axis=1)
+    if method == 'nearest':
+        # RegularGridInterpolator rounds half-way points down
+        low = np.clip(np.floor(ijk), 0, shape - 1).astype(int)
+        corners = (low + (ijk - low > 0.5))[:, None]
+        weights = np.ones((len(ijk), 1))
+    else:
+        low = np.clip(np.floor(ijk), 0, np.maximum(shape - 2, 0)).astype(int)
+        frac = ijk - low
+        offsets = np.array([[a, b, c] for a in (0, 1) for b in (0, 1) for c in (0, 1)])
+        corners = low[:, None] + offsets
+        weights = np.prod(np.where(offsets, frac[:, None], 1 - frac[:, None]), axis=2)
+    corners = np.minimum(corners, shape - 1)
+    rows = np.repeat(np.arange(len(ijk)), weights.shape[1])
+    keep = np.repeat(valid, weights.shape[1]) & (weights.ravel() != 0)
+    M = sparse.csr_matrix((weights.ravel()[keep], (rows[keep], np.ravel_multi_index(
+        corners.reshape(-1, 3)[keep].T, tuple(shape)))), shape=(len(ijk), int(np.prod(shape))))
+    M.sum_duplicates()
+    return M
+
+
+def cache_file(affine, shape, space='fsLR', density='32k', method='linear', cache_dir=cache_dir):
+    key = hashlib.sha1(np.asarray(affine, dtype=np.float64).tobytes() + np.array(shape[:3]).tobytes()).hexdigest()
+    return os.path.join(cache_dir, '{}_{}_{}_{}.npz'.format(space, density, method, key[:12]))
+
+
+def cached_matrix(affine, shape, space='fsLR', density='32k', method='linear', cache_dir=cache_dir):
+    '''Projection matrix of a volume grid and the number of left hemisphere vertices, built once'''
+    path = cache_file(affine, shape, space, density, method, cache_dir)
+    if os.path.exists(path):
+        with np.load(path) as f:
+            return sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape'])), int(f['n_left'])
+    lh, rh = vertex_coords(space, density)
+    M = projection_matrix(np.concatenate([lh, rh]), affine, shape, method)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = path + '.tmp.npz'
+    np.savez(tmp, data=M.data, indices=M.indices, indptr=M.indptr, shape=np.array(M.shape), n_left=len(lh))
+    os.replace(tmp, path)
+    return M, len(lh)
+
+
+def load_maps(paths):
+    '''(n_voxels, n_maps) float32 stack of maps on one grid, with its affine and shape'''
+    first = nib.load(paths[0])
+    shape = first.shape[:3]
+    stack = np.empty((int(np.prod(shape)), len(paths)), dtype=np.float32)
+    for i, path in enumerate(paths):
+        img = nib.load(path)
+        if img.shape[:3] != shape or not np.allclose(img.affine, first.affine):
+            raise ValueError('{} is not on the grid of {}'.format(path, paths[0]))
+        stack[:, i] = np.asarray(img.dataobj, dtype=np.float32).reshape(shape).ravel()
+    return stack, first.affine, shape
+
+
+def project(paths, space='fsLR', density='32k', method='linear', cache_dir=cache_dir):
+    '''Left and right hemisphere data (n_vertices, n_maps) of all maps from one sparse product'''
+    stack, affine, shape = load_maps(paths)
+    M, n_left = cached_matrix(affine, shape, space, density, method, cache_dir)
+    surface = M @ stack
+    return surface[:n_left], surface[n_left:]
+
+
+def _init_renderer(space, density):
+    '''Fetch the surfaces once per worker; the display comes from the parent's DISPLAY'''
+    global _surfaces
+    from neuromaps.datasets import fetch_fsaverage, fetch_fslr
+    _surfaces = fetch_fslr(density) if space == 'fsLR' else fetch_fsaverage(density)
+
+
+def render(lh_data, rh_data, title, out_file, cmap='YlOrRd_r', cbar=True, cbar_kws=None, dpi=300):
+    '''surfplot figure of one map over the sulcal depth, as in surfplot.ipynb'''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from surfplot import Plot
+    lh, rh = _surfaces['inflated']
+    p = Plot(surf_lh=lh, surf_rh=rh)
+    sulc_lh, sulc_rh = _surfaces['sulc']
+    p.add_layer({'left': sulc_lh, 'right': sulc_rh}, cmap='binary_r', cbar=False)
+    p.add_layer({'left': lh_data, 'right': rh_data}, cmap=cmap, cbar=cbar)
+    fig = p.build(cbar_kws=cbar_kws or {'fontsize': 15, 'decimals': 1, 'aspect': 8, 'draw_border': False, 'pad': 0})
+    fig.suptitle(title, fontsize=15, fontweight='bold')
+    fig.savefig(out_file, dpi=dpi, bbox_inches='tight', pad_inches=0)
+    plt.close(fig)
+    return out_file
+
+
+def _render(args):
+    return render(*args)
+
+
+def render_all(paths, titles, out_files, space='fsLR', density='32k', method='linear', cmap='YlOrRd_r',
+               cache_dir=cache_dir, n_jobs=4):
+    '''Project all maps at once and render one figure per map in a pool of workers
+
+    One Xvfb display is started for the whole pool (the workers inherit
+    DISPLAY) and stopped when rendering ends or fails.
+    '''
+    from xvfbwrapper import Xvfb
+    lh, rh = project(paths, space, density, method, cache_dir)
+    jobs = [(lh[:, i], rh[:, i], title, out_file, cmap) for i, (title, out_file) in enumerate(zip(titles, out_files))]
+    with Xvfb():
+        with ProcessPoolExecutor(n_jobs, initializer=_init_renderer, initargs=(space, density)) as pool:
+            return list(pool.map(_render, jobs))
+
+
+def check(path, space='fsLR', density='32k', method='linear', cache_dir=cache_dir):
+    '''Largest difference of the cached projection from neuromaps' per-map projection, and both runtimes'''
+    from neuromaps.transforms import _vol_to_surf
+    start = time.perf_counter()
+    reference = [g.agg_data() for g in _vol_to_surf(path, space, density, method)]
+    neuromaps_s = time.perf_counter() - start
+    start = time.perf_counter()
+    lh, rh = project([path], space, density, method, cache_dir)
+    return {'max_abs_diff': max(np.abs(reference[0] - lh[:, 0]).max(), np.abs(reference[1] - rh[:, 0]).max()),
+            'neuromaps_s': neuromaps_s, 'cached_s': time.perf_counter() - start}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Project volume maps to the surface with a cached sparse matrix and render them')
+    parser.add_argument('-maps', nargs='+', default=[second_lv_maps + '{}/spmT_0001_thr.nii'.format(c)
+                                                     for c in contrast_mapper])
+    parser.add_argument('-titles', nargs='+', default=list(contrast_mapper.values()))
+    parser.add_argument('-space', choices=['fsLR', 'fsaverage'], default='fsLR')
+    parser.add_argument('-density', type=str, default='32k')
+    parser.add_argument('-method', choices=['linear', 'nearest'], default='linear')
+    parser.add_argument('-cmap', type=str, default='YlOrRd_r')
+    parser.add_argument('-cache_dir', type=str, default=cache_dir)
+    parser.add_argument('-out_dir', type=str, default=plot_dir)
+    parser.add_argument('-n_jobs', type=int, default=4)
+    parser.add_argument('-no_render', action='store_true', help='only project, writing left/right .npy arrays')
+    parser.add_argument('-check', action='store_true', help='compare the first map with neuromaps')
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    titles = args.titles if len(args.titles) == len(args.maps) else \
+        [os.path.basename(os.path.dirname(p)) for p in args.maps]
+    start = time.perf_counter()
+    if args.no_render:
+        lh, rh = project(args.maps, args.space, args.density, args.method, args.cache_dir)
+        np.save(os.path.join(args.out_dir, 'surface_lh.npy'), lh)
+        np.save(os.path.join(args.out_dir, 'surface_rh.npy'), rh)
+    else:
+        out_files = [os.path.join(args.out_dir, 'second_lv_{}.png'.format(t)) for t in titles]
+        render_all(args.maps, titles, out_files, args.space, args.density, args.method, args.cmap,
+                   args.cache_dir, args.n_jobs)
+    print('{} maps in {:.1f}s'.format(len(args.maps), time.perf_counter() - start))
+    if args.check:
+        print(check(args.maps[0], args.space, args.density, args.method, args.cache_dir))
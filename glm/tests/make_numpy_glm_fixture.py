@@ -0,0 +1,70 @@
+# Build the stored fixture for numpy_glm.check() and its pytest
+#
+# Writes a one-subject, two-run synthetic dataset (profiling/synthetic_bids.py)
+# on a 16 mm grid cropped to a few z-slices into <fixture>/bids, small enough
+# to commit. With -spm it also runs the SPM12 first-level pipelines
+# (first_lv_workflow.py; needs MATLAB + SPM12 via nipype) on that dataset and
+# copies their con/spmT images and SPM.mat into
+# <fixture>/1st_lv_smoothed_avgcond/sub-01 and
+# <fixture>/1st_lv_unsmoothed_avgcond/sub-01, which check() compares against.
+
+import os
+import sys
+import glob
+import shutil
+import argparse
+import tempfile
+import nibabel as nib
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(tests_dir, '..'))
+sys.path.insert(0, os.path.join(tests_dir, '..', '..', 'profiling'))
+from synthetic_bids import make_dataset
+
+fixture_dir = os.path.join(tests_dir, 'fixtures', 'numpy_glm')
+subject = 'sub-01'
+voxel_mm = 16
+slices = (5, 8)   # z-slices kept, through the middle of the brain mask
+
+
+def make_inputs(out_dir=fixture_dir, n_runs=2, seed=0):
+    '''Synthetic BIDS dataset cropped to `slices`, in out_dir/bids'''
+    bids = os.path.join(out_dir, 'bids')
+    if os.path.isdir(bids):
+        shutil.rmtree(bids)
+    make_dataset(bids, n_subjects=1, n_runs=n_runs, voxel_mm=voxel_mm, seed=seed)
+    for f in glob.glob(os.path.join(bids, 'derivatives', 'fmriprep', '*', '*', '*.nii.gz')):
+        img = nib.load(f)
+        cropped = img.slicer[:, :, slices[0]:slices[1]]
+        nib.save(nib.Nifti1Image(cropped.get_fdata(dtype='float32').astype(img.get_data_dtype()),
+                                 cropped.affine, cropped.header), f)
+    return bids
+
+
+def run_spm(out_dir=fixture_dir):
+    '''Run both SPM first-level pipelines on out_dir/bids and store their outputs'''
+    import first_lv_workflow as flw
+    work = tempfile.mkdtemp(prefix='numpy_glm_fixture_')
+    flw.experiment_dir = os.path.join(out_dir, 'bids')
+    flw.working_dir = os.path.join(work, 'work')
+    flw.output_dir = os.path.join(work, 'results')
+    for label, smoothed in [('1st_lv_smoothed_avgcond', True), ('1st_lv_unsmoothed_avgcond', False)]:
+        flw.build_first_lv([subject], smoothed=smoothed).run('Linear')
+        spm_dir = os.path.join(out_dir, label, subject)
+        os.makedirs(spm_dir, exist_ok=True)
+        for f in glob.glob(os.path.join(flw.output_dir, label, subject, '*')):
+            if os.path.basename(f).startswith(('con_', 'spmT_', 'SPM.mat')):
+                shutil.copy(f, spm_dir)
+    shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the numpy_glm check() fixture')
+    parser.add_argument('-out_dir', type=str, default=fixture_dir)
+    parser.add_argument('-spm', action='store_true',
+                        help='also run the SPM12 pipelines (MATLAB) and store their outputs')
+    args = parser.parse_args()
+
+    print(make_inputs(args.out_dir))
+    if args.spm:
+        run_spm(args.out_dir)
@@ -0,0 +1,71 @@
+# Tests of numpy_glm.py against the stored fixture (make_numpy_glm_fixture.py)
+#
+# Run from the repository root with `python -m pytest glm/tests`. The SPM
+# comparison needs the SPM12 outputs in the fixture (make_numpy_glm_fixture.py
+# -spm) and is skipped when they are missing.
+
+import os
+import sys
+import tempfile
+import numpy as np
+import nibabel as nib
+import pytest
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(tests_dir, '..'))
+# Keep the run cache of the fixture out of the shared one
+os.environ.setdefault('VIGNETTE_RUN_CACHE', tempfile.mkdtemp(prefix='numpy_glm_cache_'))
+from nipype.interfaces.base import Bunch
+import numpy_glm
+from numpy_glm import session_design, hrf_basis, run_subject, check, fmri_t, fmri_t0
+
+fixture_dir = os.path.join(tests_dir, 'fixtures', 'numpy_glm')
+subject = 'sub-01'
+spm_outputs = [os.path.join(fixture_dir, label, subject)
+               for label in ['1st_lv_smoothed_avgcond', '1st_lv_unsmoothed_avgcond']]
+
+
+def _run_info(onsets, durations):
+    return Bunch(conditions=['a'], onsets=[onsets], durations=[durations], regressor_names=[], regressors=[])
+
+
+def test_offsets_from_unclamped_onsets():
+    '''A trial starting before the first microtime bin keeps only the part after it'''
+    n_scans, dt = 100, numpy_glm.TR / fmri_t
+    X, _ = session_design(_run_info([-3.], [7.92]), n_scans)
+    ton = numpy_glm._round(-3. / dt) + 32
+    tof = numpy_glm._round(7.92 / dt) + ton
+    assert ton < 0 < tof
+    sf = np.zeros(n_scans * fmri_t + 32)
+    sf[:tof] = 1
+    expected = np.convolve(sf, hrf_basis()[:, 0])[np.arange(n_scans) * fmri_t + fmri_t0 + 31]
+    np.testing.assert_allclose(X[:, 0], expected)
+
+
+def test_derivative_orthogonal_after_sampling():
+    '''Each condition's sampled derivative column is orthogonal to its HRF column (spm_orth)'''
+    rng = np.random.default_rng(0)
+    onsets = np.sort(rng.uniform(-5, 450, 20)).tolist()
+    X, names = session_design(_run_info(onsets, [7.92] * 20), 668)
+    assert names == ['a*bf(1)', 'a*bf(2)']
+    assert abs(X[:, 0] @ X[:, 1]) < 1e-8 * np.linalg.norm(X[:, 0]) * np.linalg.norm(X[:, 1])
+
+
+@pytest.mark.parametrize('smoothed', [True, False])
+def test_fit_fixture(smoothed, tmp_path):
+    '''Both input pipelines fit the fixture slab by slab and write finite maps inside the mask'''
+    bids = os.path.join(fixture_dir, 'bids')
+    run_subject(subject, str(tmp_path), max_voxels=150, bids_dir=bids, smoothed=smoothed)
+    mask = np.asarray(nib.load(numpy_glm.mask_file(subject, bids)).dataobj) > 0
+    for i in range(1, len(numpy_glm.contrast_list) + 1):
+        for prefix in ['con', 'spmT']:
+            data = np.asarray(nib.load(str(tmp_path / '{}_{:04d}.nii'.format(prefix, i))).dataobj)
+            assert np.isfinite(data[mask]).all()
+
+
+@pytest.mark.skipif(not any(os.path.isdir(d) for d in spm_outputs),
+                    reason='no SPM12 outputs in the fixture (run make_numpy_glm_fixture.py -spm with MATLAB)')
+def test_check_against_spm():
+    '''Every con/spmT image is within check()'s default tolerances of SPM12'''
+    agreement = check(fixture_dir, subject, max_voxels=150)
+    assert agreement['pass'].all(), agreement.to_string(index=False)
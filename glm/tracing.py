@@ -0,0 +1,11 @@
+# Tracing hooks of the glm scripts
+#
+# The one place the glm modules put profiling/ on the path: stage(),
+# start_trace() and node_trace_args() come from profiling/instrument.py and
+# are imported from here.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'profiling'))
+from instrument import stage, start_trace, stop_trace, node_trace_args  # noqa: E402,F401
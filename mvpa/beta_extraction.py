@@ -0,0 +1,248 @@
+# Beta extraction from the first-level SPM.mat files
+#
+# PrepBetas.ipynb digs the regressor names out of spm_mat['SPM'][0][0][13]
+# (SPM.Vbeta) with repeated string splitting per regressor, opens every beta
+# with Brain_Data to z-score and write it, and prep_betas_nltools then
+# averages the runs by reading all written files again. Here each SPM.mat is
+# parsed once into a table (beta, file, run, regressor, condition); a
+# subject's selected betas are read once into one (n_betas, n_voxels)
+# array in Brain_Data voxel order, z-scored per map as
+# Brain_Data.standardize(axis=0, method='zscore') and averaged over runs in
+# memory. Runwise and mean maps are written under the PrepBetas file names
+# and, with -store, straight into beta stores (beta_store.py) without a
+# second read. Subjects run in a joblib process pool; each worker holds one
+# subject's betas at a time.
+
+import os
+import re
+import time
+import argparse
+import scipy.io
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from joblib import Parallel, delayed
+from beta_store import brain_mask_file, parcellation_file, sort_index, store_root, voxel_layout, _read
+
+## N.B. change path to respective input directory
+spm_dir = '/srv/lab/fmri/mft/fhopp_diss/analysis/vignettes/glm/spm/results/1st_lv_smoothed_ratings'
+runwise_dir = 'betas/runwise_avg_smooth_ratings_zscored'
+mean_dir = 'betas/condition_avg_smooth_ratings_zscored'
+
+f_mapper = {'carep': 'Physical Care', 'carem': 'Emotional Care',
+            'fair': 'Fairness', 'lib': 'Liberty', 'loy': 'Loyalty',
+            'auth': 'Authority', 'pur': 'Sanctity', 'socn': 'Social'}
+
+# Vbeta descrip, e.g. 'spm_spm:beta (0001) - Sn(1) carepMD*bf(1)'
+descrip_pattern = re.compile(r'beta \((\d+)\) - Sn\((\d+)\) (\S+)')
+
+sub_list = ['sub-' + '{0:0>2}'.format(x) for x in range(1, 65)]
+
+
+def regressor_table(sub, spm_dir=spm_dir):
+    '''One row per beta of a subject's SPM.mat: beta number, file, run, regressor and condition
+
+    condition is the f_mapper label of the rating-modulated ('MD') canonical
+    ('bf(1)') condition regressors and None for every other beta.
+    '''
+    spm = scipy.io.loadmat(os.path.join(spm_dir, sub, 'SPM.mat'),
+                           struct_as_record=False, squeeze_me=True)['SPM']
+    rows = []
+    for vbeta in np.atleast_1d(spm.Vbeta):
+        beta, run, name = descrip_pattern.search(vbeta.descrip).groups()
+        condition = None
+        if 'MD' in name and 'bf(1)' in name:
+            condition = next((v for k, v in f_mapper.items() if k in name), None)
+        rows.append({'subject': sub, 'beta': int(beta), 'run': int(run), 'regressor': name,
+                     'condition': condition,
+                     'file': os.path.join(spm_dir, sub, 'beta_{}.nii'.format(beta))})
+    return pd.DataFrame(rows)
+
+
+def zscore(rows):
+    '''z-score each row (map) across voxels, as sklearn's scale in Brain_Data.standardize'''
+    rows = rows - rows.mean(axis=1, keepdims=True)
+    std = rows.std(axis=1, keepdims=True)
+    return rows / np.where(std == 0, 1, std)
+
+
+def load_betas(files, ijk, affine, shape):
+    '''(n_files, n_voxels) float64 betas at voxels ijk, read into one preallocated array
+
+    Maps are resampled one at a time: nilearn clips a resampled image to the
+    range of its input, so a stacked 4D resample would differ from
+    Brain_Data. NaNs become 0 as in Brain_Data.
+    '''
+    betas = np.empty((len(files), len(ijk)))
+    for i, f in enumerate(files):
+        betas[i] = _read(f, ijk, affine, shape)[0]
+    return betas
+
+
+def runwise_name(out_dir, sub, condition, run):
+    return os.path.join(out_dir, '{}_{}_run_{}.nii'.format(sub, condition, run))
+
+
+def mean_name(out_dir, sub, condition):
+    return os.path.join(out_dir, '{}_{}_mean.nii'.format(sub, condition))
+
+
+def _write_nifti(path, values, ijk, affine, shape):
+    volume = np.zeros(shape, dtype=np.float32)
+    volume[ijk[:, 0], ijk[:, 1], ijk[:, 2]] = values
+    nib.save(nib.Nifti1Image(volume, affine), path)
+
+
+def _write_rows(store, rows, values, columns):
+    '''Write rows into the (not yet finalized) betas array of a store at `columns`'''
+    betas = np.load(store, mmap_mode='r+')
+    out = np.zeros((len(rows), betas.shape[1]), dtype=np.float32)
+    out[:, columns] = values
+    betas[rows] = out
+    betas.flush()
+
+
+def extract_subject(table, ijk, affine, shape, runwise_dir=runwise_dir, mean_dir=mean_dir,
+                    average='raw', stores=None):
+    '''Runwise and run-averaged z-scored maps of one subject's selected betas
+
+    table: the subject's rows of regressor_table with a condition
+    average: 'raw' averages the betas themselves (prep_betas, the SPM.mat
+        path), 'zscored' the z-scored runwise maps (prep_betas_nltools); the
+        mean is z-scored again
+    stores: optional {'runwise' | 'mean': (betas.npy path, rows, columns)}
+        giving where each output row goes in a store
+    '''
+    table = table.sort_values(['condition', 'run'])
+    betas = load_betas(list(table['file']), ijk, affine, shape)
+    runwise = zscore(betas)
+    source = runwise if average == 'zscored' else betas
+    conds = list(dict.fromkeys(table['condition']))
+    positions = table['condition'].map({c: i for i, c in enumerate(conds)}).to_numpy()
+    mean = np.zeros((len(conds), betas.shape[1]))
+    np.add.at(mean, positions, source)
+    mean = zscore(mean / np.bincount(positions)[:, None])
+
+    sub = table['subject'].iloc[0]
+    if runwise_dir:
+        for values, (condition, run) in zip(runwise, table[['condition', 'run']].values):
+            _write_nifti(runwise_name(runwise_dir, sub, condition, run), values, ijk, affine, shape)
+    if mean_dir:
+        for values, condition in zip(mean, conds):
+            _write_nifti(mean_name(mean_dir, sub, condition), values, ijk, affine, shape)
+    if stores:
+        for kind, values, keys in [('runwise', runwise, list(zip(table['condition'], table['run']))),
+                                   ('mean', mean, [(c, 0) for c in conds])]:
+            if kind in stores:
+                path, rows, columns = stores[kind]
+                _write_rows(path, [rows[(sub, c, r)] for c, r in keys], values, columns)
+    return sub, len(table)
+
+
+def _init_store(index, out_dir, layout):
+    '''Write index.csv and voxels.npz of a store and allocate its betas array
+
+    Returns the temporary betas path and {(subject, condition, run): row}.
+    '''
+    ijk, labels, affine, shape = layout
+    index = sort_index(index).reset_index(drop=True)
+    os.makedirs(out_dir, exist_ok=True)
+    tmp = os.path.join(out_dir, 'betas.tmp.npy')
+    np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=(len(index), len(ijk)))
+    np.savez(os.path.join(out_dir, 'voxels.npz'), ijk=ijk, labels=labels, affine=affine, shape=np.array(shape))
+    index.to_csv(os.path.join(out_dir, 'index.csv'), index=False)
+    rows = {key: row for row, key in enumerate(zip(index['subject'], index['condition'], index['run']))}
+    return tmp, rows
+
+
+def extract(subjects=sub_list, spm_dir=spm_dir, runwise_dir=runwise_dir, mean_dir=mean_dir,
+            average='raw', store=False, parcellation=parcellation_file, brain_mask=None, n_jobs=16):
+    '''Extract the condition betas of all subjects; returns the table of selected betas
+
+    With store=True the outputs also go to beta stores under betas/store named
+    after runwise_dir and mean_dir.
+    '''
+    table = pd.concat([regressor_table(sub, spm_dir) for sub in subjects], ignore_index=True)
+    table = table[table['condition'].notna()]
+    mask_img = nib.load(brain_mask or brain_mask_file())
+    ijk = np.argwhere(np.asarray(mask_img.dataobj) > 0)
+    affine, shape = mask_img.affine, mask_img.shape[:3]
+    for out_dir in [runwise_dir, mean_dir]:
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+
+    stores, store_dirs = {}, {}
+    if store:
+        layout = voxel_layout(parcellation, brain_mask)
+        # Store column of every brain-mask voxel
+        store_voxels = np.ravel_multi_index(layout[0].T, shape)
+        order = np.argsort(store_voxels)
+        columns = order[np.searchsorted(store_voxels, np.ravel_multi_index(ijk.T, shape), sorter=order)]
+        runwise_index = table[['subject', 'condition', 'run']].assign(
+            file=[runwise_name(runwise_dir, *key) for key in table[['subject', 'condition', 'run']].values])
+        mean_index = table[['subject', 'condition']].drop_duplicates().assign(run=0)
+        mean_index['file'] = [mean_name(mean_dir, *key) for key in mean_index[['subject', 'condition']].values]
+        for kind, index, out_dir in [('runwise', runwise_index, runwise_dir), ('mean', mean_index, mean_dir)]:
+            store_dirs[kind] = os.path.join(store_root, os.path.basename(os.path.normpath(out_dir)))
+            tmp, rows = _init_store(index, store_dirs[kind], layout)
+            stores[kind] = (tmp, rows, columns)
+
+    Parallel(n_jobs=n_jobs)(
+        delayed(extract_subject)(group, ijk, affine, shape, runwise_dir, mean_dir, average, stores)
+        for _, group in table.groupby('subject'))
+    for kind, (tmp, _, _) in stores.items():
+        os.replace(tmp, os.path.join(store_dirs[kind], 'betas.npy'))
+    return table
+
+
+def check(sub, spm_dir=spm_dir, runwise_dir=runwise_dir, mean_dir=mean_dir, average='raw'):
+    '''Largest differences of a subject's written runwise and mean maps from the notebook's Brain_Data path
+
+    The mean reference is Brain_Data(files).mean().standardize() over the
+    betas (average='raw', prep_betas) or the written runwise maps
+    (average='zscored', prep_betas_nltools).
+    '''
+    from nltools.data import Brain_Data
+    table = regressor_table(sub, spm_dir)
+    table = table[table['condition'].notna()]
+    diff = {'runwise': 0., 'mean': 0.}
+    for f, condition, run in table[['file', 'condition', 'run']].values:
+        ref = Brain_Data(f).standardize(axis=0, method='zscore').data
+        new = Brain_Data(runwise_name(runwise_dir, sub, condition, run)).data
+        diff['runwise'] = max(diff['runwise'], np.abs(ref - new).max())
+    for condition, group in table.groupby('condition'):
+        if average == 'raw':
+            files = list(group['file'])
+        else:
+            files = [runwise_name(runwise_dir, sub, condition, run) for run in group['run']]
+        # Stacked from single images: with recent nilearn a list of 3D paths
+        # is concatenated into one flat map
+        ref = Brain_Data([Brain_Data(f) for f in files]).mean().standardize(axis=0, method='zscore').data
+        new = Brain_Data(mean_name(mean_dir, sub, condition)).data
+        diff['mean'] = max(diff['mean'], np.abs(ref - new).max())
+    return diff
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract z-scored runwise and run-averaged condition betas from SPM.mat')
+    parser.add_argument('-spm_dir', type=str, default=spm_dir, help='first-level results with one folder per subject')
+    parser.add_argument('-runwise_dir', type=str, default=runwise_dir)
+    parser.add_argument('-mean_dir', type=str, default=mean_dir)
+    parser.add_argument('-subjects', nargs='+', default=sub_list)
+    parser.add_argument('-average', choices=['raw', 'zscored'], default='raw',
+                        help='average raw betas (prep_betas) or z-scored runwise maps (prep_betas_nltools)')
+    parser.add_argument('-store', action='store_true', help='also write beta stores under betas/store')
+    parser.add_argument('-parcellation', type=str, default=parcellation_file)
+    parser.add_argument('-n_jobs', type=int, default=16)
+    parser.add_argument('-check', action='store_true',
+                        help='compare the first subject\'s runwise and mean maps with the Brain_Data path')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    table = extract(args.subjects, args.spm_dir, args.runwise_dir, args.mean_dir, args.average,
+                    args.store, args.parcellation, n_jobs=args.n_jobs)
+    print('{} betas of {} subjects in {:.1f}s'.format(len(table), table['subject'].nunique(),
+                                                      time.perf_counter() - start))
+    if args.check:
+        diff = check(args.subjects[0], args.spm_dir, args.runwise_dir, args.mean_dir, args.average)
+        print('max abs difference from Brain_Data: runwise {runwise:.2e}, mean {mean:.2e}'.format(**diff))
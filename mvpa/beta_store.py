@@ -0,0 +1,247 @@
+# Pre-masked, memory-mappable store of beta maps
+#
+# run_mvpa.ipynb pickles a dict of full-volume Brain_Data objects and rsa.ipynb
+# and PrepBetas.ipynb re-glob and re-read hundreds of NIfTIs per subject. A
+# store is one directory holding
+#   betas.npy   float32 (n_observations, n_voxels), opened with mmap_mode='r'
+#   index.csv   subject, condition, run and source file of every row
+#   voxels.npz  voxel coordinates, parcel labels, affine and volume shape
+# Voxels are the MNI brain mask ordered by their k50_2mm parcel, so every
+# parcel is a contiguous column range and store.roi(parcel) is a zero-copy
+# view of the memmap. Rows are sorted by subject, run and condition, so all
+# rows of a subject are a contiguous slice as well.
+
+import os
+import glob
+import time
+import pickle
+import argparse
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from joblib import Parallel, delayed
+
+parcellation_file = '../rsa/k50_2mm.nii.gz'
+store_root = 'betas/store'
+
+# Condition labels as written by PrepBetas.ipynb, in analysis order
+conditions = ['Physical Care', 'Emotional Care', 'Fairness', 'Liberty',
+              'Loyalty', 'Authority', 'Sanctity', 'Social']
+
+
+def brain_mask_file():
+    '''nltools' default MNI 2mm brain mask, the voxel space of Brain_Data'''
+    from nltools.prefs import MNI_Template
+    return MNI_Template['mask']
+
+
+def expand_mask_label(labels, parcel):
+    '''Label value of parcel number `parcel` as numbered by nltools' expand_mask
+
+    expand_mask compares the data with the positions of the non-zero entries
+    of np.unique(data), which are the label values for labels 1..n.
+    '''
+    return int(np.flatnonzero(np.unique(labels))[parcel])
+
+
+def parse_name(path):
+    '''Subject, condition and run (0 = averaged over runs) from a PrepBetas file name
+
+    Runwise maps are {sub}_{condition}_run_{n}.nii, averaged maps
+    {sub}_{condition}_mean.nii.
+    '''
+    parts = os.path.basename(path).split('.')[0].split('_')
+    run = int(parts[3]) if len(parts) > 3 and parts[2] == 'run' else 0
+    condition = {'Social Norms': 'Social'}.get(parts[1], parts[1])
+    return {'subject': parts[0], 'condition': condition, 'run': run, 'file': path}
+
+
+def voxel_layout(parcellation=parcellation_file, brain_mask=None):
+    '''Brain-mask voxels sorted by parcel
+
+    Returns the (n_voxels, 3) voxel indices, the parcel label of each column
+    (0 for brain voxels outside the parcellation, stored last), the affine and
+    the volume shape.
+    '''
+    mask_img = nib.load(brain_mask or brain_mask_file())
+    mask = np.asarray(mask_img.dataobj) > 0
+    parcels = nib.load(parcellation)
+    if parcels.shape[:3] != mask.shape or not np.allclose(parcels.affine, mask_img.affine):
+        from nilearn.image import resample_to_img
+        parcels = resample_to_img(parcels, mask_img, interpolation='nearest')
+    labels = np.rint(np.asarray(parcels.dataobj)).astype(np.int32)
+    mask |= labels > 0
+    ijk = np.argwhere(mask)
+    column_labels = labels[mask]
+    # Parcels in label order, unassigned voxels at the end; stable within parcel
+    order = np.argsort(np.where(column_labels > 0, column_labels, column_labels.max() + 1), kind='stable')
+    return ijk[order], column_labels[order], mask_img.affine, mask.shape
+
+
+def _read(path, ijk, affine, shape):
+    '''One (or a 4D stack of) image(s) as float32 rows in store voxel order
+
+    path is a file, an image, or a (values, mask image) pair of Brain_Data voxels.
+    '''
+    if isinstance(path, tuple):
+        values, mask = path
+        volume = np.zeros(mask.shape[:3], dtype=np.float32)
+        volume[np.asarray(mask.dataobj) > 0] = values
+        path = nib.Nifti1Image(volume, mask.affine)
+    img = nib.load(path) if isinstance(path, str) else path
+    if img.shape[:3] != tuple(shape) or not np.allclose(img.affine, affine):
+        from nilearn.image import resample_img
+        img = resample_img(img, target_affine=affine, target_shape=shape)
+    data = np.asarray(img.dataobj, dtype=np.float32)
+    rows = data[ijk[:, 0], ijk[:, 1], ijk[:, 2]]
+    return np.nan_to_num(rows.T if rows.ndim > 1 else rows[None])
+
+
+def sort_index(index):
+    '''Rows in store order: subject, run, then condition in analysis order'''
+    order = {c: i for i, c in enumerate(conditions)}
+    index = index.assign(_c=index['condition'].map(lambda c: order.get(c, len(order))))
+    return index.sort_values(['subject', 'run', '_c', 'condition']).drop(columns='_c')
+
+
+def build_store(index, out_dir, images=None, parcellation=parcellation_file, brain_mask=None,
+                n_jobs=8, batch=64):
+    '''Write a store from an index with one row per image
+
+    index: DataFrame with subject, condition, run and file columns; images
+    optionally gives in-memory images for its rows instead of reading `file`.
+    Images are read in parallel batches of `batch` and written straight into
+    the memmap, so memory stays bounded by one batch.
+    '''
+    ijk, labels, affine, shape = voxel_layout(parcellation, brain_mask)
+    images = list(index['file']) if images is None else list(images)
+    index = sort_index(index.reset_index(drop=True))
+    images = [images[i] for i in index.index]
+    index = index.reset_index(drop=True)
+
+    os.makedirs(out_dir, exist_ok=True)
+    tmp = os.path.join(out_dir, 'betas.tmp.npy')
+    betas = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=(len(index), len(ijk)))
+    with Parallel(n_jobs=n_jobs) as parallel:
+        for start in range(0, len(index), batch):
+            chunk = images[start:start + batch]
+            betas[start:start + len(chunk)] = np.concatenate(
+                parallel(delayed(_read)(img, ijk, affine, shape) for img in chunk))
+    betas.flush()
+    del betas
+    os.replace(tmp, os.path.join(out_dir, 'betas.npy'))
+    np.savez(os.path.join(out_dir, 'voxels.npz'), ijk=ijk, labels=labels,
+             affine=affine, shape=np.array(shape))
+    index.to_csv(os.path.join(out_dir, 'index.csv'), index=False)
+    return BetaStore(out_dir)
+
+
+def store_from_dir(betas_dir, out_dir, **kwargs):
+    '''Store of every PrepBetas image in a directory (e.g. betas/runwise_avg_smooth_zscored)'''
+    files = sorted(f for f in glob.glob(os.path.join(betas_dir, 'sub-*')) if f.endswith(('.nii', '.nii.gz')))
+    return build_store(pd.DataFrame([parse_name(f) for f in files]), out_dir, **kwargs)
+
+
+def store_from_pickle(pkl, out_dir, **kwargs):
+    '''Store of a pickled {condition: Brain_Data} dict such as avg_betas_smoothed_zscored.pkl
+
+    Image i of each Brain_Data is subject sub-{i+1:02d}, as in run_mvpa.ipynb.
+    '''
+    with open(pkl, 'rb') as f:
+        imgs = pickle.load(f)
+    index, images = [], []
+    for condition, img in imgs.items():
+        for i, values in enumerate(np.atleast_2d(img.data)):
+            index.append({'subject': 'sub-{:02d}'.format(i + 1),
+                          'condition': parse_name('x_' + condition)['condition'], 'run': 0, 'file': pkl})
+            images.append((values, img.mask))
+    return build_store(pd.DataFrame(index), out_dir, images=images, **kwargs)
+
+
+class BetaStore(object):
+    '''Read-only view of a store directory
+
+    Args:
+        store_dir: directory written by build_store
+        mmap_mode: passed to np.load ('r' maps the array without reading it)
+    '''
+
+    def __init__(self, store_dir, mmap_mode='r'):
+        self.store_dir = store_dir
+        self.data = np.load(os.path.join(store_dir, 'betas.npy'), mmap_mode=mmap_mode)
+        self.index = pd.read_csv(os.path.join(store_dir, 'index.csv'))
+        with np.load(os.path.join(store_dir, 'voxels.npz')) as voxels:
+            self.ijk = voxels['ijk']
+            self.labels = voxels['labels']
+            self.affine = voxels['affine']
+            self.shape = tuple(voxels['shape'])
+        # Column range of every parcel label
+        self.parcel_labels = np.unique(self.labels[self.labels > 0])
+        starts = np.searchsorted(self.labels[self.labels > 0], self.parcel_labels, side='left')
+        stops = np.searchsorted(self.labels[self.labels > 0], self.parcel_labels, side='right')
+        self.bounds = {int(label): (int(a), int(b)) for label, a, b in zip(self.parcel_labels, starts, stops)}
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def subjects(self):
+        return list(self.index['subject'].unique())
+
+    def parcel_label(self, parcel):
+        '''Label value of a parcel number as used by expand_mask (and moral_rois)'''
+        return expand_mask_label(self.labels, parcel)
+
+    def columns(self, parcel):
+        '''Column slice of one parcel (expand_mask numbering)'''
+        return slice(*self.bounds.get(self.parcel_label(parcel), (0, 0)))
+
+    def roi(self, parcel, rows=slice(None)):
+        '''Betas of one parcel; a view of the memmap when rows is a slice'''
+        return self.data[rows, self.columns(parcel)]
+
+    def mask_columns(self, img, threshold=0):
+        '''Columns of the voxels where a mask image (file or image) is above threshold'''
+        values = _read(img, self.ijk, self.affine, self.shape)[0]
+        return np.flatnonzero(values > threshold)
+
+    def rows(self, subject=None, condition=None, run=None):
+        '''Row positions matching the given subject, condition and run'''
+        keep = np.ones(len(self.index), dtype=bool)
+        for column, value in [('subject', subject), ('condition', condition), ('run', run)]:
+            if value is not None:
+                keep &= self.index[column].isin(np.atleast_1d(value)).to_numpy()
+        return np.flatnonzero(keep)
+
+    def subject_rows(self, subject):
+        '''Contiguous row slice of one subject'''
+        rows = self.rows(subject=subject)
+        return slice(int(rows[0]), int(rows[-1]) + 1)
+
+    def volume(self, values):
+        '''Scatter a vector in store voxel order back into a 3D Nifti1Image'''
+        img = np.zeros(self.shape, dtype=np.float32)
+        img[self.ijk[:, 0], self.ijk[:, 1], self.ijk[:, 2]] = values
+        return nib.Nifti1Image(img, self.affine)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build a pre-masked beta store from PrepBetas output or a pickled dict')
+    parser.add_argument('-source', type=str, required=True,
+                        help='directory of beta images or a pickled {condition: Brain_Data} dict')
+    parser.add_argument('-out_dir', type=str, default=None)
+    parser.add_argument('-parcellation', type=str, default=parcellation_file)
+    parser.add_argument('-n_jobs', type=int, default=8)
+    args = parser.parse_args()
+
+    out_dir = args.out_dir or os.path.join(store_root, os.path.basename(os.path.normpath(args.source)).split('.')[0])
+    start = time.perf_counter()
+    if args.source.endswith('.pkl'):
+        store = store_from_pickle(args.source, out_dir, parcellation=args.parcellation, n_jobs=args.n_jobs)
+    else:
+        store = store_from_dir(args.source, out_dir, parcellation=args.parcellation, n_jobs=args.n_jobs)
+    built = time.perf_counter() - start
+    start = time.perf_counter()
+    store = BetaStore(out_dir)
+    print('{} rows x {} voxels ({} parcels) built in {:.1f}s, opened in {:.1f}ms'.format(
+        len(store), store.data.shape[1], len(store.bounds), built, 1000 * (time.perf_counter() - start)))
@@ -0,0 +1,193 @@
+# Label-permutation nulls for LOSO forced-choice decoding accuracies
+#
+# The binomial p-values of Roc(..., forced_choice=subject_id) in run_mvpa.ipynb
+# assume independent trials. Here the null comes from refitting the same LOSO
+# folds with each subject's two condition labels swapped at random (the
+# exchangeable unit in a forced-choice design). Every ROI's linear kernel over
+# all (conditions x subjects) images is computed once; a fold of any pair is a
+# sub-block of it (kernel_decoding.py). With -method ridge (the default) the
+# held-out decision values are a fixed linear map of the labels, so a whole
+# chunk of permutations is one matrix product per pair and ROI; -method svm
+# refits a precomputed-kernel SVC on 126 samples for every fold of every
+# permutation, pair and ROI, which is orders of magnitude slower. Forced-choice
+# accuracies come from the held-out distances in vectorized form, and the
+# maximum over pairs x ROIs gives FWE-corrected p-values.
+# Permutations are processed in chunks, each written to disk as soon as it
+# finishes; a rerun with the same settings skips finished chunks.
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from itertools import combinations
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from scipy.stats import binomtest
+from threadpoolctl import threadpool_limits
+from beta_store import BetaStore, conditions
+from kernel_decoding import pair_rows, ridge_alpha, ridge_operator, svm_loso
+from parcel_index import store_index
+
+avg_store = 'betas/store/condition_avg_smooth_zscored'
+perm_dir = 'r&r_results/fc_permutation'
+
+_shared = {}
+
+
+def roi_kernels(store, index, include_whole_brain=True):
+    '''Linear kernels (n_rois, n_conditions * n_subjects, n_conditions * n_subjects) of the condition-average betas
+
+    Observations are ordered condition-major (condition c, subject s at c * S + s).
+    Raises if any subject lacks a condition-average image.
+    '''
+    table = store.index[store.index['run'] == 0]
+    subjects = sorted(table['subject'].unique())
+    rows = np.full((len(conditions), len(subjects)), -1)
+    for row, (subject, condition) in zip(table.index, table[['subject', 'condition']].values):
+        rows[conditions.index(condition), subjects.index(subject)] = row
+    missing = [(subjects[s], conditions[c]) for c, s in zip(*np.nonzero(rows < 0))]
+    if missing:
+        raise ValueError('{} has no condition-average image for (subject, condition) {}'.format(
+            store.store_dir, missing))
+    X = np.asarray(store.data[rows.ravel()], dtype=np.float64)
+    names, kernels = [], []
+    if include_whole_brain:
+        names.append('Whole Brain')
+        kernels.append(X @ X.T)
+    for name, data in index.gather(X).items():
+        names.append(name)
+        kernels.append(data @ data.T)
+    return names, subjects, np.stack(kernels)
+
+
+def swaps(n_subjects, n_perm, seed=0, chunk=0):
+    '''(n_perm, n_subjects) label swaps for one chunk; row 0 of chunk 0 is the observed labelling'''
+    rng = np.random.default_rng([seed, chunk])
+    flips = rng.random((n_perm, n_subjects)) < 0.5
+    if chunk == 0:
+        flips[0] = False
+    return flips
+
+
+def forced_choice_accuracy(d_first, d_second, swapped):
+    '''Vectorized forced-choice accuracy over the last (subject) axis
+
+    d_first / d_second are the held-out distances of each subject's first- and
+    second-condition image; where swapped, the second image carries label 1.
+    '''
+    return np.mean((d_first > d_second) != swapped, axis=-1)
+
+
+def _attach(name, shape):
+    threadpool_limits(1)
+    shm = shared_memory.SharedMemory(name=name)
+    _shared.update(shm=shm, K=np.ndarray(shape, dtype=np.float64, buffer=shm.buf))
+
+
+def _chunk(chunk, n_perm, seed, pairs, n_subjects, method='ridge', alpha=ridge_alpha):
+    '''Forced-choice accuracies (n_perm, n_rois, n_pairs) of one chunk of label swaps'''
+    K = _shared['K']
+    S = n_subjects
+    flips = swaps(S, n_perm, seed, chunk)
+    labels = np.concatenate([~flips, flips], axis=1)                  # (n_perm, 2S), True = label 1
+    out = np.empty((n_perm, K.shape[0], len(pairs)))
+    for p, (a, b) in enumerate(pairs):
+        obs = pair_rows(a, b, S)
+        for r in range(K.shape[0]):
+            if method == 'ridge':
+                d = ridge_operator(K[r][np.ix_(obs, obs)], alpha) @ np.where(labels, 1., -1.).T
+                out[:, r, p] = forced_choice_accuracy(d[:S].T, d[S:].T, flips)
+            else:
+                for k, y in enumerate(labels.astype(float)):
+                    d = svm_loso(K[r], obs, y)
+                    out[k, r, p] = forced_choice_accuracy(d[0], d[1], flips[k])
+    return chunk, out
+
+
+def _save(path, array):
+    np.save(path + '.tmp.npy', array)
+    os.replace(path + '.tmp.npy', path)
+
+
+def run(store_dir=avg_store, out_dir=perm_dir, n_perm=1000, chunk_size=50, n_jobs=None, seed=0,
+        include_whole_brain=True, method='ridge', alpha=ridge_alpha):
+    '''Observed accuracies, per-cell and max-statistic permutation p-values
+
+    Finished chunks in out_dir/chunks are reused when config.json matches.
+    '''
+    start = time.perf_counter()
+    config = {'store': os.path.abspath(store_dir), 'n_perm': n_perm, 'chunk_size': chunk_size,
+              'seed': seed, 'whole_brain': include_whole_brain, 'method': method,
+              'alpha': alpha if method == 'ridge' else None}
+    chunk_dir = os.path.join(out_dir, 'chunks')
+    os.makedirs(chunk_dir, exist_ok=True)
+    config_file = os.path.join(out_dir, 'config.json')
+    if os.path.exists(config_file):
+        with open(config_file) as f:
+            if json.load(f) != config:
+                raise ValueError('{} holds a run with other settings; use another -out_dir'.format(out_dir))
+    with open(config_file, 'w') as f:
+        json.dump(config, f, indent=1)
+
+    store = BetaStore(store_dir)
+    names, subjects, K = roi_kernels(store, store_index(store), include_whole_brain)
+    S = len(subjects)
+    pairs = list(combinations(range(len(conditions)), 2))
+    sizes = [min(chunk_size, n_perm - p0) for p0 in range(0, n_perm, chunk_size)]
+    todo = [c for c in range(len(sizes)) if not os.path.exists(os.path.join(chunk_dir, '{:05d}.npy'.format(c)))]
+    print('{} of {} chunks left'.format(len(todo), len(sizes)))
+
+    if todo:
+        shm = shared_memory.SharedMemory(create=True, size=K.nbytes)
+        try:
+            np.ndarray(K.shape, dtype=np.float64, buffer=shm.buf)[:] = K
+            with ProcessPoolExecutor(max_workers=n_jobs or os.cpu_count(), initializer=_attach,
+                                     initargs=(shm.name, K.shape)) as pool:
+                futures = [pool.submit(_chunk, c, sizes[c], seed, pairs, S, method, alpha) for c in todo]
+                for future in as_completed(futures):
+                    c, acc = future.result()
+                    _save(os.path.join(chunk_dir, '{:05d}.npy'.format(c)), acc)
+        finally:
+            shm.close()
+            shm.unlink()
+
+    null = np.concatenate([np.load(os.path.join(chunk_dir, '{:05d}.npy'.format(c))) for c in range(len(sizes))])
+    observed = null[0]
+    max_null = null.reshape(len(null), -1).max(axis=1)
+    rows = []
+    for r, name in enumerate(names):
+        for p, (a, b) in enumerate(pairs):
+            acc = observed[r, p]
+            rows.append({'roi': name, 'condition_a': conditions[a], 'condition_b': conditions[b],
+                         'accuracy': acc,
+                         'p_binomial': binomtest(int(round(acc * S)), S, p=0.5).pvalue,
+                         'p_perm': np.mean(null[:, r, p] >= acc),
+                         'p_fwe': np.mean(max_null >= acc)})
+    results = pd.DataFrame(rows)
+    results.to_csv(os.path.join(out_dir, 'fc_permutation.csv'), index=False)
+    print('{} permutations x {} ROIs x {} pairs in {:.1f}s'.format(n_perm, len(names), len(pairs),
+                                                                   time.perf_counter() - start))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Permutation nulls with max-statistic correction for forced-choice accuracies')
+    parser.add_argument('-store', type=str, default=avg_store, help='condition-average beta store')
+    parser.add_argument('-out_dir', type=str, default=perm_dir)
+    parser.add_argument('-n_perm', type=int, default=1000, help='permutations including the observed labelling')
+    parser.add_argument('-chunk', type=int, default=50, help='permutations per checkpointed chunk')
+    parser.add_argument('-n_jobs', type=int, default=None)
+    parser.add_argument('-seed', type=int, default=0)
+    parser.add_argument('-no_whole_brain', action='store_true')
+    parser.add_argument('-method', choices=['ridge', 'svm'], default='ridge',
+                        help='ridge: exact LOSO shortcut, one solve per pair and ROI; svm: refits an SVC for '
+                             'every fold of every permutation, pair and ROI (n_perm x 28 x ROIs x subjects fits, '
+                             '~29M for the default 1000 permutations)')
+    parser.add_argument('-alpha', type=float, default=ridge_alpha)
+    args = parser.parse_args()
+
+    results = run(args.store, args.out_dir, args.n_perm, args.chunk, args.n_jobs, args.seed,
+                  include_whole_brain=not args.no_whole_brain, method=args.method, alpha=args.alpha)
+    print(results.sort_values('p_fwe').head(20).to_string(index=False))
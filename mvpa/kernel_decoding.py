@@ -0,0 +1,154 @@
+# Kernel-space LOSO decoding of the 28 condition pairs
+#
+# Each pairwise decode has 128 observations (64 subjects x 2 conditions) and
+# ~200k voxels, so everything a linear classifier needs is in the linear
+# kernel. The (8 x 64) x (8 x 64) Gram matrix of all condition-average betas
+# is computed once; every pair and LOSO fold is a sub-block of it.
+#   svm   - SVC(kernel='precomputed') per fold, the same fits as nltools'
+#           linear 'svm' (and pairwise_decoding.py) on 128 x 128 inputs
+#   ridge - ridge classification (+/-1 targets, unpenalized intercept) with the
+#           exact leave-one-subject-out shortcut: with hat matrix H, the
+#           held-out residuals of subject g are (I - H_gg)^-1 (y_g - (Hy)_g),
+#           so all 64 folds of a pair come from one 128 x 128 solve. The
+#           held-out decision values are a fixed linear map of the labels,
+#           which also makes label-permutation nulls a single matrix product.
+# Both return held-out distances compatible with Roc(..., forced_choice=...).
+
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from itertools import combinations
+from sklearn.svm import SVC
+from pairwise_decoding import conditions, decode_pairs as pooled_pairs, forced_choice, load_stack, \
+    synthetic_stack, avg_betas_pkl, results_dir, stage
+
+ridge_alpha = 1.0
+
+
+def gram(stack):
+    '''Linear kernel of a (n_conditions, n_subjects, n_voxels) stack, rows condition-major'''
+    X = np.asarray(stack, dtype=np.float64).reshape(-1, stack.shape[-1])
+    return X @ X.T
+
+
+def pair_rows(a, b, n_subjects):
+    '''Kernel rows of condition a's subjects followed by condition b's'''
+    return np.concatenate([a * n_subjects + np.arange(n_subjects), b * n_subjects + np.arange(n_subjects)])
+
+
+def svm_loso(K, obs, y, C=1.0):
+    '''LOSO held-out distances (2, n_subjects) of a pair with labels y (1/0), from kernel K'''
+    S = len(obs) // 2
+    d = np.empty((2, S))
+    for s in range(S):
+        test = [s, S + s]
+        train = np.delete(np.arange(2 * S), test)
+        svm = SVC(kernel='precomputed', C=C).fit(K[np.ix_(obs[train], obs[train])], y[train])
+        d[:, s] = svm.decision_function(K[np.ix_(obs[test], obs[train])])
+    return d
+
+
+def ridge_operator(K_pair, alpha=ridge_alpha):
+    '''(2S, 2S) map from +/-1 labels to LOSO held-out ridge decision values
+
+    K_pair is the kernel of one pair (first condition's subjects, then the
+    second's); subject s owns rows s and S + s.
+    '''
+    n = len(K_pair)
+    S = n // 2
+    centre = np.eye(n) - 1. / n
+    Kc = centre @ K_pair @ centre
+    H = 1. / n + Kc @ np.linalg.solve(Kc + alpha * np.eye(n), centre)
+    groups = np.stack([np.arange(S), S + np.arange(S)], axis=1)            # (S, 2)
+    I_Hgg = np.eye(2) - H[groups[:, :, None], groups[:, None, :]]         # (S, 2, 2)
+    # held-out = y_g - (I - H_gg)^-1 ((I - H) y)_g
+    L = np.eye(n)
+    L[groups] -= np.linalg.solve(I_Hgg, (np.eye(n) - H)[groups])
+    return L
+
+
+def ridge_loso(K, obs, y, alpha=ridge_alpha):
+    '''LOSO held-out ridge decision values (2, n_subjects) of a pair with labels y (1/0)'''
+    d = ridge_operator(K[np.ix_(obs, obs)], alpha) @ (2. * y - 1)
+    return d.reshape(2, -1)
+
+
+def decode_pairs(K, n_subjects, labels=list(conditions), method='ridge', alpha=ridge_alpha, C=1.0):
+    '''Forced-choice LOSO decoding of every condition pair from one Gram matrix
+
+    Returns (table, accuracy, dists) as pairwise_decoding.decode_pairs. All
+    LOSO folds of a pair come from one block of K and are traced together.
+    '''
+    S = n_subjects
+    y = np.concatenate([np.ones(S), np.zeros(S)])
+    rows, dists = [], {}
+    accuracy = pd.DataFrame(index=labels, columns=labels, dtype=float)
+    for a, b in combinations(range(len(labels)), 2):
+        obs = pair_rows(a, b, S)
+        with stage('decoding fold', pair='{}-{}'.format(a, b), folds=S, method=method):
+            d = svm_loso(K, obs, y, C) if method == 'svm' else ridge_loso(K, obs, y, alpha)
+        d = d.ravel()
+        fc = forced_choice(d, S)
+        rows.append(dict(condition_a=labels[a], condition_b=labels[b], **fc))
+        accuracy.at[labels[a], labels[b]] = accuracy.at[labels[b], labels[a]] = fc['accuracy']
+        dists[(labels[a], labels[b])] = d
+    return pd.DataFrame(rows), accuracy, dists
+
+
+def benchmark(n_subjects=64, n_voxels=20000, alpha=ridge_alpha, seed=0):
+    '''Runtime of pooled libsvm fits versus kernel SVM and ridge, with agreement checks'''
+    from sklearn.linear_model import RidgeClassifier
+    stack = synthetic_stack(n_subjects, n_voxels, seed=seed)
+    S = n_subjects
+    row = {'subjects': S, 'voxels': n_voxels}
+
+    start = time.perf_counter()
+    pooled, _, pooled_dists = pooled_pairs(stack, n_jobs=1)
+    row['libsvm_s'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    K = gram(stack)
+    row['gram_s'] = time.perf_counter() - start
+    start = time.perf_counter()
+    svm, _, svm_dists = decode_pairs(K, S, method='svm')
+    row['kernel_svm_s'] = row['gram_s'] + time.perf_counter() - start
+    start = time.perf_counter()
+    ridge, _, ridge_dists = decode_pairs(K, S, method='ridge', alpha=alpha)
+    row['ridge_s'] = row['gram_s'] + time.perf_counter() - start
+
+    row['svm_max_dist_diff'] = max(np.abs(svm_dists[k] - pooled_dists[k]).max() for k in svm_dists)
+    row['svm_max_acc_diff'] = np.abs(svm['accuracy'] - pooled['accuracy']).max()
+
+    # Ridge shortcut against explicit refits for the first pair
+    X = stack[:2].reshape(2 * S, -1)
+    y = np.concatenate([np.ones(S), np.zeros(S)])
+    explicit = np.empty((2, S))
+    for s in range(S):
+        train = np.delete(np.arange(2 * S), [s, S + s])
+        explicit[:, s] = RidgeClassifier(alpha=alpha).fit(X[train], y[train]).decision_function(X[[s, S + s]])
+    row['ridge_max_dist_diff'] = np.abs(explicit.ravel() - ridge_dists[tuple(list(conditions)[:2])]).max()
+    row['ridge_mean_acc'] = ridge['accuracy'].mean()
+    row['svm_mean_acc'] = svm['accuracy'].mean()
+    return row
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Kernel-space LOSO forced-choice decoding of all condition pairs')
+    parser.add_argument('-source', type=str, default=avg_betas_pkl,
+                        help='beta store, pickled dict of Brain_Data or directory of condition betas')
+    parser.add_argument('-method', choices=['ridge', 'svm'], default='ridge')
+    parser.add_argument('-alpha', type=float, default=ridge_alpha)
+    parser.add_argument('-out', type=str, default=None, help='csv of pairwise accuracies')
+    parser.add_argument('-benchmark', action='store_true', help='compare with pooled libsvm fits on synthetic data')
+    parser.add_argument('-voxels', type=int, default=20000)
+    args = parser.parse_args()
+
+    if args.benchmark:
+        print(pd.Series(benchmark(n_voxels=args.voxels, alpha=args.alpha)).to_string())
+    else:
+        stack = load_stack(args.source)
+        table, accuracy, _ = decode_pairs(gram(stack), stack.shape[1], method=args.method, alpha=args.alpha)
+        table.to_csv(args.out or os.path.join(results_dir, 'loso_wb_fc_acc_{}.csv'.format(args.method)), index=False)
+        print(accuracy.round(3).to_string())
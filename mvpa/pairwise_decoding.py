@@ -0,0 +1,217 @@
+# Leave-one-subject-out SVM decoding of all 28 moral condition pairs
+#
+# run_mvpa.ipynb rebuilds data = A.append(B) for every pair and calls
+# Brain_Data.predict, copying the (128, n_voxels) matrix 28 times and fitting
+# 28 x 64 SVMs one after another. Here the (8 conditions, 64 subjects,
+# n_voxels) beta stack is loaded once into shared memory and every pair x
+# held-out subject fit is a task for a process pool; workers read their
+# training rows straight from the shared stack. Each fold is the same
+# SVC(kernel='linear') as nltools' 'svm' algorithm, so the cross-validated
+# distances from the hyperplane and the forced-choice accuracies equal those
+# of data.predict(...) + Roc(..., forced_choice=subject_id).
+
+import os
+import sys
+import glob
+import time
+import pickle
+import argparse
+import numpy as np
+import pandas as pd
+from itertools import combinations
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from scipy.stats import binomtest
+from sklearn.svm import SVC
+from threadpoolctl import threadpool_limits
+from beta_store import BetaStore, parse_name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'profiling'))
+from instrument import stage
+
+betas_dir = 'betas/condition_avg_smooth_zscored/'
+avg_betas_pkl = 'r&r_results/avg_betas_smoothed_zscored.pkl'
+neurosynth_mask = 'masks/moral_uniformity-test_z_FDR_0.01.nii.gz'
+results_dir = 'r&r_results'
+
+# Condition labels and the file name keys of their beta images
+conditions = {'Physical Care': 'Phys',
+              'Emotional Care': 'Emo',
+              'Fairness': 'Fair',
+              'Liberty': 'Lib',
+              'Loyalty': 'Loy',
+              'Authority': 'Auth',
+              'Sanctity': 'Sanc',
+              'Social Norms': 'Soc'}
+
+_shared = {}
+
+
+def load_stack(source=avg_betas_pkl, mask=None, dtype=np.float64):
+    '''(n_conditions, n_subjects, n_voxels) beta stack in the order of `conditions`
+
+    source is a beta store (beta_store.py), the pickled dict of Brain_Data
+    (avg_betas_smoothed_zscored.pkl) or a directory of per-subject condition
+    betas. mask is an optional Brain_Data (e.g. the thresholded Neurosynth moral
+    map) selecting voxels.
+    '''
+    if os.path.exists(os.path.join(source, 'betas.npy')):
+        store = BetaStore(source)
+        columns = slice(None) if mask is None else store.mask_columns(mask.to_nifti())
+        rows = [store.rows(condition=parse_name('x_' + label)['condition'], run=0) for label in conditions]
+        return np.stack([np.asarray(store.data[r][:, columns], dtype=dtype) for r in rows])
+    if source.endswith('.pkl'):
+        with open(source, 'rb') as f:
+            imgs = pickle.load(f)
+    else:
+        from nltools.data import Brain_Data
+        imgs = {label: Brain_Data(sorted(glob.glob(os.path.join(source, '*' + key + '*'))))
+                for label, key in conditions.items()}
+    if mask is not None:
+        imgs = {label: img.apply_mask(mask) for label, img in imgs.items()}
+    return np.stack([np.asarray(imgs[label].data, dtype=dtype) for label in conditions])
+
+
+def forced_choice(dist, n_subjects):
+    '''Forced-choice accuracy of cross-validated distances, as nltools Roc(forced_choice=...)
+
+    dist holds the first condition's 64 subjects followed by the second's. Roc
+    centres each subject's pair on its mean and thresholds at 0, so a subject is
+    correct when its first-condition image is further on the positive side.
+    '''
+    correct = dist[:n_subjects] > dist[n_subjects:]
+    n = len(correct)
+    return {'accuracy': correct.mean(),
+            'accuracy_se': np.sqrt(correct.mean() ** 2 / n),
+            'accuracy_p': binomtest(int(correct.sum()), n, p=0.5).pvalue}
+
+
+def _attach(name, shape, dtype):
+    '''Process pool initializer: map the shared beta stack'''
+    threadpool_limits(1)
+    shm = shared_memory.SharedMemory(name=name)
+    _shared.update(shm=shm, X=np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+
+def _fold(a, b, held_out, C=1.0):
+    '''Fit condition a (1) vs b (0) without one subject; distances of its two images'''
+    X = _shared['X']
+    with stage('decoding fold', pair='{}-{}'.format(a, b), held_out=int(held_out)):
+        train = np.arange(X.shape[1]) != held_out
+        svm = SVC(kernel='linear', C=C)
+        svm.fit(np.concatenate([X[a, train], X[b, train]]),
+                np.concatenate([np.ones(train.sum()), np.zeros(train.sum())]))
+        return a, b, held_out, svm.decision_function(X[[a, b], held_out])
+
+
+def decode_pairs(stack, labels=list(conditions), n_jobs=None, C=1.0):
+    '''LOSO SVM forced-choice decoding of every condition pair
+
+    Args:
+        stack: (n_conditions, n_subjects, n_voxels) betas
+        labels: condition names along the first axis
+        n_jobs: worker processes (default: all cores)
+
+    Returns:
+        (table, accuracy, dists): one row per pair with accuracy, se and binomial
+        p; the symmetric condition x condition accuracy matrix; and per pair the
+        dist_from_hyperplane_xval vector (first condition's subjects first)
+    '''
+    stack = np.ascontiguousarray(stack)
+    n_subjects = stack.shape[1]
+    pairs = list(combinations(range(len(labels)), 2))
+    dists = {pair: np.empty(2 * n_subjects) for pair in pairs}
+    tasks = [(a, b, s) for a, b in pairs for s in range(n_subjects)]
+
+    shm = shared_memory.SharedMemory(create=True, size=stack.nbytes)
+    try:
+        np.ndarray(stack.shape, dtype=stack.dtype, buffer=shm.buf)[:] = stack
+        with ProcessPoolExecutor(max_workers=n_jobs or os.cpu_count(), initializer=_attach,
+                                 initargs=(shm.name, stack.shape, stack.dtype)) as pool:
+            for a, b, s, d in pool.map(_fold, *zip(*tasks), [C] * len(tasks),
+                                       chunksize=max(1, len(tasks) // (4 * (n_jobs or os.cpu_count())))):
+                dists[(a, b)][[s, n_subjects + s]] = d
+    finally:
+        shm.close()
+        shm.unlink()
+
+    rows = []
+    accuracy = pd.DataFrame(index=labels, columns=labels, dtype=float)
+    for (a, b), d in dists.items():
+        fc = forced_choice(d, n_subjects)
+        rows.append(dict(condition_a=labels[a], condition_b=labels[b], **fc))
+        accuracy.at[labels[a], labels[b]] = accuracy.at[labels[b], labels[a]] = fc['accuracy']
+    dists = {(labels[a], labels[b]): d for (a, b), d in dists.items()}
+    return pd.DataFrame(rows), accuracy, dists
+
+
+def legacy_pairs(stack, labels=list(conditions)):
+    '''The run_mvpa.ipynb loop: Brain_Data.append + predict + Roc for every pair'''
+    from nltools.data import Brain_Data
+    from nltools.analysis import Roc
+    n_subjects = stack.shape[1]
+    sub_list = ['sub-{:02d}'.format(s + 1) for s in range(n_subjects)]
+    subject_id = np.concatenate([sub_list, sub_list])
+    imgs = {}
+    for label, betas in zip(labels, stack):
+        imgs[label] = Brain_Data()
+        imgs[label].data = betas
+    accuracy, dists = {}, {}
+    for a, b in combinations(labels, 2):
+        data = imgs[a].append(imgs[b])
+        data.Y = pd.DataFrame(np.hstack([np.ones(n_subjects), np.zeros(n_subjects)]))
+        svm_stat = data.predict(algorithm='svm', cv_dict={'type': 'loso', 'subject_id': subject_id},
+                                **{'kernel': 'linear'}, plot=False, verbose=0)
+        roc_fc = Roc(input_values=svm_stat['dist_from_hyperplane_xval'],
+                     binary_outcome=svm_stat['Y'].astype(bool), forced_choice=subject_id)
+        roc_fc.calculate()
+        accuracy[(a, b)] = roc_fc.accuracy
+        dists[(a, b)] = svm_stat['dist_from_hyperplane_xval']
+    return accuracy, dists
+
+
+def synthetic_stack(n_subjects=64, n_voxels=20000, effect=0.05, seed=0):
+    '''Condition patterns plus subject-specific patterns and noise'''
+    rng = np.random.default_rng(seed)
+    patterns = rng.normal(size=(len(conditions), 1, n_voxels)) * effect
+    subjects = rng.normal(size=(1, n_subjects, n_voxels))
+    return patterns + subjects + rng.normal(size=(len(conditions), n_subjects, n_voxels))
+
+
+def benchmark(n_subjects=64, n_voxels=20000, n_jobs=None, seed=0):
+    '''Runtime and agreement of decode_pairs versus the notebook loop'''
+    stack = synthetic_stack(n_subjects, n_voxels, seed=seed)
+    start = time.perf_counter()
+    table, _, dists = decode_pairs(stack, n_jobs=n_jobs)
+    pooled = time.perf_counter() - start
+    start = time.perf_counter()
+    legacy_acc, legacy_dists = legacy_pairs(stack)
+    legacy = time.perf_counter() - start
+    return {'subjects': n_subjects, 'voxels': n_voxels, 'cores': n_jobs or os.cpu_count(),
+            'legacy_s': legacy, 'pooled_s': pooled, 'speedup': legacy / pooled,
+            'max_dist_diff': max(np.abs(dists[k] - legacy_dists[k]).max() for k in dists),
+            'max_acc_diff': max(abs(row.accuracy - legacy_acc[(row.condition_a, row.condition_b)])
+                                for row in table.itertuples())}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='LOSO SVM forced-choice decoding of all condition pairs')
+    parser.add_argument('-source', type=str, default=avg_betas_pkl,
+                        help='beta store, pickled dict of Brain_Data or directory of condition betas')
+    parser.add_argument('-neurosynth', action='store_true', help='restrict to the Neurosynth moral mask')
+    parser.add_argument('-n_jobs', type=int, default=None)
+    parser.add_argument('-out', type=str, default=None, help='csv of pairwise accuracies')
+    parser.add_argument('-benchmark', action='store_true', help='compare with the notebook loop on synthetic data')
+    parser.add_argument('-voxels', type=int, default=20000)
+    args = parser.parse_args()
+
+    if args.benchmark:
+        print(pd.Series(benchmark(n_voxels=args.voxels, n_jobs=args.n_jobs)).to_string())
+    else:
+        mask = None
+        if args.neurosynth:
+            from nltools.data import Brain_Data
+            mask = Brain_Data(neurosynth_mask).threshold(1, binarize=True)
+        table, accuracy, _ = decode_pairs(load_stack(args.source, mask), n_jobs=args.n_jobs)
+        out = args.out or os.path.join(results_dir, 'loso_{}_fc_acc.csv'.format('moral' if args.neurosynth else 'wb'))
+        table.to_csv(out, index=False)
+        print(accuracy.round(3).to_string())
@@ -0,0 +1,164 @@
+# Precomputed column index of the moral ROIs and the Neurosynth moral mask
+#
+# run_mvpa.ipynb and rsa.ipynb expand the 50-parcel k50_2mm mask and call
+# apply_mask once per ROI and subject, resampling and re-indexing the full
+# volume every time. A ParcelIndex maps every ROI in moral_rois, plus the
+# thresholded Neurosynth moral map, to column indices of the masked beta
+# space (a beta store, or nltools' Brain_Data voxel order) once and caches
+# them next to the data. All ROIs of a subject then come from one
+# fancy-index gather whose result is split into per-ROI views.
+
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+import nibabel as nib
+from beta_store import BetaStore, brain_mask_file, expand_mask_label, parcellation_file, _read
+
+neurosynth_mask = 'masks/moral_uniformity-test_z_FDR_0.01.nii.gz'
+neurosynth_threshold = 1
+neurosynth_name = 'Neurosynth Moral'
+brain_data_cache = 'masks/parcel_index_brain_data.npz'
+
+# expand_mask(k50_2mm) numbering
+moral_rois = {4: 'V1',
+              35: 'Primary Auditory',
+              0: 'amPFC',
+              32: 'vmPFC',
+              2: 'dmPFC',
+              44: 'dlPFC',
+              22: 'dACC',
+              5: 'TPJ/Ang. Gyrus',
+              15: 'TPJ/Par. Operculum',
+              6: 'PCC/Precuneus',
+              19: 'PCC/Superior LOC',
+              49: 'STS',
+              16: 'mInsula',
+              18: 'daInsula',
+              37: 'vaInsula'}
+
+
+def _file_digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ParcelIndex(object):
+    '''Column indices of named ROIs in a masked voxel space
+
+    Args:
+        names: ROI names, in gather order
+        columns: concatenated column indices of all ROIs
+        offsets: ROI i spans columns[offsets[i]:offsets[i + 1]]
+    '''
+
+    def __init__(self, names, columns, offsets, key=None):
+        self.names = list(names)
+        self.columns = np.asarray(columns, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.key = key
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, name):
+        i = self.names.index(name)
+        return self.columns[self.offsets[i]:self.offsets[i + 1]]
+
+    def sizes(self):
+        return dict(zip(self.names, np.diff(self.offsets).tolist()))
+
+    def gather(self, data):
+        '''All ROIs of (n_observations, n_voxels) data from a single fancy-index gather
+
+        Returns {name: (n_observations, n_roi_voxels)} views of the gathered block.
+        '''
+        block = np.asarray(data[:, self.columns])
+        return {name: block[:, a:b] for name, a, b in zip(self.names, self.offsets[:-1], self.offsets[1:])}
+
+    @classmethod
+    def build(cls, ijk, affine, shape, parcellation=parcellation_file, rois=moral_rois,
+              mask=neurosynth_mask, threshold=neurosynth_threshold):
+        '''Index the voxels (n_voxels, 3) of a data space by ROI
+
+        Parcels follow expand_mask numbering (see expand_mask_label); the
+        Neurosynth map is kept where it is at least `threshold`, as
+        Brain_Data.threshold(1, binarize=True).
+        '''
+        labels = np.rint(_read(parcellation, ijk, affine, shape)[0]).astype(np.int64)
+        names, groups = [], []
+        for parcel, name in rois.items():
+            names.append(name)
+            groups.append(np.flatnonzero(labels == expand_mask_label(labels, parcel)))
+        if mask is not None:
+            names.append(neurosynth_name)
+            groups.append(np.flatnonzero(_read(mask, ijk, affine, shape)[0] >= threshold))
+        offsets = np.concatenate([[0], np.cumsum([len(g) for g in groups])])
+        return cls(names, np.concatenate(groups), offsets)
+
+    def save(self, path):
+        np.savez(path, names=np.array(self.names), columns=self.columns,
+                 offsets=self.offsets, key=np.array(self.key or ''))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['names'].tolist(), f['columns'], f['offsets'], str(f['key']))
+
+    @classmethod
+    def cached(cls, path, ijk, affine, shape, parcellation=parcellation_file, rois=moral_rois,
+               mask=neurosynth_mask, threshold=neurosynth_threshold):
+        '''Load the index at path, rebuilding it when the voxel space, atlas, mask or ROIs changed'''
+        h = hashlib.sha1(np.ascontiguousarray(ijk, dtype=np.int64).tobytes())
+        h.update(np.asarray(affine, dtype=np.float64).tobytes())
+        key = hashlib.sha1(json.dumps([h.hexdigest(), _file_digest(parcellation),
+                                       _file_digest(mask) if mask else None, threshold,
+                                       sorted(rois.items())]).encode()).hexdigest()
+        if os.path.exists(path):
+            index = cls.load(path)
+            if index.key == key:
+                return index
+        index = cls.build(ijk, affine, shape, parcellation, rois, mask, threshold)
+        index.key = key
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        index.save(path)
+        return index
+
+
+def store_index(store, **kwargs):
+    '''ParcelIndex of a beta store, cached as parcel_index.npz in the store directory'''
+    if isinstance(store, str):
+        store = BetaStore(store)
+    return ParcelIndex.cached(os.path.join(store.store_dir, 'parcel_index.npz'),
+                              store.ijk, store.affine, store.shape, **kwargs)
+
+
+def brain_data_index(path=brain_data_cache, **kwargs):
+    '''ParcelIndex of Brain_Data.data columns (nltools' MNI brain mask in C order)'''
+    mask_img = nib.load(brain_mask_file())
+    ijk = np.argwhere(np.asarray(mask_img.dataobj) > 0)
+    return ParcelIndex.cached(path, ijk, mask_img.affine, mask_img.shape[:3], **kwargs)
+
+
+def subject_rois(store, index, subject):
+    '''All ROI betas of one subject: one contiguous row slice, one column gather'''
+    return index.gather(store.data[store.subject_rows(subject)])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build (or check) the cached moral ROI index of a beta store')
+    parser.add_argument('-store', type=str, default=None, help='beta store directory (default: Brain_Data space)')
+    parser.add_argument('-parcellation', type=str, default=parcellation_file)
+    parser.add_argument('-mask', type=str, default=neurosynth_mask)
+    args = parser.parse_args()
+
+    if args.store:
+        index = store_index(args.store, parcellation=args.parcellation, mask=args.mask)
+    else:
+        index = brain_data_index(parcellation=args.parcellation, mask=args.mask)
+    for name, size in index.sizes().items():
+        print('{:<20} {:>7} voxels'.format(name, size))
@@ -0,0 +1,274 @@
+# Cluster and peak tables of many t maps with cached atlas label volumes
+#
+# ideology_neural.ipynb and second_lv.ipynb call atlasreader.create_output
+# once per map, and every call loads the atlases again (Harvard-Oxford and
+# Juelich are 4D probability images, read as float64), builds one 4D image
+# with a volume per cluster and looks atlas labels up cluster by cluster.
+# Here each atlas is unpacked once into .npy files that every worker
+# memory-maps: the label volume (argmax of the probabilities, -1 where all
+# are zero, for probabilistic atlases) and the raw data for peak
+# probabilities. The atlas label of every voxel of a map's grid is computed
+# once per grid and worker. Clusters of all signs come from one
+# ndimage.label per sign, and cluster sizes, means, peaks and atlas overlaps
+# from bincounts over the labelled voxels. Maps run in a process pool and
+# every threshold gets one combined table over all maps. Thresholding,
+# cluster order, peaks and label strings follow atlasreader 0.3
+# (get_statmap_info with min_distance=None).
+
+import os
+import sys
+import glob
+import time
+import shutil
+import argparse
+import importlib.util
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from scipy import ndimage
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'glm'))
+from second_lv_batched import batched_dir
+
+map_glob = os.path.join(batched_dir, 'con_*', 'spmT_0001.nii')
+out_dir = 'clusters'
+cache_dir = 'atlas_cache'
+
+# atlasreader's 'default' atlases, and those it treats as probabilistic
+atlas_list = ['aal', 'desikan_killiany', 'harvard_oxford']
+probabilistic = ['juelich', 'harvard_oxford']
+
+# Per-worker caches: atlases by name, label lookups by (atlas, grid)
+_atlases = {}
+_grids = {}
+
+
+def atlas_data_dir():
+    '''data/atlases of the installed atlasreader package (located without importing it)'''
+    spec = importlib.util.find_spec('atlasreader')
+    if spec is None:
+        raise ImportError('atlasreader is not installed; pass -atlas_dir')
+    return os.path.join(spec.submodule_search_locations[0], 'data', 'atlases')
+
+
+def cache_atlases(atlases=atlas_list, atlas_dir=None, cache_dir=cache_dir):
+    '''Unpack atlas_{name}.nii.gz / labels_{name}.csv into memory-mappable files, once'''
+    os.makedirs(cache_dir, exist_ok=True)
+    for name in atlases:
+        prefix = os.path.join(cache_dir, name)
+        if os.path.exists(prefix + '_labels.csv'):
+            continue
+        atlas_dir = atlas_dir or atlas_data_dir()
+        img = nib.load(os.path.join(atlas_dir, 'atlas_{}.nii.gz'.format(name)))
+        data = np.asarray(img.dataobj)
+        if name in probabilistic:
+            label = np.argmax(data, axis=3).astype(np.int32)
+            label[data.max(axis=3) == 0] = -1
+        else:
+            label = data.astype(np.int32)
+        for suffix, values in [('_data.npy', data), ('_label.npy', label), ('_affine.npy', img.affine)]:
+            np.save(prefix + '.tmp.npy', values)
+            os.replace(prefix + '.tmp.npy', prefix + suffix)
+        shutil.copyfile(os.path.join(atlas_dir, 'labels_{}.csv'.format(name)), prefix + '_labels.csv')
+    return cache_dir
+
+
+def load_atlas(name, cache_dir=cache_dir):
+    '''Memory-mapped atlas from cache_atlases, loaded once per process'''
+    if name not in _atlases:
+        prefix = os.path.join(cache_dir, name)
+        labels = pd.read_csv(prefix + '_labels.csv')
+        _atlases[name] = {'data': np.load(prefix + '_data.npy', mmap_mode='r'),
+                          'label': np.load(prefix + '_label.npy', mmap_mode='r'),
+                          'affine': np.load(prefix + '_affine.npy'),
+                          'names': dict(zip(labels['index'], labels['name']))}
+    return _atlases[name]
+
+
+def ijk_to_xyz(affine, ijk):
+    return (affine @ np.column_stack([ijk, np.ones(len(ijk))]).T)[:3].T
+
+
+def atlas_ijk(atlas, xyz):
+    '''Atlas voxels of xyz coordinates, rounded; voxels outside the atlas go to the origin as in atlasreader'''
+    ijk = np.round(np.linalg.solve(atlas['affine'], np.column_stack([xyz, np.ones(len(xyz))]).T)[:3].T).astype(int)
+    ijk[((ijk < 0) | (ijk >= atlas['label'].shape[:3])).any(axis=1)] = 0
+    return ijk
+
+
+def label_volume(name, affine, shape, cache_dir=cache_dir):
+    '''Atlas label of every voxel of the (affine, shape) grid, flattened; cached per grid'''
+    key = (name, affine.tobytes(), tuple(shape))
+    if key not in _grids:
+        atlas = load_atlas(name, cache_dir)
+        ijk = atlas_ijk(atlas, ijk_to_xyz(affine, np.indices(shape).reshape(3, -1).T))
+        _grids[key] = np.asarray(atlas['label'][ijk[:, 0], ijk[:, 1], ijk[:, 2]])
+    return _grids[key]
+
+
+def find_clusters(data, threshold, cluster_extent=0, direction='both'):
+    '''Clusters of |data| > threshold numbered 1..n by size (largest first), as atlasreader.process_img
+
+    Positive and negative clusters are labelled separately (face connectivity).
+    Clusters of cluster_extent voxels or fewer are dropped: atlasreader's
+    size bound is meant to be inclusive but vanishes in float32.
+    '''
+    data = np.nan_to_num(data)
+    clusters = np.zeros(data.shape, dtype=np.int32)
+    n = 0
+    for sign in (['pos', 'neg'] if direction == 'both' else [direction]):
+        labels, n_sign = ndimage.label(data > threshold if sign == 'pos' else data < -threshold)
+        sizes = np.bincount(labels.ravel(), minlength=n_sign + 1)
+        keep = np.zeros(n_sign + 1, dtype=np.int32)
+        kept = np.flatnonzero(sizes[1:] > cluster_extent) + 1
+        keep[kept] = n + np.arange(1, len(kept) + 1)
+        clusters[labels > 0] = keep[labels[labels > 0]]
+        n += len(kept)
+    sizes = np.bincount(clusters.ravel(), minlength=n + 1)[1:]
+    rank = np.zeros(n + 1, dtype=np.int32)
+    rank[np.argsort(sizes)[::-1] + 1] = np.arange(1, n + 1)
+    return rank[clusters], n
+
+
+def _overlaps(cluster, label, sizes, names, prob_thresh):
+    '''"pct% name" strings per cluster, ordered as atlasreader.read_atlas_cluster'''
+    pairs, counts = np.unique(np.column_stack([cluster, label]), axis=0, return_counts=True)
+    pct = 100 * counts / sizes[pairs[:, 0]]
+    order = np.lexsort((-pairs[:, 1], -pct, pairs[:, 0]))
+    order = order[pct[order] >= prob_thresh]
+    text = ['{:.02f}% {}'.format(p, names.get(lab, 'no_label')) for p, lab in zip(pct[order], pairs[order, 1])]
+    joined = pd.Series(text, dtype=object).groupby(pairs[order, 0]).agg('; '.join)
+    return joined.reindex(range(len(sizes)), fill_value='').tolist()
+
+
+def _peak_probabilities(atlas, xyz, prob_thresh):
+    '''"prob% name" strings at each peak of a probabilistic atlas, as atlasreader.read_atlas_peak'''
+    ijk = atlas_ijk(atlas, xyz)
+    probs = np.asarray(atlas['data'][ijk[:, 0], ijk[:, 1], ijk[:, 2]], dtype=np.float64)
+    probs[probs < prob_thresh] = 0
+    out = []
+    for p in probs:
+        idx = np.flatnonzero(p)
+        idx = idx[np.argsort(p[idx])][::-1]
+        out.append('; '.join('{}% {}'.format(p[i], atlas['names'].get(i, 'no_label')) for i in idx)
+                   if len(idx) else '0% no_label')
+    return out
+
+
+def cluster_table(data, clusters, n, affine, zooms, atlases=atlas_list, prob_thresh=5, cache_dir=cache_dir):
+    '''One row per cluster: peak, cluster mean and peak value, volume, atlas overlap and peak labels
+
+    The peak is the floored centre of mass of the voxels at the cluster's
+    maximum |value|. Per atlas, column `{atlas}` holds the cluster overlap
+    (atlasreader's cluster table) and `{atlas}_peak` the label at the peak
+    (its peak table).
+    '''
+    columns = ['cluster_id', 'peak_x', 'peak_y', 'peak_z', 'cluster_mean', 'peak_value', 'volume_mm']
+    if not n:
+        return pd.DataFrame(columns=columns + [c for a in atlases for c in (a, a + '_peak')])
+    data = np.nan_to_num(data)
+    voxels = np.flatnonzero(clusters)
+    cluster = clusters.ravel()[voxels] - 1
+    values = data.ravel()[voxels]
+    sizes = np.bincount(cluster, minlength=n)
+    peak = np.full(n, -np.inf)
+    np.maximum.at(peak, cluster, np.abs(values))
+    at_peak = np.abs(values) == peak[cluster]
+    ijk = np.column_stack(np.unravel_index(voxels[at_peak], data.shape))
+    counts = np.bincount(cluster[at_peak], minlength=n)
+    peak_ijk = np.floor(np.column_stack([np.bincount(cluster[at_peak], ijk[:, d], minlength=n)
+                                         for d in range(3)]) / counts[:, None]).astype(int)
+    xyz = ijk_to_xyz(affine, peak_ijk)
+    table = pd.DataFrame({'cluster_id': np.arange(1, n + 1), 'peak_x': xyz[:, 0], 'peak_y': xyz[:, 1],
+                          'peak_z': xyz[:, 2], 'cluster_mean': np.bincount(cluster, values, minlength=n) / sizes,
+                          'peak_value': data[tuple(peak_ijk.T)], 'volume_mm': sizes * np.prod(zooms)})
+    peak_voxels = np.ravel_multi_index(peak_ijk.T, data.shape)
+    for name in atlases:
+        atlas = load_atlas(name, cache_dir)
+        grid = label_volume(name, affine, data.shape, cache_dir)
+        table[name] = _overlaps(cluster, grid[voxels], sizes, atlas['names'], prob_thresh)
+        if name in probabilistic:
+            table[name + '_peak'] = _peak_probabilities(atlas, xyz, prob_thresh)
+        else:
+            table[name + '_peak'] = [atlas['names'].get(lab, 'no_label') for lab in grid[peak_voxels]]
+    return table
+
+
+def report_map(path, thresholds, cluster_extent=0, direction='both', atlases=atlas_list, prob_thresh=5,
+               cache_dir=cache_dir):
+    '''{threshold: cluster table} of one map; the map is read once for all thresholds'''
+    img = nib.load(path)
+    data = np.asarray(img.dataobj, dtype=np.float64).reshape(img.shape[:3])
+    tables = {}
+    for threshold in thresholds:
+        clusters, n = find_clusters(data, threshold, cluster_extent, direction)
+        table = cluster_table(data, clusters, n, img.affine, img.header.get_zooms()[:3], atlases, prob_thresh,
+                              cache_dir)
+        table.insert(0, 'map', path)
+        tables[threshold] = table
+    return tables
+
+
+def _report_map(args):
+    return report_map(*args)
+
+
+def report(paths, thresholds=[4.06], cluster_extent=0, direction='both', atlases=atlas_list, prob_thresh=5,
+           atlas_dir=None, cache_dir=cache_dir, out_dir=out_dir, n_jobs=8):
+    '''Cluster tables of all maps, combined and written per threshold as clusters_thr-{threshold}.csv'''
+    cache_atlases(atlases, atlas_dir, cache_dir)
+    jobs = [(p, thresholds, cluster_extent, direction, atlases, prob_thresh, cache_dir) for p in paths]
+    with ProcessPoolExecutor(n_jobs) as pool:
+        results = list(pool.map(_report_map, jobs, chunksize=max(1, len(jobs) // (4 * n_jobs))))
+    os.makedirs(out_dir, exist_ok=True)
+    combined = {}
+    for threshold in thresholds:
+        combined[threshold] = pd.concat([r[threshold] for r in results], ignore_index=True)
+        combined[threshold].to_csv(os.path.join(out_dir, 'clusters_thr-{:g}.csv'.format(threshold)), index=False)
+    return combined
+
+
+def check(path, threshold=4.06, cluster_extent=0, direction='both', atlases=atlas_list, prob_thresh=5,
+          cache_dir=cache_dir):
+    '''Largest numeric difference and number of differing label cells against atlasreader.get_statmap_info'''
+    from atlasreader.atlasreader import get_statmap_info
+    cache_atlases(atlases, None, cache_dir)
+    table = report_map(path, [threshold], cluster_extent, direction, atlases, prob_thresh, cache_dir)[threshold]
+    clust, peaks = get_statmap_info(path, cluster_extent, atlases, threshold, direction, prob_thresh)
+    numeric = ['peak_x', 'peak_y', 'peak_z', 'cluster_mean', 'volume_mm']
+    diff = {'clusters': len(table), 'atlasreader_clusters': len(clust)}
+    if len(table) != len(clust):
+        return diff
+    diff['max_abs_diff'] = max(np.abs(table[numeric].to_numpy(float) - clust[numeric].to_numpy(float)).max(),
+                               np.abs(table['peak_value'].to_numpy(float) - peaks['peak_value'].to_numpy(float)).max())
+    diff['label_mismatches'] = int(sum((table[a].to_numpy() != clust[a].to_numpy()).sum() +
+                                       (table[a + '_peak'].to_numpy() != peaks[a].to_numpy()).sum()
+                                       for a in atlases))
+    return diff
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Combined cluster / peak tables with atlas labels for a directory of t maps')
+    parser.add_argument('-maps', type=str, default=map_glob, help='glob of statistical maps')
+    parser.add_argument('-thresholds', nargs='+', type=float, default=[4.06], help='voxel thresholds on |t|')
+    parser.add_argument('-cluster_extent', type=int, default=0, help='clusters must have more voxels than this')
+    parser.add_argument('-direction', choices=['both', 'pos', 'neg'], default='both')
+    parser.add_argument('-atlases', nargs='+', default=atlas_list)
+    parser.add_argument('-prob_thresh', type=float, default=5, help='minimum percentage reported')
+    parser.add_argument('-atlas_dir', type=str, default=None, help='atlasreader data/atlases (default: installed package)')
+    parser.add_argument('-cache_dir', type=str, default=cache_dir)
+    parser.add_argument('-out_dir', type=str, default=out_dir)
+    parser.add_argument('-n_jobs', type=int, default=8)
+    parser.add_argument('-check', action='store_true', help='compare the first map with atlasreader.get_statmap_info')
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(args.maps))
+    start = time.perf_counter()
+    tables = report(paths, args.thresholds, args.cluster_extent, args.direction, args.atlases, args.prob_thresh,
+                    args.atlas_dir, args.cache_dir, args.out_dir, args.n_jobs)
+    print('{} maps x {} thresholds in {:.1f}s: {}'.format(len(paths), len(tables), time.perf_counter() - start,
+                                                         {t: len(df) for t, df in tables.items()}))
+    if args.check:
+        print(check(paths[0], args.thresholds[0], args.cluster_extent, args.direction, args.atlases,
+                    args.prob_thresh, args.cache_dir))
@@ -0,0 +1,221 @@
+# Mass-univariate ideology regression of every first-level contrast
+#
+# ideology_neural.ipynb starts from t maps (ind_bind.nii, bind_ind.nii) that
+# came out of one SPM regression per contrast. Here the con_*.nii images of
+# all 17 contrasts are stacked once (and cached, keyed on the con images'
+# paths and mtimes), the participants.tsv covariates of ideology_beh.ipynb
+# form one design matrix (categorical covariates as treatment-coded dummy
+# columns), and all
+# contrasts x voxels are fitted by a single QR least-squares solve. t and
+# two-sided p maps are written for each tested covariate. Permutation nulls
+# follow Freedman & Lane (1983): the residuals of the nuisance-only model are
+# permuted, and since the tested covariate is residualized on the nuisance
+# space, the t of every permutation and voxel needs only two matrix products
+# per block. The maximum |t| of each contrast gives FWE-corrected p maps.
+
+import os
+import sys
+import json
+import glob
+import time
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from scipy import stats
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'glm'))
+from permutation import fwe_p
+from second_lv_batched import first_lv_dir, load_contrasts
+
+exp_dir = '/srv/lab/fmri/mft/fhopp_diss//bids/'
+out_dir = 'ideology_glm'
+
+# first_lv_workflow.contrast_list
+contrast_names = {'0001': 'Physical Care', '0002': 'Emotional Care', '0003': 'Fairness', '0004': 'Liberty',
+                  '0005': 'Loyalty', '0006': 'Authority', '0007': 'Sanctity', '0008': 'Social Norms',
+                  '0009': 'Physical Care > Social', '0010': 'Emotional Care > Social',
+                  '0011': 'Fairness > Social', '0012': 'Liberty > Social', '0013': 'Loyalty > Social',
+                  '0014': 'Authority > Social', '0015': 'Sanctity > Social',
+                  '0016': 'Binding > Individualizing', '0017': 'Moral > Social'}
+
+# Covariates of the ideology_beh.ipynb regressions
+covariate_list = ['pol_orient', 'age', 'gender']
+test_list = ['pol_orient']
+
+
+def load_survey(exp_dir=exp_dir):
+    '''participants.tsv indexed by subject'''
+    survey = pd.read_csv(os.path.join(exp_dir, 'participants.tsv'), sep='\t')
+    return survey.set_index('participant_id')
+
+
+def contrasts_key(contrast_ids, first_lv_dir=first_lv_dir):
+    '''Digest of first_lv_dir, the contrast ids and the paths, sizes and mtimes of every con image read'''
+    files = sorted(f for c in contrast_ids
+                   for f in glob.glob(os.path.join(first_lv_dir, 'sub-*', 'con_{}.nii'.format(c))))
+    stamps = [[os.path.relpath(f, first_lv_dir), os.stat(f).st_size, os.stat(f).st_mtime_ns] for f in files]
+    key = [os.path.realpath(first_lv_dir), list(contrast_ids), stamps]
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+
+def cached_contrasts(contrast_ids=list(contrast_names), first_lv_dir=first_lv_dir, cache=None):
+    '''load_contrasts, stored as an .npz after the first call so designs can be changed cheaply
+
+    The stack is reloaded whenever first_lv_dir, the contrasts or any con
+    image (added, removed or rewritten) changed.
+    '''
+    cache = cache or os.path.join(out_dir, 'contrasts.npz')
+    key = contrasts_key(contrast_ids, first_lv_dir)
+    if os.path.exists(cache):
+        with np.load(cache) as f:
+            if 'key' in f and f['key'].item() == key:
+                return f['subjects'].tolist(), f['Y'], f['mask'], f['affine']
+    subjects, Y, mask, affine = load_contrasts(contrast_ids, first_lv_dir)
+    os.makedirs(os.path.dirname(os.path.abspath(cache)), exist_ok=True)
+    np.savez(cache, subjects=np.array(subjects), Y=Y, mask=mask, affine=affine,
+             contrast_ids=np.array(list(contrast_ids)), key=np.array(key))
+    return subjects, Y, mask, affine
+
+
+def design_matrix(survey, subjects, covariates=covariate_list):
+    '''Intercept plus covariates for the subjects with complete covariates (DataFrame indexed by subject)
+
+    Numeric covariates enter as they are. Non-numeric ones (e.g. gender coded
+    as text) become one 0/1 column per level except the first, named
+    <covariate>_<level>.
+    '''
+    table = survey.reindex(subjects)[covariates].dropna()
+    columns = [pd.Series(1., index=table.index, name='intercept')]
+    for covariate in covariates:
+        values = table[covariate]
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            columns.append(values.astype(float))
+        else:
+            columns.append(pd.get_dummies(values, prefix=covariate, prefix_sep='_', drop_first=True, dtype=float))
+    return pd.concat(columns, axis=1)
+
+
+def test_columns(X, test):
+    '''Design columns of a tested covariate: itself, or the dummy columns of a categorical one'''
+    if test in X.columns:
+        return [test]
+    dummies = [c for c in X.columns if c.startswith(test + '_')]
+    if not dummies:
+        raise ValueError('{} is not a covariate of the design ({})'.format(test, ', '.join(X.columns)))
+    return dummies
+
+
+def ols(X, Y):
+    '''Betas and t of every regressor for Y (n_subjects, ...) from one QR solve
+
+    Returns betas and t with shape (n_regressors, ...) and the residual df.
+    '''
+    X = np.asarray(X, dtype=np.float64)
+    n, p = X.shape
+    shape = Y.shape[1:]
+    Y = np.asarray(Y, dtype=np.float64).reshape(n, -1)
+    Q, R = np.linalg.qr(X)
+    QtY = Q.T @ Y
+    B = np.linalg.solve(R, QtY)
+    df = n - p
+    sigma2 = np.maximum((Y ** 2).sum(axis=0) - (QtY ** 2).sum(axis=0), 0) / df
+    Rinv = np.linalg.inv(R)
+    se = np.sqrt(np.outer((Rinv ** 2).sum(axis=1), sigma2))
+    return B.reshape((p,) + shape), (B / se).reshape((p,) + shape), df
+
+
+def freedman_lane(X, Y, test, n_perm=1000, seed=0, max_bytes=1 << 30):
+    '''Freedman-Lane permutation t nulls of regressor `test` (column index) of X
+
+    Y is (n_subjects, n_contrasts, n_voxels). Returns the observed t
+    (n_contrasts, n_voxels) and the max |t| null (n_perm, n_contrasts);
+    permutation 0 is the identity. Permutations are processed in blocks that
+    keep the temporaries under max_bytes.
+    '''
+    X = np.asarray(X, dtype=np.float64)
+    n, n_con, n_vox = Y.shape
+    Y = np.asarray(Y, dtype=np.float64).reshape(n, -1)
+    Z = np.delete(X, test, axis=1)
+    Qz = np.linalg.qr(Z)[0]
+    Rz = Y - Qz @ (Qz.T @ Y)                                     # nuisance-model residuals
+    x = X[:, test] - Qz @ (Qz.T @ X[:, test])                    # covariate orthogonal to Z
+    x /= np.linalg.norm(x)
+    ss = (Rz ** 2).sum(axis=0)
+    df = n - X.shape[1]
+    rng = np.random.default_rng(seed)
+    perms = np.array([np.arange(n)] + [rng.permutation(n) for _ in range(n_perm - 1)])
+    max_t = np.empty((n_perm, n_con))
+    block = max(1, int(max_bytes // (8 * (Z.shape[1] + 3) * Y.shape[1])))
+    for start in range(0, n_perm, block):
+        P = perms[start:start + block]                           # rows of P Rz
+        # x'(I - Hz) P Rz = (P'x)' Rz; ||(I - Hz) P Rz||^2 = ||Rz||^2 - ||Qz' P Rz||^2
+        inverse = np.argsort(P, axis=1)
+        num = x[inverse] @ Rz
+        proj = np.einsum('bnk,nv->bkv', Qz[inverse], Rz)
+        resid = np.maximum(ss - (proj ** 2).sum(axis=1) - num ** 2, 0)
+        t = num / np.sqrt(resid / df)
+        max_t[start:start + len(P)] = np.abs(t).reshape(len(P), n_con, n_vox).max(axis=2)
+        if start == 0:
+            observed = t[0].reshape(n_con, n_vox)
+    return observed, max_t
+
+
+def _write(path, values, mask, affine):
+    img = np.full(mask.shape, np.nan, dtype=np.float32)
+    img[mask] = values
+    nib.save(nib.Nifti1Image(img, affine), path)
+
+
+def run(contrast_ids=list(contrast_names), covariates=covariate_list, tests=test_list, first_lv_dir=first_lv_dir,
+        exp_dir=exp_dir, out_dir=out_dir, n_perm=0, seed=0):
+    '''Fit every contrast x voxel, write t / p maps (and FWE p maps) per tested covariate'''
+    start = time.perf_counter()
+    subjects, Y, mask, affine = cached_contrasts(contrast_ids, first_lv_dir, os.path.join(out_dir, 'contrasts.npz'))
+    X = design_matrix(load_survey(exp_dir), subjects, covariates)
+    Y = Y[:, [subjects.index(s) for s in X.index]].transpose(1, 0, 2)        # (n_subjects, n_contrasts, n_voxels)
+    loaded = time.perf_counter()
+    B, T, df = ols(X, Y)
+    fitted = time.perf_counter()
+
+    summary = []
+    for test in [c for t in tests for c in test_columns(X, t)]:
+        col = list(X.columns).index(test)
+        null = freedman_lane(X, Y, col, n_perm, seed=seed)[1] if n_perm else None
+        for i, c in enumerate(contrast_ids):
+            t = T[col, i]
+            p = 2 * stats.t.sf(np.abs(t), df)
+            prefix = os.path.join(out_dir, 'con_{}_{}'.format(c, test))
+            _write(prefix + '_beta.nii', B[col, i], mask, affine)
+            _write(prefix + '_t.nii', t, mask, affine)
+            _write(prefix + '_p.nii', p, mask, affine)
+            row = {'contrast': c, 'name': contrast_names.get(c, c), 'covariate': test, 'n': len(X), 'df': df,
+                   'max_t': t.max(), 'min_t': t.min(), 'min_p': p.min()}
+            if n_perm:
+                p_fwe = fwe_p(np.abs(t), null[:, i])
+                _write(prefix + '_pfwe.nii', p_fwe, mask, affine)
+                row.update(fwe_t_05=np.percentile(null[:, i], 95), min_p_fwe=p_fwe.min())
+            summary.append(row)
+    summary = pd.DataFrame(summary)
+    summary.to_csv(os.path.join(out_dir, 'summary.csv'), index=False)
+    print('{} subjects x {} contrasts x {} voxels: loaded in {:.1f}s, fitted in {:.2f}s, total {:.1f}s'.format(
+        len(X), len(contrast_ids), Y.shape[2], loaded - start, fitted - loaded, time.perf_counter() - start))
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Voxelwise regression of all contrast maps on ideology / MFQ covariates')
+    parser.add_argument('-contrasts', nargs='+', default=list(contrast_names))
+    parser.add_argument('-covariates', nargs='+', default=covariate_list, help='participants.tsv columns')
+    parser.add_argument('-test', nargs='+', default=test_list, help='covariates to write maps for')
+    parser.add_argument('-first_lv_dir', type=str, default=first_lv_dir)
+    parser.add_argument('-exp_dir', type=str, default=exp_dir, help='BIDS directory with participants.tsv')
+    parser.add_argument('-out_dir', type=str, default=out_dir)
+    parser.add_argument('-n_perm', type=int, default=0, help='Freedman-Lane permutations (0 = off)')
+    parser.add_argument('-seed', type=int, default=0)
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    print(run(args.contrasts, args.covariates, args.test, args.first_lv_dir, args.exp_dir, args.out_dir,
+              args.n_perm, args.seed).to_string(index=False))
@@ -0,0 +1,159 @@
+# Offline throughput benchmark of the pipelines on a synthetic dataset
+#
+# Writes (or reuses) a small synthetic BIDS / fMRIPrep dataset with the
+# vignette layout (synthetic_bids.py), then runs the pipeline stages on it
+# with tracing on (instrument.py):
+#   index      bids_index.build_index
+#   trim       the run-cache trimming as a nipype graph (one node per run)
+#   smoothing  smoothing.smooth_file (SPM kernel) on every trimmed run
+#   numpy_glm  numpy_glm.run_subject (design build, regression, beta write)
+#   nltools    nltools_ratings_glm.run_subject, in memory / streamed (optional;
+#              both resample every run to the 2 mm MNI mask, which takes
+#              minutes and several GB per run even on the coarse grid)
+#   decoding   pairwise_decoding / kernel_decoding on a synthetic beta stack
+#   rdm        crossnobis.roi_crossnobis and beh_features.beh_rdms
+# The glm/mvpa/rsa modules are imported once the run cache points at the work
+# directory. The trace and a per-stage summary are written to out_dir. With
+# -baseline (an earlier summary.csv) stages whose mean wall time grew by more
+# than -tolerance (and by more than -min_s seconds) are listed and the exit
+# code is 1, so throughput regressions are caught without real data.
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import pandas as pd
+
+here = os.path.dirname(os.path.abspath(__file__))
+for d in ['glm', 'mvpa', 'rsa']:
+    sys.path.insert(0, os.path.join(here, '..', d))
+
+from instrument import stage, start_trace, node_trace_args, load_trace, summarize
+from synthetic_bids import make_dataset
+
+out_dir = 'benchmark'
+stage_list = ['index', 'trim', 'smoothing', 'numpy_glm', 'decoding', 'rdm']
+optional_stages = ['nltools', 'nltools_stream']
+
+
+def trim_graph(bold_files, work_dir, n_procs=1):
+    '''nipype graph with one run_cache.trim_run node per run'''
+    from nipype import Workflow, Node
+    from nipype.interfaces.utility import Function
+    from run_cache import trim_run
+    trim = Node(Function(input_names=['in_file', 't_min', 't_size', 'code_dir'], output_names=['out_file'],
+                         function=trim_run), name='trim_run')
+    trim.inputs.t_min, trim.inputs.t_size = 11, 668
+    trim.inputs.code_dir = os.path.join(here, '..', 'glm')
+    trim.iterables = [('in_file', bold_files)]
+    graph = Workflow(name='benchmark_trim', base_dir=work_dir)
+    graph.add_nodes([trim])
+    graph.config['execution']['crashfile_format'] = 'txt'
+    return graph.run('MultiProc', plugin_args=node_trace_args({'n_procs': n_procs}))
+
+
+def run_stages(bids_dir, work_dir, stages=stage_list, n_subjects=16, n_voxels=2000, n_jobs=1):
+    '''Run the requested stages on a synthetic dataset; tracing must already be on'''
+    from bids_index import build_index, find_runs
+    subjects = sorted(find_runs(bids_dir)['subject'].unique())
+    if 'index' in stages:
+        with stage('index'):
+            build_index(bids_dir, n_jobs=n_jobs)
+    if 'trim' in stages:
+        trim_graph(sorted(find_runs(bids_dir)['bold']), work_dir, n_jobs)
+    if 'smoothing' in stages:
+        from run_cache import cached_trimmed_run
+        from smoothing import smooth_file
+        os.makedirs(os.path.join(work_dir, 'smoothed'), exist_ok=True)
+        for bold in sorted(find_runs(bids_dir)['bold']):
+            run_file = cached_trimmed_run(bold)
+            with stage('smoothing', run=os.path.basename(bold)):
+                smooth_file(run_file, os.path.join(work_dir, 'smoothed', 's' + os.path.basename(run_file)))
+    if 'numpy_glm' in stages:
+        from numpy_glm import run_subject
+        for subject in subjects:
+            run_subject(subject, os.path.join(work_dir, 'numpy_glm', subject), bids_dir=bids_dir)
+    for mode in ['nltools', 'nltools_stream']:
+        if mode in stages:
+            from nltools_ratings_glm import run_subject
+            betas = os.path.join(work_dir, mode) + os.sep
+            os.makedirs(betas, exist_ok=True)
+            for subject in subjects:
+                run_subject(subject, stream=mode == 'nltools_stream', scratch_dir=work_dir,
+                            bids_dir=bids_dir, output_dir=betas)
+    if 'decoding' in stages:
+        import pairwise_decoding
+        import kernel_decoding
+        stack = pairwise_decoding.synthetic_stack(n_subjects, n_voxels)
+        pairwise_decoding.decode_pairs(stack, n_jobs=n_jobs)
+        K = kernel_decoding.gram(stack)
+        for method in ['svm', 'ridge']:
+            kernel_decoding.decode_pairs(K, n_subjects, method=method)
+    if 'rdm' in stages:
+        from crossnobis import roi_crossnobis, synthetic_rois
+        from beh_features import load_beh, beh_rdms, measures
+        rois, n_runs = synthetic_rois(n_subjects, n_voxels=n_voxels)
+        roi_crossnobis(rois, n_runs, n_jobs=n_jobs)
+        vig_beh = load_beh(bids_dir)
+        for measure in measures:
+            beh_rdms(vig_beh, measure, exclude=[])
+
+
+def compare(summary, baseline, tolerance=0.25, min_s=0.05):
+    '''Stages whose mean wall time exceeds the baseline by more than tolerance (relative) and min_s'''
+    merged = summary.merge(baseline, on=['source', 'stage'], suffixes=('', '_baseline'))
+    merged['ratio'] = merged['mean_wall_s'] / merged['mean_wall_s_baseline']
+    slower = (merged['ratio'] > 1 + tolerance) & \
+        (merged['mean_wall_s'] - merged['mean_wall_s_baseline'] > min_s)
+    return merged.loc[slower, ['source', 'stage', 'mean_wall_s_baseline', 'mean_wall_s', 'ratio']]
+
+
+def benchmark(out_dir=out_dir, bids_dir=None, stages=stage_list, n_subjects=2, n_runs=3, voxel_mm=8,
+              n_jobs=1, seed=0):
+    '''Trace every stage on a synthetic dataset; returns the trace and the per-stage summary'''
+    os.makedirs(out_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix='work_', dir=out_dir)
+    # Trimmed runs go to a private cache (read by run_cache on import)
+    os.environ['VIGNETTE_RUN_CACHE'] = os.path.join(work_dir, 'run_cache')
+    if bids_dir is None:
+        bids_dir = os.path.join(work_dir, 'bids')
+        start = time.perf_counter()
+        make_dataset(bids_dir, n_subjects, n_runs, voxel_mm, seed=seed)
+        print('Synthetic dataset in {:.1f}s'.format(time.perf_counter() - start))
+    trace = os.path.join(out_dir, 'trace.jsonl')
+    if os.path.exists(trace):
+        os.remove(trace)
+    start_trace(trace)
+    run_stages(bids_dir, work_dir, stages, n_jobs=n_jobs)
+    trace = load_trace(trace)
+    trace.to_csv(os.path.join(out_dir, 'trace.csv'), index=False)
+    summary = summarize(trace)
+    summary.to_csv(os.path.join(out_dir, 'summary.csv'), index=False)
+    return trace, summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Trace the pipeline stages on a synthetic vignette dataset')
+    parser.add_argument('-out_dir', type=str, default=out_dir)
+    parser.add_argument('-bids_dir', type=str, default=None, help='reuse a dataset written by synthetic_bids.py')
+    parser.add_argument('-stages', nargs='+', default=stage_list, choices=stage_list + optional_stages)
+    parser.add_argument('-subjects', type=int, default=2)
+    parser.add_argument('-runs', type=int, default=3)
+    parser.add_argument('-voxel_mm', type=float, default=8)
+    parser.add_argument('-n_jobs', type=int, default=1)
+    parser.add_argument('-seed', type=int, default=0)
+    parser.add_argument('-baseline', type=str, default=None, help='summary.csv of an earlier run to compare with')
+    parser.add_argument('-tolerance', type=float, default=0.25, help='allowed relative slowdown per stage')
+    parser.add_argument('-min_s', type=float, default=0.05, help='ignore slowdowns smaller than this (secs)')
+    args = parser.parse_args()
+
+    trace, summary = benchmark(args.out_dir, args.bids_dir, args.stages, args.subjects, args.runs,
+                               args.voxel_mm, args.n_jobs, args.seed)
+    print(summary.to_string(index=False))
+    if args.baseline:
+        slower = compare(summary, pd.read_csv(args.baseline), args.tolerance, args.min_s)
+        if len(slower):
+            print('Slower than {}:'.format(args.baseline))
+            print(slower.to_string(index=False))
+        raise SystemExit(int(len(slower) > 0))
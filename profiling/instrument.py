@@ -0,0 +1,265 @@
+# Per-stage and per-node resource tracing for the GLM, MVPA and RSA pipelines
+#
+# Tracing is switched on by pointing MFT_TRACE at a .jsonl file, either in
+# the environment or through start_trace(). The variable is inherited by
+# nipype workers and process pools, and every process appends one JSON line
+# per finished record, so a whole multi-process run ends up in one file. When
+# MFT_TRACE is unset, stage() does nothing.
+#
+# stage(name, **tags) records, for the enclosed block:
+#   wall_s, cpu_s       wall clock and CPU time of this process plus reaped
+#                       child processes (MATLAB, wb_command, ...)
+#   peak_rss_gb         resident set high-water mark (VmHWM) of the process at
+#                       the end of the block, i.e. the peak up to and including
+#                       the block
+#   hwm_delta_gb        how much the block raised that high-water mark; when it
+#                       is > 0 peak_rss_gb is the block's own peak, when it is 0
+#                       the block stayed below an earlier peak. The mark is never
+#                       reset, so ru_maxrss-based checks in the pipelines (e.g.
+#                       stream_glm.peak_rss_gb) keep seeing the lifetime peak
+#   read_mb, write_mb   bytes passed through read/write calls (/proc/self/io
+#                       rchar/wchar); disk_read_mb / disk_write_mb are the bytes
+#                       that reached storage
+# node_callback is a nipype status_callback that records every finished node:
+#   wall_s              the node's run time
+#   cpu_s, peak_rss_gb  from the CPU and memory samples of nipype's resource
+#                       monitor, which node_trace_args enables; the monitor
+#                       needs psutil, so install it to trace nodes (without it
+#                       these stay NaN and a warning says so)
+#   input_mb, output_mb sizes of the node's input files and of its working
+#                       directory; read_mb / write_mb stay NaN for nodes, as
+#                       the I/O of the worker process is not seen
+
+import os
+import json
+import time
+import argparse
+import warnings
+import resource
+import threading
+import contextlib
+import numpy as np
+import pandas as pd
+
+trace_var = 'MFT_TRACE'
+
+fields = ['source', 'stage', 'name', 'pid', 'start', 'wall_s', 'cpu_s', 'peak_rss_gb', 'hwm_delta_gb',
+          'read_mb', 'write_mb', 'disk_read_mb', 'disk_write_mb', 'input_mb', 'output_mb', 'status']
+
+_lock = threading.Lock()
+
+
+def trace_file():
+    '''Active trace file, or None when tracing is off'''
+    return os.environ.get(trace_var) or None
+
+
+def start_trace(path):
+    '''Trace this process and everything it starts into path (appending)'''
+    path = os.path.abspath(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.environ[trace_var] = path
+    return path
+
+
+def stop_trace():
+    os.environ.pop(trace_var, None)
+
+
+def write_record(record, path=None):
+    '''Append one record to the trace as a JSON line'''
+    path = path or trace_file()
+    if path is None:
+        return
+    line = json.dumps({k: (None if isinstance(v, float) and np.isnan(v) else v) for k, v in record.items()},
+                      default=str) + '\n'
+    with _lock, open(path, 'a') as f:
+        f.write(line)
+
+
+def _proc_io():
+    '''rchar, wchar, read_bytes and write_bytes of this process (zeros off Linux)'''
+    counters = dict.fromkeys(['rchar', 'wchar', 'read_bytes', 'write_bytes'], 0)
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                if key in counters:
+                    counters[key] = int(value)
+    except OSError:
+        pass
+    return counters
+
+
+def _hwm_gb():
+    '''Resident set high-water mark (VmHWM) in GB, or the lifetime peak where /proc is missing'''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024**2
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024**2
+
+
+def _cpu_s():
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+@contextlib.contextmanager
+def stage(name, **tags):
+    '''Record wall/CPU time, peak RSS and I/O of the enclosed block as stage `name`
+
+    tags (subject, run, pair, ...) are stored with the record. A no-op when
+    tracing is off.
+    '''
+    if trace_file() is None:
+        yield
+        return
+    hwm, io, cpu, wall, start = _hwm_gb(), _proc_io(), _cpu_s(), time.perf_counter(), time.time()
+    status = 'end'
+    try:
+        yield
+    except BaseException:
+        status = 'exception'
+        raise
+    finally:
+        wall = time.perf_counter() - wall
+        cpu = _cpu_s() - cpu
+        end_io = _proc_io()
+        peak = _hwm_gb()
+        record = {'source': 'stage', 'stage': name, 'name': name, 'pid': os.getpid(), 'start': start,
+                  'wall_s': wall, 'cpu_s': cpu, 'peak_rss_gb': peak, 'hwm_delta_gb': peak - hwm,
+                  'read_mb': (end_io['rchar'] - io['rchar']) / 1024**2,
+                  'write_mb': (end_io['wchar'] - io['wchar']) / 1024**2,
+                  'disk_read_mb': (end_io['read_bytes'] - io['read_bytes']) / 1024**2,
+                  'disk_write_mb': (end_io['write_bytes'] - io['write_bytes']) / 1024**2,
+                  'status': status}
+        record.update(tags)
+        write_record(record)
+
+
+def _tree_mb(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total / 1024**2
+
+
+def _input_mb(node):
+    '''Total size of the existing files among a node's inputs'''
+    paths = set()
+
+    def collect(value):
+        if isinstance(value, str):
+            if os.path.isfile(value):
+                paths.add(value)
+        elif isinstance(value, (list, tuple)):
+            for v in value:
+                collect(v)
+    try:
+        for value in node.inputs.get_traitsfree().values():
+            collect(value)
+    except Exception:
+        return np.nan
+    return sum(os.path.getsize(p) for p in paths) / 1024**2
+
+
+def node_callback(node, status):
+    '''nipype status_callback writing one record per finished or failed node'''
+    if status == 'start' or trace_file() is None:
+        return
+    runtime = getattr(getattr(node, 'result', None), 'runtime', None)
+    record = {'source': 'nipype', 'stage': type(node.interface).__name__, 'name': node.fullname,
+              'params': '/'.join(node.parameterization), 'pid': getattr(runtime, 'pid', None),
+              'status': status, 'wall_s': getattr(runtime, 'duration', np.nan), 'cpu_s': np.nan,
+              'peak_rss_gb': getattr(runtime, 'mem_peak_gb', None) or np.nan,
+              'read_mb': np.nan, 'write_mb': np.nan, 'disk_read_mb': np.nan, 'disk_write_mb': np.nan,
+              'input_mb': _input_mb(node), 'output_mb': np.nan,
+              'mem_gb_estimate': node.mem_gb, 'n_procs': node.n_procs}
+    start = getattr(runtime, 'startTime', None)
+    if start:
+        record['start'] = pd.Timestamp(start).timestamp()
+    profile = getattr(runtime, 'prof_dict', None)
+    if profile and len(profile['time']) > 1:
+        # cpu percent samples of the node's process tree, integrated over time
+        cpus, times = np.asarray(profile['cpus']) / 100, np.asarray(profile['time'])
+        record['cpu_s'] = float(np.sum((cpus[1:] + cpus[:-1]) / 2 * np.diff(times)))
+    try:
+        record['output_mb'] = _tree_mb(node.output_dir())
+    except Exception:
+        pass
+    write_record(record)
+
+
+def node_trace_args(plugin_args=None):
+    '''plugin_args for Workflow.run, with node tracing when tracing is on
+
+    Also enables nipype's resource monitor for node CPU time and peak RSS,
+    which needs psutil.
+    '''
+    if trace_file() is None:
+        return dict(plugin_args or {})
+    from nipype import config
+    try:
+        import psutil  # noqa: F401
+        config.enable_resource_monitor()
+    except ImportError:
+        warnings.warn('psutil is not installed: nipype nodes are traced without CPU time and peak RSS')
+    return dict(plugin_args or {}, status_callback=node_callback)
+
+
+def load_trace(path=None):
+    '''All records of a trace as a DataFrame'''
+    with open(path or trace_file()) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    trace = pd.DataFrame(records)
+    for field in fields:
+        if field not in trace:
+            trace[field] = np.nan
+    trace['pid'] = trace['pid'].astype('Int64')
+    return trace[fields + [c for c in trace.columns if c not in fields]]
+
+
+def summarize(trace):
+    '''Totals per (source, stage): count, wall and CPU time, largest peak RSS and I/O'''
+    # Totals stay NaN when a field was never measured (e.g. node CPU without psutil)
+    total = lambda values: values.sum(min_count=1)
+    return trace.groupby(['source', 'stage'], sort=False).agg(
+        count=('wall_s', 'size'), wall_s=('wall_s', total), mean_wall_s=('wall_s', 'mean'),
+        cpu_s=('cpu_s', total), peak_rss_gb=('peak_rss_gb', 'max'),
+        hwm_delta_gb=('hwm_delta_gb', 'max'), read_mb=('read_mb', total),
+        write_mb=('write_mb', total), disk_read_mb=('disk_read_mb', total),
+        disk_write_mb=('disk_write_mb', total), input_mb=('input_mb', total),
+        output_mb=('output_mb', total)).reset_index()
+
+
+def export(path, out):
+    '''Write a trace as .csv or .json (records), chosen by the extension of out'''
+    trace = load_trace(path)
+    if out.endswith('.json'):
+        trace.to_json(out, orient='records', indent=1)
+    else:
+        trace.to_csv(out, index=False)
+    return trace
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize or export a stage / node trace')
+    parser.add_argument('trace', type=str, help='.jsonl trace written with MFT_TRACE')
+    parser.add_argument('-out', type=str, default=None, help='export all records to .csv or .json')
+    parser.add_argument('-summary', type=str, default=None, help='write the per-stage summary as csv')
+    args = parser.parse_args()
+
+    trace = export(args.trace, args.out) if args.out else load_trace(args.trace)
+    summary = summarize(trace)
+    if args.summary:
+        summary.to_csv(args.summary, index=False)
+    print('{} records from {} processes'.format(len(trace), trace['pid'].nunique()))
+    print(summary.to_string(index=False))
@@ -0,0 +1,168 @@
+# Small synthetic BIDS / fMRIPrep dataset with the vignette task layout
+#
+# Every run has the layout the pipelines expect: 11 + 668 + 11 volumes at
+# TR = 0.72 s (dummy scans are dropped with [11:-11]), 40 vignettes of the 8
+# conditions (5 each) with onset, duration, trial_type, stim_file and vigtext,
+# a behaviour file with moral_decision and RT for the same trials, and an
+# fMRIPrep confounds file with the columns of bids_index.confound_columns.
+# Bold runs live on a coarse MNI152NLin2009cAsym grid (8 mm by default) and
+# are a baseline plus HRF-convolved condition patterns and noise inside an
+# ellipsoid brain mask, so designs, GLMs, decoding and RDMs all run on it
+# with no real data.
+
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from scipy.stats import gamma
+
+tr = 0.72
+n_dummy = 11
+n_tr = 668
+n_vols = n_dummy + n_tr + n_dummy
+conditions = ['carep', 'carem', 'fair', 'lib', 'loy', 'auth', 'pur', 'socn']
+# Item prefixes of the stimulus files (sbert_embeddings.item_prefixes)
+item_prefixes = {'carep': 'carep', 'carem': 'careem', 'fair': 'fair', 'lib': 'lib',
+                 'loy': 'loy', 'auth': 'auth', 'pur': 'pur', 'socn': 'socn'}
+items_per_run = 5
+trial_spacing = 12.
+trial_duration = 7.92
+space = 'MNI152NLin2009cAsym'
+# Bounding box of the 2 mm MNI152NLin2009cAsym templates (mm)
+mni_origin = np.array([-96., -132., -78.])
+mni_extent = np.array([193., 229., 193.])
+confound_columns = ['dvars', 'framewise_displacement'] + \
+    ['a_comp_cor_%02d' % i for i in range(6)] + ['cosine%02d' % i for i in range(4)] + \
+    ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']
+
+
+def grid(voxel_mm=8):
+    '''Affine and shape of an MNI grid with voxel_mm voxels'''
+    shape = tuple(int(s) for s in np.ceil(mni_extent / voxel_mm))
+    affine = np.diag([voxel_mm, voxel_mm, voxel_mm, 1.])
+    affine[:3, 3] = mni_origin
+    return affine, shape
+
+
+def brain_mask(shape):
+    '''Ellipsoid filling most of the box'''
+    ijk = np.indices(shape, dtype=float)
+    centre = (np.array(shape) - 1) / 2
+    radius = 0.42 * np.array(shape)
+    return sum(((ijk[i] - centre[i]) / radius[i]) ** 2 for i in range(3)) <= 1
+
+
+def hrf(dt=tr, length=32.):
+    '''Double-gamma HRF (peak 6 s, undershoot 16 s) sampled every dt seconds'''
+    t = np.arange(0, length, dt)
+    h = gamma.pdf(t, 6) - gamma.pdf(t, 16) / 6
+    return h / h.sum()
+
+
+def run_events(rng, run):
+    '''40 trials of the 8 conditions in random order, ~12 s apart; onsets include the dummy scans'''
+    order = rng.permutation(np.repeat(conditions, items_per_run))
+    onsets = n_dummy * tr + 6 + trial_spacing * np.arange(len(order)) + rng.uniform(-1, 1, len(order))
+    counters = dict.fromkeys(conditions, 0)
+    stim_files, texts = [], []
+    for cond in order:
+        item = (run - 1) * items_per_run + counters[cond] + 1
+        counters[cond] += 1
+        stim_files.append('stimuli/{}{:02d}.txt'.format(item_prefixes[cond], item))
+        texts.append('You_see_someone_in_vignette_{}_{:02d}'.format(cond, item))
+    return pd.DataFrame({'onset': onsets.round(3), 'duration': trial_duration, 'trial_type': order,
+                         'stim_file': stim_files, 'vigtext': texts})
+
+
+def run_beh(rng, events, subject, missing=0.05):
+    '''Ratings (1-4, some missing) and RTs of a run's trials'''
+    effect = {c: i * 0.3 for i, c in enumerate(conditions)}
+    rating = np.clip(np.round(1 + events['trial_type'].map(effect) + rng.normal(0, 0.7, len(events))), 1, 4)
+    rt = rng.gamma(4, 0.5, len(events))
+    skipped = rng.random(len(events)) < missing
+    rating[skipped], rt[skipped] = np.nan, np.nan
+    return pd.DataFrame({'sub_id': subject, 'stim_file': events['stim_file'], 'trial_type': events['trial_type'],
+                         'moral_decision': rating, 'RT': rt.round(3)})
+
+
+def run_confounds(rng):
+    '''fMRIPrep-style confounds; dvars and framewise_displacement are undefined for the first volume'''
+    confounds = pd.DataFrame(rng.normal(0, 0.01, (n_vols, len(confound_columns))), columns=confound_columns)
+    motion = ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']
+    confounds[motion] = np.cumsum(rng.normal(0, 0.005, (n_vols, 6)), axis=0)
+    confounds['dvars'] = rng.gamma(20, 1, n_vols)
+    confounds['framewise_displacement'] = np.abs(np.diff(confounds[motion].to_numpy(), axis=0, prepend=0)).sum(axis=1)
+    confounds.loc[0, ['dvars', 'framewise_displacement']] = np.nan
+    t = np.arange(n_vols)
+    for k in range(4):
+        confounds['cosine%02d' % k] = np.cos(np.pi * (t + 0.5) * (k + 1) / n_vols) * np.sqrt(2. / n_vols)
+    return confounds
+
+
+def run_bold(rng, events, mask, patterns, noise=10., baseline=1000.):
+    '''(x, y, z, t) float32 run: baseline + condition patterns x convolved boxcars + noise'''
+    frames = np.arange(n_vols) * tr
+    boxcars = np.zeros((len(conditions), n_vols))
+    for ev in events.itertuples():
+        on = (frames >= ev.onset) & (frames < ev.onset + ev.duration)
+        boxcars[conditions.index(ev.trial_type), on] = 1
+    regressors = np.stack([np.convolve(b, hrf())[:n_vols] for b in boxcars])
+    data = np.zeros(mask.shape + (n_vols,), dtype=np.float32)
+    inside = (baseline + patterns @ regressors + rng.normal(0, noise, (len(patterns), n_vols))).astype(np.float32)
+    inside += np.cumsum(rng.normal(0, 0.2, n_vols)).astype(np.float32)  # slow drift
+    data[mask] = inside
+    return data
+
+
+def make_dataset(out_dir, n_subjects=2, n_runs=3, voxel_mm=8, effect=20., seed=0):
+    '''Write the dataset under out_dir and return the subject ids'''
+    rng = np.random.default_rng(seed)
+    affine, shape = grid(voxel_mm)
+    mask = brain_mask(shape)
+    subjects = ['sub-{:02d}'.format(s + 1) for s in range(n_subjects)]
+    fmriprep = os.path.join(out_dir, 'derivatives', 'fmriprep')
+    os.makedirs(fmriprep, exist_ok=True)
+    with open(os.path.join(out_dir, 'dataset_description.json'), 'w') as f:
+        json.dump({'Name': 'Synthetic vignettes', 'BIDSVersion': '1.6.0'}, f)
+    with open(os.path.join(out_dir, 'task-vignette_bold.json'), 'w') as f:
+        json.dump({'RepetitionTime': tr, 'TaskName': 'vignette'}, f)
+    pd.DataFrame({'participant_id': subjects, 'age': rng.integers(18, 60, n_subjects),
+                  'gender': rng.integers(0, 2, n_subjects), 'pol_orient': rng.integers(1, 8, n_subjects)}) \
+        .to_csv(os.path.join(out_dir, 'participants.tsv'), sep='\t', index=False)
+
+    shared = rng.normal(0, effect, (mask.sum(), len(conditions)))
+    for subject in subjects:
+        func, beh = os.path.join(out_dir, subject, 'func'), os.path.join(out_dir, subject, 'beh')
+        prep_func, prep_anat = os.path.join(fmriprep, subject, 'func'), os.path.join(fmriprep, subject, 'anat')
+        for d in [func, beh, prep_func, prep_anat]:
+            os.makedirs(d, exist_ok=True)
+        nib.save(nib.Nifti1Image(mask.astype(np.uint8), affine),
+                 os.path.join(prep_anat, '{}_space-{}_desc-brain_mask.nii.gz'.format(subject, space)))
+        patterns = shared + rng.normal(0, effect / 2, shared.shape)
+        for run in range(1, n_runs + 1):
+            prefix = '{}_task-vignette_run-{}'.format(subject, run)
+            events = run_events(rng, run)
+            events.to_csv(os.path.join(func, prefix + '_events.tsv'), sep='\t', index=False)
+            run_beh(rng, events, subject).to_csv(os.path.join(beh, prefix + '_beh.tsv'), sep='\t',
+                                                 index=False, na_rep='n/a')
+            run_confounds(rng).to_csv(os.path.join(prep_func, prefix + '_desc-confounds_timeseries.tsv'),
+                                      sep='\t', index=False, na_rep='n/a')
+            img = nib.Nifti1Image(run_bold(rng, events, mask, patterns), affine)
+            img.header.set_xyzt_units('mm', 'sec')
+            img.header['pixdim'][4] = tr
+            nib.save(img, os.path.join(prep_func, '{}_space-{}_desc-preproc_bold.nii.gz'.format(prefix, space)))
+    return subjects
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic vignette BIDS / fMRIPrep dataset')
+    parser.add_argument('out_dir', type=str)
+    parser.add_argument('-subjects', type=int, default=2)
+    parser.add_argument('-runs', type=int, default=3)
+    parser.add_argument('-voxel_mm', type=float, default=8)
+    parser.add_argument('-seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print(make_dataset(args.out_dir, args.subjects, args.runs, args.voxel_mm, seed=args.seed))
@@ -0,0 +1,130 @@
+# Run x condition tensors of the vignette judgments and RTs, and their RDMs
+#
+# parse_beh and parse_rt in rsa.ipynb filter the concatenated behaviour table
+# once per subject, impute missing responses with the subject's condition
+# median in a loop, and stack exactly three runs. Here one groupby/transform
+# imputes every subject at once, one groupby/unstack gives the run x
+# condition means, and the rows are scattered into a (subjects, runs,
+# conditions) tensor with each subject's runs first and missing runs
+# zero-padded. That is the input layout of crossnobis.crossnobis, so the
+# judgment and RT RDMs of all subjects come from one batched call.
+
+import os
+import glob
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+from crossnobis import crossnobis, pair_columns, stage
+
+exp_dir = '../../../bids'
+excluded_subjects = ['sub-35']  # left out of the RSA in rsa.ipynb
+
+# trial_type of each condition, in crossnobis.labels order
+beh_conditions = ['carep', 'carem', 'fair', 'lib', 'loy', 'auth', 'pur', 'socn']
+measures = {'moral_decision': 'Moral Judgment', 'RT': 'Response Time'}
+
+
+def load_beh(exp_dir=exp_dir):
+    '''All vignette behaviour files as one table (sub_id, item, trial_type, run, moral_decision, RT)'''
+    files = sorted(glob.glob(os.path.join(exp_dir, 'sub-*/beh/sub-*_task-vignette_*_beh.tsv')))
+    vig_beh = pd.concat([pd.read_csv(f, sep='\t').assign(file=f) for f in files], ignore_index=True)
+    vig_beh['run'] = vig_beh['file'].str.extract(r'run-(\d+)_', expand=False).astype(int)
+    vig_beh['item'] = vig_beh['stim_file'].str.split('/').str[-1].str.split('.').str[0]
+    return vig_beh[['sub_id', 'item', 'trial_type', 'run', 'moral_decision', 'RT']]
+
+
+def run_tensor(vig_beh, measure='moral_decision', conditions=beh_conditions, exclude=excluded_subjects):
+    '''Imputed run x condition means of every subject
+
+    Missing responses get the median of the subject's condition over all
+    runs. Returns the subjects, a (subjects, max_runs, conditions) tensor with
+    each subject's runs in order and missing runs zero-padded, and the number
+    of runs per subject.
+    '''
+    data = vig_beh[~vig_beh['sub_id'].isin(exclude)]
+    median = data.groupby(['sub_id', 'trial_type'])[measure].transform('median')
+    data = data.assign(value=data[measure].fillna(median))
+    cells = data.groupby(['sub_id', 'run', 'trial_type'])['value'].mean().unstack('trial_type')
+    cells = cells.reindex(columns=conditions)
+    subjects, sub_pos = np.unique(cells.index.get_level_values('sub_id'), return_inverse=True)
+    run_pos = cells.groupby(level='sub_id').cumcount().to_numpy()
+    n_runs = np.bincount(sub_pos)
+    X = np.zeros((len(subjects), n_runs.max(), len(conditions)))
+    X[sub_pos, run_pos] = cells.to_numpy()
+    return list(subjects), X, n_runs
+
+
+def beh_rdms(vig_beh, measure='moral_decision', exclude=excluded_subjects):
+    '''Crossnobis RDMs (subjects x pairs) of one behavioural measure, as calc_rdm in rsa.ipynb'''
+    with stage('RDM', measure=measure):
+        subjects, X, n_runs = run_tensor(vig_beh, measure, exclude=exclude)
+        return pd.DataFrame(crossnobis(X[..., None], n_runs), index=pd.Index(subjects, name='subject'),
+                            columns=pair_columns())
+
+
+def parse_measure(vig_beh, sub, measure='moral_decision'):
+    '''parse_beh / parse_rt of rsa.ipynb for one subject: (24, 1) measurements of runs 1-3'''
+    sub_data = vig_beh[vig_beh['sub_id'] == sub][['item', 'trial_type', measure, 'run']]
+    cond_medians = sub_data.groupby('trial_type')[measure].median()
+    for cond, median in cond_medians.items():
+        mask = sub_data[sub_data['trial_type'] == cond].index
+        sub_data.loc[mask, measure] = sub_data.loc[mask, measure].fillna(median)
+    by_run = sub_data.groupby(['run', 'trial_type'])[measure].mean()
+    runs_data = pd.concat([by_run.loc[run].loc[beh_conditions] for run in (1, 2, 3)])
+    return pd.DataFrame(runs_data).to_numpy()
+
+
+def synthetic_beh(n_subjects=1000, n_runs=3, items_per_run=5, missing=0.05, seed=0):
+    '''Behaviour table with missing responses; every tenth subject has one run fewer'''
+    rng = np.random.default_rng(seed)
+    sub, run, cond = np.meshgrid(np.arange(n_subjects), np.arange(1, n_runs + 1),
+                                 np.repeat(np.arange(len(beh_conditions)), items_per_run), indexing='ij')
+    keep = ~((sub % 10 == 0) & (run == n_runs))
+    sub, run, cond = sub[keep], run[keep], cond[keep]
+    vig_beh = pd.DataFrame({'sub_id': ['sub-{:04d}'.format(s) for s in sub],
+                            'item': ['{}{:02d}'.format(beh_conditions[c], k % 15) for k, c in enumerate(cond)],
+                            'trial_type': np.array(beh_conditions)[cond], 'run': run,
+                            'moral_decision': rng.integers(1, 5, len(sub)).astype(float) + cond * 0.1,
+                            'RT': rng.gamma(4, 0.5, len(sub)) + cond * 0.05})
+    for measure in measures:
+        vig_beh.loc[rng.random(len(vig_beh)) < missing, measure] = np.nan
+    return vig_beh
+
+
+def benchmark(n_subjects=1000, seed=0):
+    '''Runtime of run_tensor versus the per-subject parse loop, with agreement on three-run subjects'''
+    vig_beh = synthetic_beh(n_subjects, seed=seed)
+    row = {'subjects': n_subjects, 'rows': len(vig_beh)}
+    start = time.perf_counter()
+    subjects, X, n_runs = run_tensor(vig_beh, exclude=[])
+    row['tensor_s'] = time.perf_counter() - start
+    start = time.perf_counter()
+    rdms = crossnobis(X[..., None], n_runs)
+    row['rdms_s'] = time.perf_counter() - start
+    complete = [s for s, n in zip(subjects, n_runs) if n == 3]
+    start = time.perf_counter()
+    legacy = np.stack([parse_measure(vig_beh, sub) for sub in complete])
+    row['loop_s'] = time.perf_counter() - start
+    rows = [subjects.index(s) for s in complete]
+    row['max_abs_diff'] = np.abs(legacy.reshape(len(complete), 3, -1) - X[rows, :3]).max()
+    row['speedup'] = row['loop_s'] / row['tensor_s']
+    return row
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Judgment and RT run x condition tensors and crossnobis RDMs of all subjects')
+    parser.add_argument('-exp_dir', type=str, default=exp_dir, help='BIDS directory with sub-*/beh files')
+    parser.add_argument('-exclude', nargs='*', default=excluded_subjects)
+    parser.add_argument('-out', type=str, default='beh_rdms.csv', help='long csv for rdm_comparison.py -beh_rdms')
+    parser.add_argument('-benchmark', action='store_true', help='time against the per-subject loop on synthetic data')
+    parser.add_argument('-subjects', type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.benchmark:
+        print(pd.Series(benchmark(args.subjects)).to_string())
+    else:
+        vig_beh = load_beh(args.exp_dir)
+        pd.concat([beh_rdms(vig_beh, measure, args.exclude).reset_index().assign(name=name)
+                   for measure, name in measures.items()]).to_csv(args.out, index=False)
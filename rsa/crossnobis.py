@@ -0,0 +1,216 @@
+# Batched crossnobis RDMs for all subjects and ROIs
+#
+# rsa.ipynb calls rsr.calc_rdm(..., method='crossnobis', descriptor='conds',
+# cv_descriptor='sessions') once per subject and ROI. Without a noise model
+# that is the mean over run pairs r < t of (x_ri - x_rj).(x_ti - x_tj) / V.
+# Summed over all ordered run pairs this is |sum_r D_r|^2 - sum_r |D_r|^2, so
+# with the condition Gram matrices of the run sum and of each run,
+#   K = (sum_r X_r)(sum_r X_r)' - sum_r X_r X_r'
+#   d_ij = (K_ii + K_jj - K_ij - K_ji) / (R (R - 1) V)
+# gives every 8 x 8 RDM of a (subjects, runs, conditions, voxels) stack from
+# two batched matrix products. Missing runs are zero-padded and R is counted
+# per subject. ROIs run in a thread pool (the products release the GIL), so
+# the ROI stacks are shared rather than copied.
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mvpa'))
+from beta_store import BetaStore, conditions as labels
+from parcel_index import store_index
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'profiling'))
+from instrument import stage
+
+runwise_store = '../mvpa/betas/store/runwise_avg_smooth_zscored'
+neurosynth_mask = '../mvpa/masks/moral_uniformity-test_z_FDR_0.01.nii.gz'
+
+
+def pair_indices(n_conditions):
+    '''Condition pairs in rsatoolbox's RDM vector order (upper triangle, row-major)'''
+    return np.triu_indices(n_conditions, 1)
+
+
+def pair_columns():
+    '''Column names of the condition pairs, e.g. "Physical Care-Emotional Care"'''
+    i, j = pair_indices(len(labels))
+    return ['{}-{}'.format(labels[a], labels[b]) for a, b in zip(i, j)]
+
+
+def crossnobis(X, n_runs=None):
+    '''Crossnobis RDM vectors (n_subjects, n_pairs) of X (n_subjects, n_runs, n_conditions, n_voxels)
+
+    n_runs gives the runs present per subject (the first n_runs[s] along axis 1,
+    the rest zero-padded); by default every run is present. Every subject
+    needs at least two runs for the cross-validated distances.
+    '''
+    X = np.asarray(X, dtype=np.float64)
+    S, R, C, V = X.shape
+    n_runs = np.full(S, R) if n_runs is None else np.asarray(n_runs)
+    if (n_runs < 2).any():
+        raise ValueError('crossnobis needs at least two runs per subject; subjects {} have {}'.format(
+            np.flatnonzero(n_runs < 2).tolist(), n_runs[n_runs < 2].tolist()))
+    total = X.sum(axis=1)
+    K = total @ total.transpose(0, 2, 1) - (X @ X.transpose(0, 1, 3, 2)).sum(axis=1)
+    i, j = pair_indices(C)
+    d = K[:, i, i] + K[:, j, j] - K[:, i, j] - K[:, j, i]
+    return d / (n_runs * (n_runs - 1) * V)[:, None]
+
+
+def squareform(vectors, n_conditions=len(labels)):
+    '''(..., n_pairs) RDM vectors as (..., n_conditions, n_conditions) matrices'''
+    vectors = np.asarray(vectors)
+    out = np.zeros(vectors.shape[:-1] + (n_conditions, n_conditions))
+    i, j = pair_indices(n_conditions)
+    out[..., i, j] = vectors
+    out[..., j, i] = vectors
+    return out
+
+
+def model_rdms():
+    '''The categorical model RDM vectors of rsa.ipynb, one row per model'''
+    i, j = pair_indices(len(labels))
+
+    def categorical(categories):
+        categories = np.asarray(categories)
+        return (categories[i] != categories[j]).astype(float)
+
+    ind, bind, social = range(4), range(4, 7), 7
+    ind_bind_social = np.zeros((len(labels), len(labels)))
+    ind_bind_social[social, :social] = ind_bind_social[:social, social] = 1
+    ind_bind_social[np.ix_(ind, bind)] = ind_bind_social[np.ix_(bind, ind)] = 0.3
+    return pd.DataFrame([categorical(range(8)),
+                         categorical([0, 0, 0, 0, 1, 1, 1, 2]),
+                         ind_bind_social[i, j],
+                         categorical([0] * 7 + [1])],
+                        index=['Independent', 'Ind/Bind/Social', 'Ind:Bind/Social', 'Moral/Social'])
+
+
+def roi_crossnobis(rois, n_runs=None, n_jobs=-1):
+    '''Crossnobis RDM vectors of every ROI
+
+    rois: {name: (n_subjects, n_runs, n_conditions, n_voxels)}
+    Returns {name: (n_subjects, n_pairs)}.
+    '''
+    names = list(rois)
+    # ROIs share one process, so the thread pool is traced as a whole
+    with stage('RDM', rois=len(names)):
+        results = Parallel(n_jobs=n_jobs, prefer='threads')(
+            delayed(crossnobis)(rois[name], n_runs) for name in names)
+    return dict(zip(names, results))
+
+
+def load_rois(store, index, subjects=None):
+    '''ROI stacks {name: (n_subjects, max_runs, n_conditions, n_voxels)} from a runwise beta store
+
+    Each subject's rows are one contiguous slice of the store and all ROIs
+    come from one ParcelIndex gather; runs are zero-padded to the longest
+    subject. Subjects with fewer than two runs have no crossnobis RDM and are
+    left out (with a message). Returns the subjects, the stacks and the runs
+    per subject.
+    '''
+    table = store.index[store.index['run'] > 0]
+    subjects = subjects or sorted(table['subject'].unique())
+    runs = [sorted(table.loc[table['subject'] == s, 'run'].unique()) for s in subjects]
+    single = [s for s, r in zip(subjects, runs) if len(r) < 2]
+    if single:
+        print('Skipping {} subject(s) with fewer than two runs: {}'.format(len(single), ', '.join(single)))
+        runs = [r for r in runs if len(r) >= 2]
+        subjects = [s for s in subjects if s not in single]
+    n_runs = np.array([len(r) for r in runs])
+    sizes = index.sizes()
+    rois = {name: np.zeros((len(subjects), n_runs.max(), len(labels), size), dtype=np.float32)
+            for name, size in sizes.items()}
+    for s, (subject, subject_runs) in enumerate(zip(subjects, runs)):
+        rows = store.rows(subject=subject)
+        rows = rows[store.index['run'].to_numpy()[rows] > 0]
+        block = index.gather(store.data[rows[0]:rows[-1] + 1])
+        sub_index = store.index.iloc[rows]
+        run_pos = sub_index['run'].map({r: k for k, r in enumerate(subject_runs)}).to_numpy()
+        cond_pos = sub_index['condition'].map({c: k for k, c in enumerate(labels)}).to_numpy()
+        for name, data in block.items():
+            rois[name][s, run_pos, cond_pos] = data
+    return subjects, rois, n_runs
+
+
+def rsatoolbox_rdms(X, n_runs=None):
+    '''The rsa.ipynb loop: one rsatoolbox crossnobis RDM per subject'''
+    import rsatoolbox.data as rsd
+    import rsatoolbox.rdm as rsr
+    S, R, C, V = X.shape
+    n_runs = np.full(S, R) if n_runs is None else np.asarray(n_runs)
+    cond_names = ['{0:0>3}'.format(c) for c in range(C)]
+    out = []
+    for s in range(S):
+        obs_des = {'conds': np.tile(cond_names, n_runs[s]),
+                   'sessions': np.repeat(np.arange(1, n_runs[s] + 1), C)}
+        data = rsd.Dataset(measurements=X[s, :n_runs[s]].reshape(-1, V), obs_descriptors=obs_des)
+        out.append(rsr.calc_rdm(data, method='crossnobis', descriptor='conds',
+                                cv_descriptor='sessions').get_vectors()[0])
+    return np.array(out)
+
+
+def synthetic_rois(n_subjects=64, n_runs=3, n_rois=16, n_voxels=1500, seed=0):
+    '''ROI stacks with a shared condition structure plus noise; a quarter of subjects lose a run'''
+    rng = np.random.default_rng(seed)
+    runs = np.full(n_subjects, n_runs)
+    runs[::4] = n_runs - 1
+    rois = {}
+    for roi in range(n_rois):
+        X = rng.normal(size=(n_subjects, n_runs, len(labels), n_voxels))
+        X += rng.normal(size=(1, 1, len(labels), n_voxels)) * 0.3
+        X[np.arange(n_runs)[None, :] >= runs[:, None]] = 0
+        rois['roi_{:02d}'.format(roi)] = X
+    return rois, runs
+
+
+def benchmark(n_subjects=64, n_rois=16, n_voxels=1500, n_jobs=-1, seed=0):
+    '''Runtime of the batched engine and, when rsatoolbox is installed, the per-subject loop
+
+    'validated' says whether the RDMs were checked against rsatoolbox.
+    '''
+    rois, n_runs = synthetic_rois(n_subjects, n_rois=n_rois, n_voxels=n_voxels, seed=seed)
+    start = time.perf_counter()
+    batched = roi_crossnobis(rois, n_runs, n_jobs=n_jobs)
+    row = {'subjects': n_subjects, 'rois': n_rois, 'voxels': n_voxels,
+           'batched_s': time.perf_counter() - start}
+    try:
+        import rsatoolbox  # noqa: F401
+    except ImportError:
+        print('rsatoolbox is not installed: the batched RDMs were NOT validated against calc_rdm')
+        row['validated'] = False
+        return row
+    start = time.perf_counter()
+    reference = {name: rsatoolbox_rdms(X, n_runs) for name, X in rois.items()}
+    row.update(rsatoolbox_s=time.perf_counter() - start, validated=True,
+               max_abs_diff=max(np.abs(batched[k] - reference[k]).max() for k in rois))
+    row['speedup'] = row['rsatoolbox_s'] / row['batched_s']
+    return row
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Batched crossnobis RDMs for every subject and moral ROI')
+    parser.add_argument('-store', type=str, default=runwise_store, help='runwise beta store (beta_store.py)')
+    parser.add_argument('-out', type=str, default='crossnobis_rdms.csv')
+    parser.add_argument('-n_jobs', type=int, default=-1)
+    parser.add_argument('-benchmark', action='store_true', help='compare with rsatoolbox on synthetic data')
+    parser.add_argument('-rois', type=int, default=16)
+    parser.add_argument('-voxels', type=int, default=1500)
+    args = parser.parse_args()
+
+    if args.benchmark:
+        print(pd.Series(benchmark(n_rois=args.rois, n_voxels=args.voxels, n_jobs=args.n_jobs)).to_string())
+    else:
+        store = BetaStore(args.store)
+        start = time.perf_counter()
+        subjects, rois, n_runs = load_rois(store, store_index(store, mask=neurosynth_mask))
+        loaded = time.perf_counter()
+        rdms = roi_crossnobis(rois, n_runs, n_jobs=args.n_jobs)
+        print('Loaded {} subjects x {} ROIs in {:.1f}s, RDMs in {:.2f}s'.format(
+            len(subjects), len(rois), loaded - start, time.perf_counter() - loaded))
+        pd.concat([pd.DataFrame(v, columns=pair_columns()).assign(roi=name, subject=subjects)
+                   for name, v in rdms.items()]).to_csv(args.out, index=False)
@@ -0,0 +1,176 @@
+# Covariance-weighted cosine comparison of all candidate RDMs at once
+#
+# rsa.ipynb fills its model x model cosine matrix with nested loops calling
+# rsatoolbox.rdm.compare_cosine_cov_weighted for every ordered pair, which
+# rebuilds the weighting each time. That comparison is the cosine of
+# x' V^-1 y with V = (C C') o (C C'), C the (pairs x conditions) contrast
+# matrix, and depends only on the number of conditions. Here V^-1 is
+# factored once as W W', every RDM vector is whitened (x W) and normalized,
+# and the full matrix is one product. Subject-level RDMs (ROI crossnobis
+# RDMs, judgments, RTs) enter as subject means, which makes bootstrap
+# confidence intervals cheap: B resamples of subjects are a (B x subjects)
+# weight matrix applied to every subject-level RDM stack, followed by one
+# batched product.
+
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from scipy.linalg import cholesky
+
+from crossnobis import labels, model_rdms, pair_columns, pair_indices
+
+
+def contrast_matrix(n_conditions):
+    '''(n_pairs, n_conditions) rows e_i - e_j in RDM vector order'''
+    i, j = pair_indices(n_conditions)
+    C = np.zeros((len(i), n_conditions))
+    C[np.arange(len(i)), i] = 1
+    C[np.arange(len(i)), j] = -1
+    return C
+
+
+def distance_covariance(n_conditions):
+    '''V = (C C') o (C C'), rsatoolbox's covariance of distance estimates under i.i.d. noise'''
+    CC = contrast_matrix(n_conditions) @ contrast_matrix(n_conditions).T
+    return CC * CC
+
+
+def whitening(n_conditions):
+    '''W with W W' = V^-1, so (x W).(y W) = x' V^-1 y'''
+    return np.linalg.inv(cholesky(distance_covariance(n_conditions), lower=True)).T
+
+
+def _whiten(rdms, W):
+    Z = np.asarray(rdms, dtype=np.float64) @ W
+    return Z / np.linalg.norm(Z, axis=-1, keepdims=True)
+
+
+def cosine_matrix(rdms, W=None):
+    '''Covariance-weighted cosines (n, n) of RDM vectors (n, n_pairs)'''
+    rdms = np.asarray(rdms, dtype=np.float64)
+    Z = _whiten(rdms, whitening(len(labels)) if W is None else W)
+    return Z @ Z.T
+
+
+def pairwise_loop(rdms):
+    '''The rsa.ipynb pattern: every ordered pair separately, rebuilding V each time'''
+    rdms = np.asarray(rdms, dtype=np.float64)
+    n = len(rdms)
+    out = np.ones((n, n))
+    for a in range(n):
+        for b in range(n):
+            if a != b:
+                V = distance_covariance(len(labels))
+                xa, xb = np.linalg.solve(V, rdms[a]), np.linalg.solve(V, rdms[b])
+                out[a, b] = xa @ rdms[b] / np.sqrt(xa @ rdms[a]) / np.sqrt(xb @ rdms[b])
+    return out
+
+
+def rsatoolbox_loop(rdms):
+    '''compare_cosine_cov_weighted over all ordered pairs, as in rsa.ipynb'''
+    from rsatoolbox.rdm import RDMs, compare_cosine_cov_weighted
+    rdms = [RDMs(np.asarray(r)[None]) for r in rdms]
+    out = np.ones((len(rdms), len(rdms)))
+    for a, rdm_a in enumerate(rdms):
+        for b, rdm_b in enumerate(rdms):
+            if a != b:
+                out[a, b] = float(compare_cosine_cov_weighted(rdm_a, rdm_b)[0])
+    return out
+
+
+def compare(fixed, subject_rdms, n_boot=2000, ci=95, seed=0):
+    '''Cosine matrix of all RDMs with subject-bootstrap confidence intervals
+
+    fixed: DataFrame (names x n_pairs) of RDMs without subjects (models, sBERT)
+    subject_rdms: {name: DataFrame (subjects x n_pairs)}; subjects present in
+        every entry are resampled jointly, the mean over subjects is compared
+    Returns (cosines, lower, upper) DataFrames over fixed names then subject names.
+    '''
+    names = list(fixed.index) + list(subject_rdms)
+    W = whitening(len(labels))
+    fixed = np.asarray(fixed, dtype=np.float64)
+    if subject_rdms:
+        subjects = sorted(set.intersection(*[set(df.index) for df in subject_rdms.values()]))
+        stack = np.stack([np.asarray(df.loc[subjects], dtype=np.float64) for df in subject_rdms.values()])
+    else:
+        subjects, stack = [], np.zeros((0, 0, fixed.shape[1]))
+    S = len(subjects)
+    cosines = cosine_matrix(np.concatenate([fixed, stack.mean(axis=1)]), W)
+
+    lower = upper = np.full_like(cosines, np.nan)
+    if S and n_boot:
+        rng = np.random.default_rng(seed)
+        weights = rng.multinomial(S, np.full(S, 1. / S), size=n_boot) / S            # (B, S)
+        means = np.einsum('bs,nsp->bnp', weights, stack)                             # (B, n_subject_rdms, n_pairs)
+        Z = _whiten(np.concatenate([np.broadcast_to(fixed, (n_boot,) + fixed.shape), means], axis=1), W)
+        boot = Z @ Z.transpose(0, 2, 1)
+        lower, upper = np.percentile(boot, [(100 - ci) / 2, 100 - (100 - ci) / 2], axis=0)
+    return tuple(pd.DataFrame(m, index=names, columns=names) for m in (cosines, lower, upper))
+
+
+def load_subject_rdms(path, name_column='roi'):
+    '''{name: DataFrame (subjects x n_pairs)} from a long csv such as crossnobis.py output'''
+    table = pd.read_csv(path)
+    return {name: group.set_index('subject')[pair_columns()] for name, group in table.groupby(name_column, sort=False)}
+
+
+def benchmark(n_subjects=63, n_rois=16, n_boot=2000, seed=0):
+    '''Runtime of the engine with bootstrap against the pairwise loops on synthetic RDMs'''
+    rng = np.random.default_rng(seed)
+    fixed = model_rdms()
+    subject_rdms = {'roi_{:02d}'.format(r): pd.DataFrame(rng.random((n_subjects, len(pair_columns()))),
+                                                         columns=pair_columns())
+                    for r in range(n_rois)}
+    start = time.perf_counter()
+    cosines = compare(fixed, subject_rdms, n_boot=0)[0]
+    row = {'rdms': len(cosines), 'engine_s': time.perf_counter() - start}
+    start = time.perf_counter()
+    compare(fixed, subject_rdms, n_boot=n_boot, seed=seed)
+    row.update(n_boot=n_boot, engine_bootstrap_s=time.perf_counter() - start)
+    means = np.concatenate([fixed.to_numpy(), [df.mean().to_numpy() for df in subject_rdms.values()]])
+    start = time.perf_counter()
+    loop = pairwise_loop(means)
+    row['loop_s'] = time.perf_counter() - start
+    row['loop_max_abs_diff'] = np.abs(loop - cosines.to_numpy()).max()
+    try:
+        import rsatoolbox  # noqa: F401
+    except ImportError:
+        return row
+    start = time.perf_counter()
+    reference = rsatoolbox_loop(means)
+    row['rsatoolbox_s'] = time.perf_counter() - start
+    row['rsatoolbox_max_abs_diff'] = np.abs(reference - cosines.to_numpy()).max()
+    return row
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Covariance-weighted cosine matrix of all candidate RDMs with bootstrap CIs')
+    parser.add_argument('-roi_rdms', type=str, default='crossnobis_rdms.csv', help='crossnobis.py output')
+    parser.add_argument('-beh_rdms', type=str, default=None, help='long csv of subject RDMs with a name column')
+    parser.add_argument('-sbert', type=str, default=None, help='sbert_embeddings.py output')
+    parser.add_argument('-n_boot', type=int, default=2000)
+    parser.add_argument('-ci', type=float, default=95)
+    parser.add_argument('-seed', type=int, default=0)
+    parser.add_argument('-out', type=str, default='rdm_cosines.csv')
+    parser.add_argument('-benchmark', action='store_true', help='time against the pairwise loop on synthetic RDMs')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        print(pd.Series(benchmark(n_boot=args.n_boot)).to_string())
+    else:
+        fixed = model_rdms()
+        if args.sbert:
+            fixed.loc['sBERT'] = pd.read_csv(args.sbert)['sbert'].to_numpy()
+        subject_rdms = {}
+        if args.beh_rdms:
+            subject_rdms.update(load_subject_rdms(args.beh_rdms, 'name'))
+        subject_rdms.update(load_subject_rdms(args.roi_rdms))
+        start = time.perf_counter()
+        cosines, lower, upper = compare(fixed, subject_rdms, args.n_boot, args.ci, args.seed)
+        print('{0} x {0} cosines with {1} bootstrap samples in {2:.2f}s'.format(
+            len(cosines), args.n_boot, time.perf_counter() - start))
+        long = pd.concat({'cosine': cosines.stack(), 'lower': lower.stack(), 'upper': upper.stack()}, axis=1)
+        long.rename_axis(['rdm_a', 'rdm_b']).reset_index().to_csv(args.out, index=False)
+        cosines.to_csv(os.path.splitext(args.out)[0] + '_matrix.csv')
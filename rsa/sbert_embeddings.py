@@ -0,0 +1,183 @@
+# Cached sentence embeddings of the vignettes and the sBERT model RDM
+#
+# rsa.ipynb downloads all-mpnet-base-v2 and encodes all 120 vignettes every
+# time it runs, then averages the embeddings per condition into sbert_rdm.
+# Here the model is loaded from a local directory with the Hugging Face hub
+# switched offline, texts are encoded on the CPU in batches (PyTorch, or an
+# ONNX / int8-quantized ONNX export of the same model), and every embedding
+# is stored in a per-model cache keyed by the SHA-1 of its text. Re-running
+# the RSA or adding vignettes only encodes texts that are not cached yet.
+# `-download` fetches the model (and ONNX exports) once on a machine with
+# network access.
+
+import os
+import glob
+import time
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+
+model_name = 'sentence-transformers/all-mpnet-base-v2'
+model_dir = 'models/all-mpnet-base-v2'
+cache_dir = 'embeddings'
+events_glob = '/srv/lab/fmri/mft/fhopp_diss/bids/sub-01/func/sub-01_task-vignette_run-*_events.tsv'
+
+# Item prefixes of the conditions, in rsa.ipynb order
+item_prefixes = ['carep', 'careem', 'fair', 'lib', 'loy', 'auth', 'pur', 'socn']
+
+# ONNX files written by -download, per backend
+onnx_files = {'onnx': 'onnx/model.onnx', 'onnx-int8': 'onnx/model_qint8_avx2.onnx'}
+
+
+def load_vignettes(pattern=events_glob):
+    '''Vignette texts and conditions in rsa.ipynb item order (stim_file, vigtext, trial_type)'''
+    df_vig = pd.concat([pd.read_csv(f, sep='\t') for f in sorted(glob.glob(pattern))])[['stim_file', 'vigtext', 'trial_type']]
+    df_vig['vigtext'] = df_vig['vigtext'].str.replace('_', ' ')
+    df_vig['stim_file'] = df_vig['stim_file'].apply(lambda x: x.split('/')[-1].split('.')[0])
+    item_order = [c for prefix in item_prefixes for c in sorted(df_vig['stim_file']) if c.startswith(prefix)]
+    return df_vig.set_index('stim_file').loc[item_order].reset_index()
+
+
+def text_key(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache(object):
+    '''Embeddings of one model/backend keyed by text hash, persisted as an .npz file
+
+    Args:
+        path: cache file; created on the first save
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.vectors = {}
+        if os.path.exists(path):
+            with np.load(path) as f:
+                self.vectors = dict(zip(f['keys'].tolist(), f['vectors']))
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def missing(self, texts):
+        '''Unique texts without a cached embedding, in first-seen order'''
+        return [t for t in dict.fromkeys(texts) if text_key(t) not in self.vectors]
+
+    def update(self, texts, vectors):
+        self.vectors.update(zip(map(text_key, texts), np.asarray(vectors, dtype=np.float32)))
+
+    def lookup(self, texts):
+        return np.stack([self.vectors[text_key(t)] for t in texts])
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = self.path + '.tmp.npz'
+        np.savez(tmp, keys=np.array(list(self.vectors)), vectors=np.stack(list(self.vectors.values())))
+        os.replace(tmp, self.path)
+
+
+def cache_file(model_path=model_dir, backend='torch', cache_root=cache_dir):
+    return os.path.join(cache_root, '{}_{}.npz'.format(os.path.basename(os.path.normpath(model_path)), backend))
+
+
+def load_model(model_path=model_dir, backend='torch', threads=None):
+    '''SentenceTransformer on the CPU from a local directory, without network access'''
+    os.environ['HF_HUB_OFFLINE'] = '1'
+    os.environ['TRANSFORMERS_OFFLINE'] = '1'
+    import torch
+    from sentence_transformers import SentenceTransformer
+    if threads:
+        torch.set_num_threads(threads)
+    if backend == 'torch':
+        return SentenceTransformer(model_path, device='cpu', local_files_only=True)
+    return SentenceTransformer(model_path, device='cpu', backend='onnx', local_files_only=True,
+                               model_kwargs={'file_name': onnx_files[backend]})
+
+
+def download(model_path=model_dir):
+    '''Save the model and its ONNX and int8 ONNX exports to model_path (needs network access)'''
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+    SentenceTransformer(model_name, device='cpu').save(model_path)
+    onnx = SentenceTransformer(model_name, device='cpu', backend='onnx')
+    onnx.save(model_path)
+    export_dynamic_quantized_onnx_model(onnx, 'avx2', model_path)
+
+
+def tune_batch_size(model, texts, sizes=(4, 8, 16, 32, 64)):
+    '''Batch size with the highest encoding throughput on texts; returns it and the texts/s per size'''
+    rate = {}
+    for size in sizes:
+        start = time.perf_counter()
+        model.encode(texts, batch_size=size)
+        rate[size] = len(texts) / (time.perf_counter() - start)
+    return max(rate, key=rate.get), rate
+
+
+def encode(texts, model=None, cache=None, batch_size=32, **model_kwargs):
+    '''(n_texts, n_dims) embeddings of texts, encoding only those not in cache
+
+    The model is loaded (with model_kwargs) only if something needs encoding.
+    '''
+    texts = list(texts)
+    cache = cache or EmbeddingCache(cache_file(**{k: v for k, v in model_kwargs.items()
+                                                  if k in ('model_path', 'backend')}))
+    new = cache.missing(texts)
+    if new:
+        model = model or load_model(**model_kwargs)
+        cache.update(new, model.encode(new, batch_size=batch_size, convert_to_numpy=True))
+        cache.save()
+    return cache.lookup(texts)
+
+
+def condition_vectors(df_vig, embeddings):
+    '''Mean embedding per condition, conditions in order of appearance'''
+    vectors = pd.DataFrame(embeddings, index=df_vig['trial_type'].to_numpy())
+    return vectors.groupby(level=0).mean().loc[df_vig['trial_type'].unique()]
+
+
+def sbert_rdm(vectors):
+    '''Cosine-distance RDM vector (upper triangle) of the condition embeddings'''
+    X = np.asarray(vectors, dtype=np.float64)
+    X = X / np.linalg.norm(X, axis=1, keepdims=True)
+    i, j = np.triu_indices(len(X), 1)
+    return 1 - (X @ X.T)[i, j]
+
+
+def sbert_model_rdm(pattern=events_glob, **kwargs):
+    '''The sBERT model RDM as a named row to go with crossnobis.model_rdms()'''
+    df_vig = load_vignettes(pattern)
+    return pd.Series(sbert_rdm(condition_vectors(df_vig, encode(df_vig['vigtext'], **kwargs))), name='sBERT')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cached CPU sentence embeddings of the vignettes and the sBERT RDM')
+    parser.add_argument('-model_dir', type=str, default=model_dir, help='local SentenceTransformer directory')
+    parser.add_argument('-backend', choices=['torch', 'onnx', 'onnx-int8'], default='torch')
+    parser.add_argument('-events', type=str, default=events_glob, help='glob of vignette events.tsv files')
+    parser.add_argument('-batch_size', type=int, default=32)
+    parser.add_argument('-threads', type=int, default=None)
+    parser.add_argument('-tune', action='store_true', help='time batch sizes on the vignettes before encoding')
+    parser.add_argument('-download', action='store_true', help='save the model and ONNX exports to -model_dir')
+    parser.add_argument('-out', type=str, default='sbert_rdm.csv')
+    args = parser.parse_args()
+
+    if args.download:
+        download(args.model_dir)
+    df_vig = load_vignettes(args.events)
+    cache = EmbeddingCache(cache_file(args.model_dir, args.backend))
+    model, batch_size = None, args.batch_size
+    if args.tune:
+        model = load_model(args.model_dir, args.backend, args.threads)
+        batch_size, rate = tune_batch_size(model, list(df_vig['vigtext']))
+        print('texts/s by batch size: {}'.format({k: round(v, 1) for k, v in rate.items()}))
+    start = time.perf_counter()
+    n_new = len(cache.missing(df_vig['vigtext']))
+    embeddings = encode(df_vig['vigtext'], model, cache, batch_size,
+                        model_path=args.model_dir, backend=args.backend, threads=args.threads)
+    print('{} texts ({} encoded, {} cached) in {:.2f}s'.format(len(df_vig), n_new, len(df_vig) - n_new,
+                                                              time.perf_counter() - start))
+    vectors = condition_vectors(df_vig, embeddings)
+    i, j = np.triu_indices(len(vectors), 1)
+    pd.DataFrame({'condition_a': vectors.index[i], 'condition_b': vectors.index[j],
+                  'sbert': sbert_rdm(vectors)}).to_csv(args.out, index=False)
@@ -0,0 +1,248 @@
+# Whole-brain searchlight RSA and decoding over a beta store
+#
+# Sphere neighbourhoods of every brain voxel are built once as a CSR matrix
+# (centres x store columns) and cached next to the store. Two modes:
+#   rsa - crossnobis RDMs of every sphere from the runwise betas. For each
+#         voxel and condition pair the crossnobis numerator is
+#         (sum_r D_r)^2 - sum_r D_r^2, so a block of sphere RDMs for all
+#         subjects is one sparse (centres x voxels) x (voxels x subjects *
+#         pairs) product. Each sphere RDM is compared with the categorical
+#         models of rsa.ipynb by covariance-weighted cosine (whitened as in
+#         rdm_comparison.py); maps hold the subject mean and one-sample t.
+#   ridge - LOSO forced-choice accuracy of condition pairs from the
+#   svm     condition-average betas; each centre's (conditions x subjects)^2
+#           linear kernel is computed once and every pair is decoded from a
+#           block of it with kernel_decoding.py: ridge needs one solve per
+#           pair for all folds, svm refits a precomputed-kernel SVC per fold.
+# Blocks of centres go to a process pool; workers map the store and the
+# neighbourhood arrays from disk instead of receiving copies.
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from itertools import combinations
+from scipy import sparse
+from concurrent.futures import ProcessPoolExecutor
+from threadpoolctl import threadpool_limits
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mvpa'))
+from beta_store import BetaStore
+from crossnobis import labels, model_rdms, pair_indices, runwise_store
+from rdm_comparison import whitening
+from kernel_decoding import pair_rows, ridge_loso, svm_loso, ridge_alpha
+
+avg_store = '../mvpa/betas/store/condition_avg_smooth_zscored'
+radius_mm = 6
+block_size = 500
+
+_shared = {}
+
+
+def sphere_offsets(radius, voxel_size):
+    '''Integer voxel offsets within radius (mm) of the centre'''
+    reach = np.floor(radius / np.asarray(voxel_size)).astype(int)
+    grid = np.stack(np.meshgrid(*[np.arange(-r, r + 1) for r in reach], indexing='ij'), -1).reshape(-1, 3)
+    return grid[((grid * voxel_size) ** 2).sum(axis=1) <= radius ** 2 + 1e-6]
+
+
+def neighbourhoods(ijk, shape, affine, radius=radius_mm):
+    '''CSR matrix (n_voxels, n_voxels): row c marks the store columns within radius of voxel c'''
+    lookup = np.full(shape, -1, dtype=np.int64)
+    lookup[ijk[:, 0], ijk[:, 1], ijk[:, 2]] = np.arange(len(ijk))
+    rows, cols = [], []
+    for offset in sphere_offsets(radius, np.sqrt((affine[:3, :3] ** 2).sum(axis=0))):
+        nb = ijk + offset
+        inside = np.all((nb >= 0) & (nb < shape), axis=1)
+        col = np.full(len(ijk), -1)
+        col[inside] = lookup[nb[inside, 0], nb[inside, 1], nb[inside, 2]]
+        rows.append(np.flatnonzero(col >= 0))
+        cols.append(col[col >= 0])
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    return sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=(len(ijk), len(ijk)))
+
+
+def cached_neighbourhoods(store, radius=radius_mm):
+    '''Neighbourhood arrays of a store, saved as indptr/indices .npy under the store'''
+    cache = os.path.join(store.store_dir, 'searchlight_r{:g}'.format(radius))
+    if not os.path.exists(os.path.join(cache, 'indices.npy')):
+        A = neighbourhoods(store.ijk, store.shape, store.affine, radius)
+        os.makedirs(cache, exist_ok=True)
+        np.save(os.path.join(cache, 'indptr.npy'), A.indptr.astype(np.int64))
+        np.save(os.path.join(cache, 'indices.npy'), A.indices.astype(np.int32))
+    return cache
+
+
+def run_rows(store):
+    '''(n_subjects, max_runs, n_conditions) store rows of the runwise betas (-1 where missing)'''
+    table = store.index[store.index['run'] > 0]
+    subjects = sorted(table['subject'].unique())
+    runs = [sorted(table.loc[table['subject'] == s, 'run'].unique()) for s in subjects]
+    rows = np.full((len(subjects), max(len(r) for r in runs), len(labels)), -1)
+    for s, subject in enumerate(subjects):
+        for row, (run, condition) in zip(table.index[table['subject'] == subject],
+                                         table.loc[table['subject'] == subject, ['run', 'condition']].values):
+            rows[s, runs[s].index(run), labels.index(condition)] = row
+    return subjects, rows, np.array([len(r) for r in runs])
+
+
+def average_rows(store):
+    '''(n_conditions, n_subjects) store rows of the condition-average betas'''
+    table = store.index[store.index['run'] == 0]
+    subjects = sorted(table['subject'].unique())
+    rows = np.full((len(labels), len(subjects)), -1)
+    for row, (subject, condition) in zip(table.index, table[['subject', 'condition']].values):
+        rows[labels.index(condition), subjects.index(subject)] = row
+    return subjects, rows
+
+
+def _attach(store_dir, cache):
+    '''Process pool initializer: map the store and neighbourhoods read-only'''
+    threadpool_limits(1)
+    _shared.update(data=np.load(os.path.join(store_dir, 'betas.npy'), mmap_mode='r'),
+                   indptr=np.load(os.path.join(cache, 'indptr.npy'), mmap_mode='r'),
+                   indices=np.load(os.path.join(cache, 'indices.npy'), mmap_mode='r'))
+
+
+def _block(centres):
+    '''Local CSR of a block of centres and the store columns it touches'''
+    indptr, indices = _shared['indptr'], _shared['indices']
+    starts, lengths = indptr[centres], indptr[centres + 1] - indptr[centres]
+    local_ptr = np.concatenate([[0], np.cumsum(lengths)])
+    positions = np.repeat(starts - local_ptr[:-1], lengths) + np.arange(local_ptr[-1])
+    cols, local = np.unique(np.asarray(indices[positions]), return_inverse=True)
+    A = sparse.csr_matrix((np.ones(len(local), dtype=np.float32), local, local_ptr),
+                          shape=(len(centres), len(cols)))
+    return A, cols
+
+
+def _gather(rows, cols):
+    '''Store values at rows (any shape, -1 = missing -> 0) and columns'''
+    flat = rows.ravel()
+    out = np.zeros((len(flat), len(cols)), dtype=np.float32)
+    present = flat >= 0
+    out[present] = _shared['data'][flat[present]][:, cols]
+    return out.reshape(rows.shape + (len(cols),))
+
+
+def _unit(rdms, W):
+    '''Whitened RDM vectors scaled to unit length (all-zero ones stay zero)'''
+    Z = rdms @ W
+    norm = np.linalg.norm(Z, axis=-1, keepdims=True)
+    return Z / np.where(norm > 0, norm, 1)
+
+
+def _rsa_block(centres, rows, n_runs, models, W):
+    '''Mean and t (over subjects) of the covariance-weighted cosine between sphere RDMs and each model'''
+    A, cols = _block(centres)
+    X = _gather(rows, cols)                                 # (S, R, C, k)
+    i, j = pair_indices(X.shape[2])
+    D = X[:, :, i] - X[:, :, j]                             # (S, R, P, k)
+    q = D.sum(axis=1) ** 2 - (D ** 2).sum(axis=1)           # (S, P, k)
+    S, P, k = q.shape
+    rdms = (A @ q.reshape(S * P, k).T).reshape(len(centres), S, P)
+    n = np.asarray(A.sum(axis=1)).ravel()
+    rdms /= n[:, None, None] * (n_runs * (n_runs - 1))[None, :, None]
+    cos = _unit(rdms.astype(np.float64), W) @ _unit(models, W).T
+    mean = cos.mean(axis=1)
+    sd = cos.std(axis=1, ddof=1)
+    return mean, mean / (sd / np.sqrt(S))
+
+
+def _decode_block(centres, rows, pairs, method='ridge', alpha=ridge_alpha, C=1.0):
+    '''Forced-choice LOSO accuracy of every pair for each centre in the block'''
+    A, cols = _block(centres)
+    X = _gather(rows, cols).astype(np.float64)              # (C, S, k)
+    n_cond, S = rows.shape
+    y = np.concatenate([np.ones(S), np.zeros(S)])
+    accuracy = np.empty((len(centres), len(pairs)))
+    for c in range(len(centres)):
+        sphere = A.indices[A.indptr[c]:A.indptr[c + 1]]
+        Xc = X[:, :, sphere].reshape(n_cond * S, -1)
+        K = Xc @ Xc.T
+        for p, (a, b) in enumerate(pairs):
+            obs = pair_rows(a, b, S)
+            d = ridge_loso(K, obs, y, alpha) if method == 'ridge' else svm_loso(K, obs, y, C)
+            accuracy[c, p] = np.mean(d[0] > d[1])
+    return (accuracy,)
+
+
+def searchlight(store_dir, mode='rsa', radius=radius_mm, centres=None, pairs=None, n_jobs=None,
+                block=block_size):
+    '''Searchlight maps over every store voxel (or the given centre columns)
+
+    mode is 'rsa', 'ridge' or 'svm'. Returns a dict of (n_centres, ...)
+    arrays in the order of centres, the centres and voxels per second.
+    '''
+    store = BetaStore(store_dir)
+    cache = cached_neighbourhoods(store, radius)
+    centres = np.arange(store.data.shape[1]) if centres is None else np.asarray(centres)
+    # Positions in centres of each block, so results land where their centres are in any order
+    blocks = [np.arange(b, min(b + block, len(centres))) for b in range(0, len(centres), block)]
+    n_jobs = n_jobs or os.cpu_count()
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_attach, initargs=(store_dir, cache)) as pool:
+        if mode == 'rsa':
+            subjects, rows, n_runs = run_rows(store)
+            if (n_runs < 2).any():
+                raise ValueError('crossnobis needs at least two runs per subject: {}'.format(
+                    [s for s, n in zip(subjects, n_runs) if n < 2]))
+            models = model_rdms()
+            W = whitening(len(labels))
+            keys = ['mean', 't']
+            out = {key: np.empty((len(centres), len(models))) for key in keys}
+            futures = [pool.submit(_rsa_block, centres[pos], rows, n_runs, models.to_numpy(), W) for pos in blocks]
+            out['names'] = list(models.index)
+        else:
+            subjects, rows = average_rows(store)
+            pairs = pairs or list(combinations(range(len(labels)), 2))
+            keys = ['accuracy']
+            out = {'accuracy': np.empty((len(centres), len(pairs)))}
+            futures = [pool.submit(_decode_block, centres[pos], rows, pairs, mode) for pos in blocks]
+            out['names'] = ['{}-{}'.format(labels[a], labels[b]) for a, b in pairs]
+        for pos, future in zip(blocks, futures):
+            for key, values in zip(keys, future.result()):
+                out[key][pos] = values
+    elapsed = time.perf_counter() - start
+    out.update(centres=centres, subjects=subjects, voxels_per_sec=len(centres) / elapsed)
+    return out
+
+
+def write_maps(store, result, out_dir, mode):
+    '''One NIfTI per output (4D over models or pairs) in store space'''
+    os.makedirs(out_dir, exist_ok=True)
+    keys = ['mean', 't'] if mode == 'rsa' else ['accuracy']
+    for key in keys:
+        values = np.zeros((store.data.shape[1], result[key].shape[1]), dtype=np.float32)
+        values[result['centres']] = result[key]
+        vols = np.stack([np.asarray(store.volume(v).dataobj) for v in values.T], axis=-1)
+        nib.save(nib.Nifti1Image(vols, store.affine), os.path.join(out_dir, 'searchlight_{}_{}.nii.gz'.format(mode, key)))
+        if mode != 'rsa':
+            nib.save(store.volume(values.mean(axis=1)), os.path.join(out_dir, 'searchlight_{}_mean_accuracy.nii.gz'.format(mode)))
+    pd.Series(result['names']).to_csv(os.path.join(out_dir, 'searchlight_{}_volumes.csv'.format(mode)),
+                                      index=False, header=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Whole-brain searchlight crossnobis RSA or LOSO ridge / SVM decoding')
+    parser.add_argument('-mode', choices=['rsa', 'ridge', 'svm'], default='rsa')
+    parser.add_argument('-store', type=str, default=None,
+                        help='beta store (default: runwise store for rsa, condition-average store for decoding)')
+    parser.add_argument('-radius', type=float, default=radius_mm, help='sphere radius in mm')
+    parser.add_argument('-mask', type=str, default=None, help='only use centres inside this mask image')
+    parser.add_argument('-n_jobs', type=int, default=None)
+    parser.add_argument('-block', type=int, default=block_size, help='centres per task')
+    parser.add_argument('-out_dir', type=str, default='searchlight')
+    args = parser.parse_args()
+
+    store_dir = args.store or (runwise_store if args.mode == 'rsa' else avg_store)
+    store = BetaStore(store_dir)
+    centres = store.mask_columns(args.mask) if args.mask else None
+    result = searchlight(store_dir, args.mode, args.radius, centres, n_jobs=args.n_jobs, block=args.block)
+    write_maps(store, result, args.out_dir, args.mode)
+    print('{} centres, {} subjects: {:.0f} voxels/sec'.format(
+        len(result['centres']), len(result['subjects']), result['voxels_per_sec']))